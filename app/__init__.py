@@ -1,7 +1,20 @@
 """EPUBAR - EPUB Library and Reader application module"""
 import os
-from flask import Flask
-from app.models.db import db
+import tempfile
+from flask import Flask, jsonify
+from app.models.db import db, apply_sqlite_profile, DEFAULT_SQLITE_PRAGMAS
+from app.models.migrations import upgrade
+from app.utils.concurrency.singleflight import singleflight
+from app.utils.concurrency.admission import admission, DEFAULT_LIMITS
+from app.utils.content.workers import parser_pool
+from app.utils.content.artifacts import artifact_migrator
+from app.utils.content.images import image_variants
+from app.utils.content.packs import reader_packs
+from app.utils.content.stylesheets import stylesheet_bundler
+from app.utils.epub.processor import EPUBProcessor, DecompressionBudget
+from app.utils.epub.workspace import workspace_janitor, WorkspaceQuotaExceeded
+from app.utils.reading.positions import position_buffer
+from app.utils.search.fulltext import book_text_index
 
 
 def create_app(test_config=None):
@@ -16,8 +29,59 @@ def create_app(test_config=None):
         SECRET_KEY=os.environ.get('SECRET_KEY', 'dev'),
         SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', 'sqlite:///data/epubar.db'),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLITE_PRAGMAS=DEFAULT_SQLITE_PRAGMAS,  # storage profile applied on connect
         UPLOAD_FOLDER=os.path.join(os.getcwd(), 'uploads'),
         MAX_CONTENT_LENGTH=50 * 1024 * 1024,  # 50MB max upload size
+        LIBRARY_PAGE_SIZE=48,  # books per library page
+        API_PAGE_SIZE=100,  # default page size of paginated API listings
+        API_MAX_PAGE_SIZE=1000,
+        ANNOTATION_BATCH_MAX=5000,  # operations accepted per annotation batch
+        # Elements of rendered chapters carrying data-epubar-id: 'elements' (every
+        # annotatable element) or 'blocks' (block-level only, smaller chapters)
+        READER_ANCHOR_MODE=os.environ.get('READER_ANCHOR_MODE', 'elements'),
+        # Lock/result files for coalescing renders across worker processes
+        SINGLEFLIGHT_LOCK_DIR=os.path.join(tempfile.gettempdir(), 'epubar-locks'),
+        SINGLEFLIGHT_RESULT_TTL=60,  # seconds lock/result files outlive their flight
+        # Per endpoint class: concurrent requests and bounded wait queue
+        ADMISSION_LIMITS=DEFAULT_LIMITS,
+        ADMISSION_QUEUE_TIMEOUT=5.0,  # seconds a queued request may wait
+        ADMISSION_RETRY_AFTER=2,  # seconds advertised to rejected clients
+        # Sandboxed chapter parsing (size 0 renders in the web worker)
+        PARSER_POOL_SIZE=int(os.environ.get('PARSER_POOL_SIZE', 0)),
+        PARSER_POOL_TIMEOUT=20.0,  # wall-clock seconds per chapter
+        PARSER_POOL_MEMORY_LIMIT=512 * 1024 * 1024,  # address space per worker
+        PARSER_POOL_MAX_TASKS=50,  # chapters before a worker is recycled
+        PARSER_FALLBACK_DIR=os.path.join(tempfile.gettempdir(), 'epubar-fallbacks'),
+        PARSER_FALLBACK_MAX_AGE=7 * 24 * 3600,  # seconds a cached fallback is kept after its last use
+        # Scoped per-book stylesheet bundles
+        STYLESHEET_DIR=None,  # defaults to UPLOAD_FOLDER/stylesheets
+        # Responsive image variants, rendered on first request
+        IMAGE_CACHE_DIR=None,  # defaults to UPLOAD_FOLDER/images
+        IMAGE_WIDTHS=(480, 960, 1600),  # variant widths offered in srcset
+        IMAGE_QUALITY=80,
+        # Rendered chapters of each book in one memory-mapped file
+        READER_PACK_DIR=None,  # defaults to UPLOAD_FOLDER/packs
+        READER_PACK_GZIP=True,  # store a gzip encoding of every chapter
+        READER_PACK_MAX_OPEN=256,  # packs kept memory-mapped, least recently read unmapped first
+        # Background migration of derived artifacts built by older code versions
+        ARTIFACT_REBUILD_INTERVAL=30,  # seconds between rebuild runs, 0 disables them
+        ARTIFACT_REBUILD_BATCH=2,  # books rebuilt per run
+        ARTIFACT_BASE_URL=None,  # public root URL for links in rebuilt packs, e.g. https://host/reader
+        # Decompression budget applied to every archive read
+        EPUB_MAX_UNCOMPRESSED_BYTES=512 * 1024 * 1024,
+        EPUB_MAX_ENTRIES=10000,
+        EPUB_MAX_COMPRESSION_RATIO=100.0,
+        # Extraction workspaces (epubar_* directories)
+        WORKSPACE_ROOT=os.environ.get('WORKSPACE_ROOT'),  # defaults to the system temp dir
+        WORKSPACE_MAX_AGE=3600,  # seconds before an unreleased workspace is an orphan
+        WORKSPACE_QUOTA_BYTES=2 * 1024 * 1024 * 1024,  # 0 disables the quota
+        WORKSPACE_SWEEP_INTERVAL=300,  # seconds between sweeps, 0 disables the sweeper
+        # Write-behind reading positions: the flush interval is the durability window
+        POSITION_FLUSH_INTERVAL=5.0,  # seconds, 0 writes every update through
+        POSITION_MAX_PENDING=5000,  # buffered (user, book) pairs forcing an early flush
+        # Full-text index: books uploaded before it existed are indexed in the background
+        SEARCH_BACKFILL_INTERVAL=60,  # seconds between backfill runs, 0 disables them
+        SEARCH_BACKFILL_BATCH=5,  # books indexed per run
     )
     
     # Load test config if provided
@@ -30,7 +94,48 @@ def create_app(test_config=None):
     # Initialize database
     db.init_app(app)
     with app.app_context():
+        # Import the models so create_all() knows every table
+        from app.models import (  # noqa: F401
+            user, book, reading_state, annotation, sync_change, book_text, chapter_location, book_image,
+            book_artifact
+        )
+        
+        apply_sqlite_profile(db.engine, app.config['SQLITE_PRAGMAS'])
         db.create_all()
+        upgrade(db.engine, {'anchor_mode': app.config['READER_ANCHOR_MODE']})
+    
+    # Guard every archive read against zip bombs
+    EPUBProcessor.default_budget = DecompressionBudget.from_config(app.config)
+    
+    # Account for extraction workspaces and sweep orphaned ones
+    workspace_janitor.init_app(app)
+    
+    # Batch reading-position updates into periodic transactions
+    position_buffer.init_app(app)
+    
+    # Index book contents for full-text search
+    book_text_index.init_app(app)
+    
+    # Coalesce concurrent renders of the same chapter, spine or cover
+    singleflight.init_app(app)
+    
+    # Bound concurrent uploads, renders and media requests
+    admission.init_app(app)
+    
+    # Render chapters in sandboxed, time-limited worker processes
+    parser_pool.init_app(app)
+    
+    # Serve each book's CSS as one scoped, content-addressed bundle
+    stylesheet_bundler.init_app(app)
+    
+    # Index book images and serve size-capped variants of them
+    image_variants.init_app(app)
+    
+    # Serve rendered chapters from per-book packs
+    reader_packs.init_app(app)
+    
+    # Rebuild artifacts stamped by older code versions, lazily and in the background
+    artifact_migrator.init_app(app)
     
     # Register blueprints
     from app.routes.main import main_bp
@@ -43,4 +148,17 @@ def create_app(test_config=None):
     app.register_blueprint(reader_bp, url_prefix='/reader')
     app.register_blueprint(api_bp, url_prefix='/api')
     
+    @app.template_filter('date')
+    def format_date(value, fmt='%b %d, %Y'):
+        """Format a datetime for display"""
+        return value.strftime(fmt) if value else ''
+    
+    @app.errorhandler(WorkspaceQuotaExceeded)
+    def workspace_quota_exceeded(error):
+        """Turn requests away while extraction workspaces are over quota"""
+        response = jsonify({'error': str(error)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
+        return response
+    
     return app
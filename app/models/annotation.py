@@ -2,7 +2,7 @@
 Annotation model for storing highlights, notes, and bookmarks
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Enum, Index
 from sqlalchemy.orm import relationship
 import enum
 
@@ -17,6 +17,11 @@ class AnnotationType(enum.Enum):
 class Annotation(db.Model):
     """Annotation model for managing highlights, notes, and bookmarks"""
     __tablename__ = 'annotations'
+    __table_args__ = (
+        # A user's annotations for a book, optionally narrowed to a chapter
+        Index('ix_annotations_user_book_chapter', 'user_id', 'book_id', 'chapter_index'),
+        Index('ix_annotations_book_chapter', 'book_id', 'chapter_index'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -26,6 +31,9 @@ class Annotation(db.Model):
     color = Column(String(50))  # For highlights
     position_data = Column(Text, nullable=False)  # JSON string with selection position data
     chapter_index = Column(Integer)  # Chapter where the annotation is located
+    # Character range within the chapter, [start_offset, end_offset), copied from position_data
+    start_offset = Column(Integer)
+    end_offset = Column(Integer)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -35,3 +43,11 @@ class Annotation(db.Model):
     
     def __repr__(self):
         return f'<Annotation {self.id} - {self.type.name}>'
+
+
+# Overlap queries: a range scan on start_offset, bounded by the longest span,
+# which the expression index answers without visiting the rows
+Index('ix_annotations_chapter_start', Annotation.user_id, Annotation.book_id,
+      Annotation.chapter_index, Annotation.start_offset)
+Index('ix_annotations_chapter_span', Annotation.user_id, Annotation.book_id,
+      Annotation.chapter_index, Annotation.end_offset - Annotation.start_offset)
@@ -2,7 +2,7 @@
 Book model for storing EPUB metadata and file information
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, Index, func
 from sqlalchemy.orm import relationship
 
 from app.models.db import db
@@ -10,6 +10,13 @@ from app.models.db import db
 class Book(db.Model):
     """Book model representing EPUB files in the library"""
     __tablename__ = 'books'
+    __table_args__ = (
+        # Keyset pagination of a user's library by (created_at, id)
+        Index('ix_books_user_created', 'user_id', 'created_at', 'id'),
+        # Sorting by title and the language facet
+        Index('ix_books_user_title', 'user_id', 'title', 'id'),
+        Index('ix_books_user_language', 'user_id', 'language'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -20,10 +27,19 @@ class Book(db.Model):
     identifier = Column(String(255))  # ISBN or other unique identifier
     publication_date = Column(String(50))
     description = Column(Text)
+    subject = Column(String(255))
     file_path = Column(String(255), nullable=False)
     cover_path = Column(String(255))
     file_size = Column(Integer)  # in bytes
     total_pages = Column(Integer, default=0)
+    word_count = Column(Integer)
+    # JSON list of cumulative character offsets of the spine items (see utils/reading/progress.py)
+    chapter_weights = Column(Text)
+    text_indexed_at = Column(DateTime)  # when the full-text index last covered this book
+    # Name of the scoped stylesheet bundle ('' for books without styles, NULL until built)
+    stylesheet = Column(String(32))
+    images_indexed_at = Column(DateTime)  # when book_images last covered this book
+    pack_version = Column(Integer)  # version of the book's reader pack, NULL without one
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -32,5 +48,14 @@ class Book(db.Model):
     reading_state = relationship('ReadingState', back_populates='book', uselist=False)
     annotations = relationship('Annotation', back_populates='book')
     
+    @property
+    def author_sort_key(self):
+        """Author as the library sorts it (ix_books_user_author)"""
+        return self.author or ''
+    
     def __repr__(self):
         return f'<Book {self.title} by {self.author}>'
+
+
+# Sorting by author and the author facet; missing authors sort as ''
+Index('ix_books_user_author', Book.user_id, func.coalesce(Book.author, ''), Book.id)
@@ -0,0 +1,47 @@
+"""
+BookArtifact model: generator versions of the data derived from each book
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy.dialects.sqlite import insert
+
+from app.models.db import db
+
+class BookArtifact(db.Model):
+    """
+    Version stamp of one artifact derived from a book (see utils/content/artifacts.py).
+
+    An artifact whose stamp is missing or differs from the version its
+    generator reports now is stale, and is rebuilt on access or by the
+    background migration.
+    """
+    __tablename__ = 'book_artifacts'
+    __table_args__ = (
+        UniqueConstraint('book_id', 'name', name='uq_book_artifacts_book_name'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    name = Column(String(32), nullable=False)  # 'text', 'stylesheet', 'images', 'cover' or 'pack'
+    version = Column(String(32), nullable=False)
+    built_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<BookArtifact {self.book_id}:{self.name}@{self.version}>'
+
+
+def stamp_artifact(book_id: int, name: str, version: str) -> None:
+    """
+    Record the version an artifact was built with, in the current transaction.
+
+    Args:
+        book_id: Book ID
+        name: Artifact name
+        version: Generator version
+    """
+    statement = insert(BookArtifact).values(book_id=book_id, name=name, version=version, built_at=datetime.utcnow())
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['book_id', 'name'],
+        set_={'version': statement.excluded.version, 'built_at': statement.excluded.built_at}
+    ))
@@ -0,0 +1,31 @@
+"""
+BookImage model: intrinsic size and content hash of each image in a book
+"""
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, UniqueConstraint
+
+from app.models.db import db
+
+class BookImage(db.Model):
+    """
+    One raster image of a book's archive (see utils/content/images.py).
+
+    Indexed at ingest, so rendered chapters get dimensions and responsive
+    sources without opening any image, and resized variants can be looked up
+    by the image's content hash.
+    """
+    __tablename__ = 'book_images'
+    __table_args__ = (
+        UniqueConstraint('book_id', 'path', name='uq_book_images_book_path'),
+        # Variant requests name the image by its content hash
+        Index('ix_book_images_book_digest', 'book_id', 'digest'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    path = Column(String(512), nullable=False)  # archive member name
+    digest = Column(String(64), nullable=False)  # SHA-256 of the image bytes
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<BookImage {self.book_id}:{self.path}>'
@@ -0,0 +1,29 @@
+"""
+BookTextSegment model: the searchable text of books
+"""
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Index
+
+from app.models.db import db
+
+class BookTextSegment(db.Model):
+    """
+    Text of one element of a spine item.
+
+    Rows are the content table of the ``book_text_fts`` FTS5 index, which
+    triggers keep in step (see migrations). Keeping the text in an ordinary
+    table lets a book's rows be replaced through the book_id index instead
+    of scanning the FTS table.
+    """
+    __tablename__ = 'book_text_segments'
+    __table_args__ = (
+        Index('ix_book_text_segments_book', 'book_id', 'spine_index'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    spine_index = Column(Integer, nullable=False)
+    element_id = Column(String(32))  # data-epubar-id in the rendered chapter
+    text = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return f'<BookTextSegment {self.book_id}:{self.spine_index}:{self.element_id}>'
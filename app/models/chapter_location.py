@@ -0,0 +1,31 @@
+"""
+ChapterLocation model: character-offset index of each chapter
+"""
+from sqlalchemy import Column, Integer, LargeBinary, ForeignKey, UniqueConstraint
+
+from app.models.db import db
+
+class ChapterLocation(db.Model):
+    """
+    Packed element offsets of one spine item (see utils/epub/locations.py).
+
+    Built with the text index at ingest, so positions and annotations can be
+    converted between element IDs and character offsets without parsing the
+    chapter again.
+    """
+    __tablename__ = 'chapter_locations'
+    __table_args__ = (
+        UniqueConstraint('book_id', 'spine_index', name='uq_chapter_locations_book_spine'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    spine_index = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)  # characters of displayed text
+    starts = Column(LargeBinary, nullable=False)
+    ends = Column(LargeBinary, nullable=False)
+    parents = Column(LargeBinary, nullable=False)
+    blocks = Column(LargeBinary)  # block-level flags, NULL if indexed before they existed
+
+    def __repr__(self):
+        return f'<ChapterLocation {self.book_id}:{self.spine_index}>'
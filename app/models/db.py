@@ -1,9 +1,42 @@
 """
 Database configuration and initialization module
 """
+from typing import Dict, Any
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.orm import declarative_base
 
 # Initialize SQLAlchemy instance
 db = SQLAlchemy()
 Base = declarative_base()
+
+# SQLite storage profile applied to every new connection
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # readers no longer block the writer
+    'synchronous': 'NORMAL',  # durable at checkpoints; safe with WAL
+    'mmap_size': 256 * 1024 * 1024,  # memory-mapped reads of the database file
+    'cache_size': -64 * 1024,  # page cache in KiB (negative) rather than pages
+    'busy_timeout': 5000,  # milliseconds to wait for a lock before failing
+    'temp_store': 'MEMORY',
+}
+
+
+def apply_sqlite_profile(engine, pragmas: Dict[str, Any]) -> None:
+    """
+    Apply PRAGMA settings to every connection the engine opens.
+    
+    Args:
+        engine: SQLAlchemy engine
+        pragmas: Mapping of PRAGMA name to value
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
@@ -0,0 +1,441 @@
+"""
+Schema migrations for existing databases.
+
+``db.create_all()`` creates missing tables but never alters existing ones, so
+changes to tables that already hold data (new indexes, new columns) are
+applied here. Applied versions are recorded in the ``schema_migrations``
+table; every step is written to be safe to re-run on a fresh database where
+``create_all()`` already produced the final schema.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import inspect, text
+
+from app.utils.reading.progress import ChapterWeights, load_starts, progress_percent, spine_index_of
+
+
+def _composite_indexes(conn, settings: Dict[str, Any]) -> None:
+    """Add the composite indexes used by the hot queries."""
+    statements = [
+        'CREATE INDEX IF NOT EXISTS ix_books_user_created ON books (user_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_reading_states_user_book ON reading_states (user_id, book_id)',
+        'CREATE INDEX IF NOT EXISTS ix_reading_states_user_last_read ON reading_states (user_id, last_read_at)',
+        'CREATE INDEX IF NOT EXISTS ix_annotations_user_book_chapter ON annotations (user_id, book_id, chapter_index)',
+        'CREATE INDEX IF NOT EXISTS ix_annotations_book_chapter ON annotations (book_id, chapter_index)',
+    ]
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+def _annotation_offsets(conn, settings: Dict[str, Any]) -> None:
+    """Copy annotation character ranges out of position_data into indexed columns."""
+    add_column_if_missing(conn, 'annotations', 'start_offset', 'INTEGER')
+    add_column_if_missing(conn, 'annotations', 'end_offset', 'INTEGER')
+    
+    # Chapter-level offsets are start_offset/end_offset; start/end count as
+    # such only when they are not relative to an element
+    conn.execute(text("""
+        UPDATE annotations SET
+            start_offset = COALESCE(
+                json_extract(position_data, '$.start_offset'),
+                CASE WHEN json_extract(position_data, '$.element') IS NULL
+                     THEN json_extract(position_data, '$.start') END),
+            end_offset = COALESCE(
+                json_extract(position_data, '$.end_offset'),
+                CASE WHEN json_extract(position_data, '$.element') IS NULL
+                     THEN json_extract(position_data, '$.end') END)
+        WHERE start_offset IS NULL
+          AND json_valid(position_data)
+          AND json_type(position_data) = 'object'
+    """))
+    # Ranges that are not a pair of ordered integers stay unindexed
+    conn.execute(text("""
+        UPDATE annotations SET start_offset = NULL, end_offset = NULL
+        WHERE typeof(start_offset) != 'integer' OR typeof(end_offset) != 'integer'
+           OR start_offset < 0 OR end_offset < start_offset
+    """))
+    
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_annotations_chapter_start '
+                      'ON annotations (user_id, book_id, chapter_index, start_offset)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_annotations_chapter_span '
+                      'ON annotations (user_id, book_id, chapter_index, (end_offset - start_offset))'))
+
+
+# Tables whose changes are logged for delta sync, by entity name
+SYNCED_TABLES = {
+    'annotation': 'annotations',
+    'reading_state': 'reading_states',
+}
+
+
+def _sync_change_log(conn, settings: Dict[str, Any]) -> None:
+    """Create the delta-sync change log, its triggers, and log existing rows."""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS sync_changes (
+            seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            entity VARCHAR(20) NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op VARCHAR(10) NOT NULL,
+            changed_at DATETIME,
+            CONSTRAINT uq_sync_changes_entity UNIQUE (entity, entity_id)
+        )
+    """))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_sync_changes_user_seq ON sync_changes (user_id, seq)'))
+    
+    for entity, table in SYNCED_TABLES.items():
+        # INSERT OR REPLACE keeps one entry per row, renumbered on every change
+        for event, row, op in (('INSERT', 'NEW', 'upsert'), ('UPDATE', 'NEW', 'upsert'),
+                               ('DELETE', 'OLD', 'delete')):
+            conn.execute(text(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT OR REPLACE INTO sync_changes (user_id, entity, entity_id, op, changed_at)
+                    VALUES ({row}.user_id, '{entity}', {row}.id, '{op}', CURRENT_TIMESTAMP);
+                END
+            """))
+        
+        # Rows that predate the log are reported to a client's first sync
+        conn.execute(text(f"""
+            INSERT OR IGNORE INTO sync_changes (user_id, entity, entity_id, op, changed_at)
+            SELECT user_id, '{entity}', id, 'upsert', CURRENT_TIMESTAMP FROM {table} ORDER BY id
+        """))
+
+
+def _book_text_search(conn, settings: Dict[str, Any]) -> None:
+    """Create the full-text index over book contents."""
+    add_column_if_missing(conn, 'books', 'text_indexed_at', 'DATETIME')
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS book_text_segments (
+            id INTEGER NOT NULL PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books (id),
+            spine_index INTEGER NOT NULL,
+            element_id VARCHAR(32),
+            text TEXT NOT NULL
+        )
+    """))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_book_text_segments_book '
+                      'ON book_text_segments (book_id, spine_index)'))
+    
+    # External-content FTS5 index over the segments, kept in step by triggers
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS book_text_fts USING fts5(
+            text, content='book_text_segments', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_book_text_segments_insert AFTER INSERT ON book_text_segments
+        BEGIN
+            INSERT INTO book_text_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_book_text_segments_delete AFTER DELETE ON book_text_segments
+        BEGIN
+            INSERT INTO book_text_fts (book_text_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_book_text_segments_update AFTER UPDATE ON book_text_segments
+        BEGIN
+            INSERT INTO book_text_fts (book_text_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+            INSERT INTO book_text_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END
+    """))
+
+
+def _library_search(conn, settings: Dict[str, Any]) -> None:
+    """Add the subject column, library sort indexes and the metadata FTS index."""
+    add_column_if_missing(conn, 'books', 'subject', 'VARCHAR(255)')
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_books_user_title ON books (user_id, title, id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_books_user_language ON books (user_id, language)'))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_books_user_author ON books (user_id, coalesce(author, ''), id)"))
+    
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title, author, publisher, subject,
+            content='books', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_books_fts_insert AFTER INSERT ON books
+        BEGIN
+            INSERT INTO books_fts (rowid, title, author, publisher, subject)
+            VALUES (NEW.id, NEW.title, NEW.author, NEW.publisher, NEW.subject);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_books_fts_delete AFTER DELETE ON books
+        BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author, publisher, subject)
+            VALUES ('delete', OLD.id, OLD.title, OLD.author, OLD.publisher, OLD.subject);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_books_fts_update
+        AFTER UPDATE OF title, author, publisher, subject ON books
+        BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author, publisher, subject)
+            VALUES ('delete', OLD.id, OLD.title, OLD.author, OLD.publisher, OLD.subject);
+            INSERT INTO books_fts (rowid, title, author, publisher, subject)
+            VALUES (NEW.id, NEW.title, NEW.author, NEW.publisher, NEW.subject);
+        END
+    """))
+    # Index the books that already exist
+    conn.execute(text("INSERT INTO books_fts (books_fts) VALUES ('rebuild')"))
+
+
+def _annotation_search(conn, settings: Dict[str, Any]) -> None:
+    """Create the full-text index over annotation notes and highlighted text."""
+    # The index keeps its own copy of the (short) texts, so snippet() works;
+    # the highlighted text lives in position_data, which may not be JSON
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS annotations_fts USING fts5(
+            content, quote, tokenize='unicode61 remove_diacritics 2'
+        )
+    """))
+    quote = "CASE WHEN json_valid({row}.position_data) THEN json_extract({row}.position_data, '$.text') END"
+    conn.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_annotations_fts_insert AFTER INSERT ON annotations
+        BEGIN
+            INSERT INTO annotations_fts (rowid, content, quote)
+            VALUES (NEW.id, NEW.content, {quote.format(row='NEW')});
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS trg_annotations_fts_delete AFTER DELETE ON annotations
+        BEGIN
+            DELETE FROM annotations_fts WHERE rowid = OLD.id;
+        END
+    """))
+    conn.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_annotations_fts_update
+        AFTER UPDATE OF content, position_data ON annotations
+        BEGIN
+            UPDATE annotations_fts SET content = NEW.content, quote = {quote.format(row='NEW')}
+            WHERE rowid = NEW.id;
+        END
+    """))
+    # Index the annotations that already exist
+    conn.execute(text("DELETE FROM annotations_fts"))
+    conn.execute(text(f"""
+        INSERT INTO annotations_fts (rowid, content, quote)
+        SELECT id, content, {quote.format(row='annotations')} FROM annotations
+    """))
+
+
+def _chapter_weights(conn, settings: Dict[str, Any]) -> None:
+    """Weigh the chapters of indexed books and recompute stored progress."""
+    add_column_if_missing(conn, 'books', 'word_count', 'INTEGER')
+    add_column_if_missing(conn, 'books', 'chapter_weights', 'TEXT')
+    
+    # Segments already hold the whitespace-normalized text of indexed books;
+    # spine items without text after the last one with text weigh nothing
+    rows = conn.execute(text("""
+        SELECT book_id, spine_index, SUM(LENGTH(text)),
+               SUM(LENGTH(text) - LENGTH(REPLACE(text, ' ', '')) + 1)
+        FROM book_text_segments
+        GROUP BY book_id, spine_index
+        ORDER BY book_id, spine_index
+    """)).all()
+    books = {}
+    for book_id, spine_index, chars, words in rows:
+        books.setdefault(book_id, []).append((spine_index, chars, words))
+    for book_id, chapters in books.items():
+        weights = ChapterWeights(chapters[-1][0] + 1)
+        for spine_index, chars, words in chapters:
+            weights.chars[spine_index] = chars
+            weights.words += words
+        conn.execute(
+            text('UPDATE books SET chapter_weights = :chapter_weights, word_count = :word_count, '
+                 'total_pages = :total_pages WHERE id = :id'),
+            {'id': book_id, **weights.columns()}
+        )
+    
+    # Replace percentages written by the old "10 chapters per book" estimate
+    states = conn.execute(text("""
+        SELECT s.id, s.current_position, s.is_finished, b.chapter_weights
+        FROM reading_states s JOIN books b ON b.id = s.book_id
+    """)).all()
+    for state_id, position, is_finished, chapter_weights in states:
+        percent = progress_percent(load_starts(chapter_weights), spine_index_of(position),
+                                   is_finished=bool(is_finished))
+        conn.execute(text('UPDATE reading_states SET progress_percent = :percent WHERE id = :id'),
+                     {'id': state_id, 'percent': percent or 0.0})
+
+
+def _chapter_locations(conn, settings: Dict[str, Any]) -> None:
+    """Add the chapter offset of reading states and queue books for location indexing."""
+    add_column_if_missing(conn, 'reading_states', 'chapter_offset', 'INTEGER')
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS chapter_locations (
+            id INTEGER NOT NULL PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books (id),
+            spine_index INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            starts BLOB NOT NULL,
+            ends BLOB NOT NULL,
+            parents BLOB NOT NULL,
+            CONSTRAINT uq_chapter_locations_book_spine UNIQUE (book_id, spine_index)
+        )
+    """))
+    # The index is built with the text index; the backfill re-indexes these
+    conn.execute(text("""
+        UPDATE books SET text_indexed_at = NULL
+        WHERE text_indexed_at IS NOT NULL
+          AND id NOT IN (SELECT book_id FROM chapter_locations)
+    """))
+
+
+def _block_anchors(conn, settings: Dict[str, Any]) -> None:
+    """Add block-level flags to chapter indexes and queue books indexed without them."""
+    add_column_if_missing(conn, 'chapter_locations', 'blocks', 'BLOB')
+    # Until re-indexed, every element of these chapters counts as a block
+    conn.execute(text("""
+        UPDATE books SET text_indexed_at = NULL
+        WHERE text_indexed_at IS NOT NULL
+          AND id IN (SELECT book_id FROM chapter_locations WHERE blocks IS NULL)
+    """))
+
+
+def _collapsed_whitespace_offsets(conn, settings: Dict[str, Any]) -> None:
+    """Queue indexed books for re-indexing: offsets now count collapsed whitespace."""
+    # Re-indexing moves stored annotation and reading offsets to the new indexes
+    conn.execute(text("""
+        UPDATE books SET text_indexed_at = NULL
+        WHERE text_indexed_at IS NOT NULL
+          AND id IN (SELECT book_id FROM chapter_locations)
+    """))
+
+
+def _stylesheet_bundles(conn, settings: Dict[str, Any]) -> None:
+    """Add the stylesheet bundle name; existing books are bundled on their next read."""
+    add_column_if_missing(conn, 'books', 'stylesheet', 'VARCHAR(32)')
+
+
+def _book_images(conn, settings: Dict[str, Any]) -> None:
+    """Create the image index; existing books are indexed on their next read."""
+    add_column_if_missing(conn, 'books', 'images_indexed_at', 'DATETIME')
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS book_images (
+            id INTEGER NOT NULL PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books (id),
+            path VARCHAR(512) NOT NULL,
+            digest VARCHAR(64) NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            CONSTRAINT uq_book_images_book_path UNIQUE (book_id, path)
+        )
+    """))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_book_images_book_digest ON book_images (book_id, digest)'))
+
+
+def _reader_packs(conn, settings: Dict[str, Any]) -> None:
+    """Add the reader pack version; the background migration packs existing books."""
+    add_column_if_missing(conn, 'books', 'pack_version', 'INTEGER')
+
+
+def _book_artifacts(conn, settings: Dict[str, Any]) -> None:
+    """Create the artifact version stamps, crediting existing artifacts to the versions that built them."""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS book_artifacts (
+            id INTEGER NOT NULL PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books (id),
+            name VARCHAR(32) NOT NULL,
+            version VARCHAR(32) NOT NULL,
+            built_at DATETIME,
+            CONSTRAINT uq_book_artifacts_book_name UNIQUE (book_id, name)
+        )
+    """))
+    # Versions the code reported when this migration was written, spelled out
+    # because later upgrades change them: text_index_version() and the
+    # stylesheet version are '<generator>.<MetadataExtractor.VERSION>', images
+    # and covers '<generator>', and packs '<pack_version()>.<MetadataExtractor,
+    # styles and ImageVariants versions>.<anchor mode>' (see utils/content/artifacts.py).
+    # Packs carry the anchoring mode the application is configured with.
+    baseline = [
+        ('text', '1.1', 'text_indexed_at IS NOT NULL'),
+        ('stylesheet', '1.1', 'stylesheet IS NOT NULL'),
+        ('images', '1', 'images_indexed_at IS NOT NULL'),
+        ('cover', '1', "cover_path IS NOT NULL AND cover_path != ''"),
+        ('pack', f"10001.1.1.1.{settings['anchor_mode']}", 'pack_version = 10001'),
+    ]
+    for name, version, condition in baseline:
+        conn.execute(text(f"""
+            INSERT OR IGNORE INTO book_artifacts (book_id, name, version, built_at)
+            SELECT id, :name, :version, CURRENT_TIMESTAMP FROM books WHERE {condition}
+        """), {'name': name, 'version': version})
+
+
+# Ordered list of (version, description, step); steps are called with a
+# connection and the settings passed to upgrade()
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, 'Composite indexes for library, reading state and annotation lookups', _composite_indexes),
+    (2, 'Indexed character ranges for annotation overlap queries', _annotation_offsets),
+    (3, 'Change log with tombstones for delta sync', _sync_change_log),
+    (4, 'Full-text index over book contents', _book_text_search),
+    (5, 'Library sort indexes and metadata search', _library_search),
+    (6, 'Full-text index over annotation notes and highlighted text', _annotation_search),
+    (7, 'Chapter weights for reading progress', _chapter_weights),
+    (8, 'Character-offset index of chapters', _chapter_locations),
+    (9, 'Block-level flags of chapter index elements', _block_anchors),
+    (10, 'Chapter offsets counting whitespace as minified chapters display it', _collapsed_whitespace_offsets),
+    (11, 'Per-book stylesheet bundles', _stylesheet_bundles),
+    (12, 'Image index for responsive image variants', _book_images),
+    (13, 'Reader packs of rendered chapters', _reader_packs),
+    (14, 'Version stamps of derived book artifacts', _book_artifacts),
+]
+
+
+def add_column_if_missing(conn, table: str, column: str, ddl: str) -> bool:
+    """
+    Add a column to an existing table unless it is already there.
+    
+    Args:
+        conn: Database connection
+        table: Table name
+        column: Column name
+        ddl: Column definition (type and constraints)
+        
+    Returns:
+        True if the column was added
+    """
+    existing = {info['name'] for info in inspect(conn).get_columns(table)}
+    if column in existing:
+        return False
+    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    return True
+
+
+def upgrade(engine, settings: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Apply pending migrations.
+    
+    Args:
+        engine: SQLAlchemy engine of the application database
+        settings: Application settings migrations depend on: ``anchor_mode``,
+                  the READER_ANCHOR_MODE the application runs with
+                  (defaults to 'elements')
+        
+    Returns:
+        Schema version after the upgrade
+    """
+    settings = {'anchor_mode': 'elements', **(settings or {})}
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY)'))
+        current = conn.execute(text('SELECT MAX(version) FROM schema_migrations')).scalar() or 0
+    
+    for version, _, step in MIGRATIONS:
+        if version <= current:
+            continue
+        # Each migration commits on its own, so a failure keeps earlier ones
+        with engine.begin() as conn:
+            step(conn, settings)
+            conn.execute(text('INSERT INTO schema_migrations (version) VALUES (:version)'),
+                         {'version': version})
+        current = version
+    
+    return current
@@ -2,7 +2,7 @@
 ReadingState model for tracking user reading progress
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Boolean, Index
 from sqlalchemy.orm import relationship
 
 from app.models.db import db
@@ -10,11 +10,18 @@ from app.models.db import db
 class ReadingState(db.Model):
     """ReadingState model for tracking user reading progress and bookmarks"""
     __tablename__ = 'reading_states'
+    __table_args__ = (
+        # Per-book state lookups and the "continue reading" list
+        Index('ix_reading_states_user_book', 'user_id', 'book_id'),
+        Index('ix_reading_states_user_last_read', 'user_id', 'last_read_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
     current_position = Column(String(255))  # Can store chapter/page info in structured format
+    # Character offset of the position within its chapter (see utils/epub/locations.py)
+    chapter_offset = Column(Integer)
     progress_percent = Column(Float, default=0.0)
     is_finished = Column(Boolean, default=False)
     last_read_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,35 @@
+"""
+SyncChange model: the change log behind delta sync
+"""
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime, Index, UniqueConstraint
+
+from app.models.db import db
+
+class SyncChange(db.Model):
+    """
+    Latest change of each synced row (annotations and reading states).
+
+    Rows are written by SQLite triggers (see migrations), so bulk statements
+    and write-behind flushes are logged like ORM writes. Each change replaces
+    the previous entry of the same row and takes a new, strictly increasing
+    ``seq``; deletes are kept as ``op='delete'`` tombstones.
+    """
+    __tablename__ = 'sync_changes'
+    __table_args__ = (
+        UniqueConstraint('entity', 'entity_id', name='uq_sync_changes_entity'),
+        # "What changed for this user after seq N" is one range scan
+        Index('ix_sync_changes_user_seq', 'user_id', 'seq'),
+        # Never reuse a seq, even after the newest entry is replaced
+        {'sqlite_autoincrement': True},
+    )
+
+    seq = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    entity = Column(String(20), nullable=False)  # 'annotation' or 'reading_state'
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(10), nullable=False)  # 'upsert' or 'delete'
+    changed_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SyncChange {self.seq} {self.op} {self.entity} {self.entity_id}>'
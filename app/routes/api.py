@@ -3,54 +3,330 @@ API routes for EPUBAR application
 """
 import os
 import json
-from flask import Blueprint, jsonify, request, current_app, send_file
+from flask import Blueprint, jsonify, request, current_app, send_file, url_for, Response, stream_with_context
 from werkzeug.utils import safe_join
 from app.models.db import db
 from app.models.book import Book
 from app.models.annotation import Annotation
 from app.models.reading_state import ReadingState
+from app.utils.epub.content import ANCHOR_BLOCKS
 from app.utils.epub.processor import EPUBProcessor
 from app.utils.epub.metadata import MetadataExtractor
-from app.utils.epub.content import ContentProcessor
+from app.utils.epub.workspace import workspace_janitor
+from app.utils.concurrency.singleflight import singleflight
+from app.utils.concurrency.admission import admission
+from app.utils.content.artifacts import artifact_migrator
+from app.utils.content.images import image_variants
+from app.utils.content.packs import reader_assets, reader_packs
+from app.utils.content.stylesheets import stylesheet_bundler
+from app.utils.content.workers import parser_pool
+from app.utils.query.keyset import keyset_page
+from app.utils.reading.positions import position_buffer
+from app.utils.reading.sync import changes_since
+from app.utils.search.annotations import search_annotations
+from app.utils.search.fulltext import book_text_index
+from app.utils.search.library import facet_counts, library_filters, library_sort, parse_library_args
+from app.utils.reading.anchors import BookLocations
+from app.utils.reading.annotations import (
+    AnnotationError, apply_batch, chapter_annotations, compact_annotations,
+    overlapping_annotations, parse_annotation, serialize_annotation
+)
 
 # Create blueprint
 api_bp = Blueprint('api', __name__)
 
+# Fields /api/books can return, mapped to the columns holding them
+BOOK_FIELDS = {
+    'id': Book.id,
+    'title': Book.title,
+    'author': Book.author,
+    'publisher': Book.publisher,
+    'language': Book.language,
+    'subject': Book.subject,
+    'identifier': Book.identifier,
+    'publication_date': Book.publication_date,
+    'description': Book.description,
+    'cover_path': Book.cover_path,
+    'file_path': Book.file_path,
+    'file_size': Book.file_size,
+    'total_pages': Book.total_pages,
+    'word_count': Book.word_count,
+    'added_at': Book.created_at,
+    'updated_at': Book.updated_at,
+}
+
+DEFAULT_BOOK_FIELDS = ('id', 'title', 'author', 'cover_path', 'file_path', 'added_at')
+
+# Library query arguments carried over to the next page's URL
+BOOK_QUERY_ARGS = ('fields', 'q', 'language', 'author', 'finished', 'sort', 'order')
+
+
+def _book_projection(fields_param, sort_columns):
+    """
+    Build the column list for the requested book fields.
+
+    The sort columns are selected as well, under private labels, so the
+    cursor can be built from the last row of a page.
+
+    Returns:
+        Tuple of (field_names, columns, sort_keys)
+
+    Raises:
+        ValueError: If an unknown field is requested
+    """
+    if fields_param:
+        fields = [field.strip() for field in fields_param.split(',') if field.strip()]
+    else:
+        fields = list(DEFAULT_BOOK_FIELDS)
+    
+    unknown = [field for field in fields if field not in BOOK_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    
+    columns = [BOOK_FIELDS[field].label(field) for field in fields]
+    sort_keys = [f'_cursor_{i}' for i in range(len(sort_columns))]
+    columns += [column.label(key) for column, key in zip(sort_columns, sort_keys)]
+    return fields, columns, sort_keys
+
+
+def _book_row(row, fields):
+    """Serialize a projected book row"""
+    result = {}
+    for field in fields:
+        value = row._mapping[field]
+        result[field] = value.isoformat() if hasattr(value, 'isoformat') else value
+    return result
+
+
 @api_bp.route('/books', methods=['GET'])
 def get_books():
-    """Get all books for the current user"""
+    """
+    Get the current user's books, newest first unless sorted otherwise.
+    
+    Query parameters:
+        fields: Comma-separated fields to return (only those columns are selected)
+        q: Search in title, author, publisher and subject (the last word may be a prefix)
+        language, author: Only books with this language or author
+        finished: 'true' or 'false' to filter on the reading state
+        sort: 'added' (default), 'title' or 'author'
+        order: 'asc' or 'desc' (defaults depend on the sort)
+        limit: Page size (default API_PAGE_SIZE, at most API_MAX_PAGE_SIZE)
+        cursor: Cursor from the previous page's X-Next-Cursor header
+        format: 'ndjson' to stream every remaining book as newline-delimited JSON
+    
+    Pagination is opt-in: without limit or cursor, every book is returned in
+    one list, as before pagination existed.
+    """
     # In a real app, we would use authentication to get the user
     # For now, we're assuming user_id = 1
     user_id = 1
-    books = Book.query.filter_by(user_id=user_id).all()
     
-    result = []
-    for book in books:
-        result.append({
-            'id': book.id,
-            'title': book.title,
-            'author': book.author,
-            'cover_path': book.cover_path,
-            'file_path': book.file_path,
-            'added_at': book.created_at.isoformat()
-        })
+    try:
+        options = parse_library_args(request.args)
+        sort_columns, descending = library_sort(options)
+        fields, columns, sort_keys = _book_projection(request.args.get('fields'), sort_columns)
+        filters = library_filters(user_id, options)
+        limit = min(
+            request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int),
+            current_app.config['API_MAX_PAGE_SIZE']
+        )
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        
+        def page(cursor, size):
+            query = db.session.query(*columns).filter(*filters)
+            return keyset_page(query, sort_columns, cursor=cursor, limit=size,
+                               descending=descending, key_names=sort_keys)
+        
+        cursor = request.args.get('cursor')
+        if request.args.get('format') == 'ndjson' or \
+                request.accept_mimetypes.best == 'application/x-ndjson':
+            # Validate the cursor before the response starts streaming
+            rows, next_cursor = page(cursor, limit)
+            return Response(
+                stream_with_context(_stream_books(rows, next_cursor, fields, page, limit)),
+                mimetype='application/x-ndjson'
+            )
+        
+        rows, next_cursor = page(cursor, limit)
+        if 'limit' not in request.args and not cursor:
+            # Unpaginated listing: collect the rest in the largest allowed batches
+            while next_cursor:
+                more, next_cursor = page(next_cursor, current_app.config['API_MAX_PAGE_SIZE'])
+                rows += more
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    response = jsonify([_book_row(row, fields) for row in rows])
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        carried = {arg: request.args[arg] for arg in BOOK_QUERY_ARGS if request.args.get(arg)}
+        next_url = url_for('api.get_books', cursor=next_cursor, limit=limit, **carried)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+
+def _stream_books(rows, next_cursor, fields, page, batch_size):
+    """Yield NDJSON lines for every book, fetching one keyset batch at a time"""
+    while True:
+        for row in rows:
+            yield json.dumps(_book_row(row, fields), separators=(',', ':')) + '\n'
+        if not next_cursor:
+            break
+        rows, next_cursor = page(next_cursor, batch_size)
+
+
+@api_bp.route('/books/facets', methods=['GET'])
+def get_book_facets():
+    """
+    Count the current user's books per language, author and finished state.
+    
+    Accepts the search and filter parameters of /api/books. Each facet is
+    counted with every filter but its own, so the counts tell how many books
+    choosing another value would list.
+    """
+    # In a real app, we would use authentication to get the user
+    user_id = 1
+    
+    try:
+        options = parse_library_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(facet_counts(user_id, options))
+
+
+@api_bp.route('/search', methods=['GET'])
+def search_books():
+    """
+    Search the text of the current user's books.
+    
+    Query parameters:
+        q: Search text (every word must match; the last may be a prefix)
+        book_id: Optional book to search within
+        limit: Number of hits (default 20, at most API_PAGE_SIZE)
+        offset: Number of hits to skip
+    
+    Hits are ranked best first and carry an HTML snippet with <mark>ed
+    matches and a reader URL opening the passage.
+    """
+    # In a real app, we would use authentication to get the user
+    user_id = 1
+    
+    try:
+        limit = min(request.args.get('limit', 20, type=int), current_app.config['API_PAGE_SIZE'])
+        offset = request.args.get('offset', 0, type=int)
+        if limit < 1 or offset < 0:
+            raise ValueError("limit must be positive and offset non-negative")
+        hits = book_text_index.search(
+            user_id,
+            request.args.get('q', ''),
+            book_id=request.args.get('book_id', type=int),
+            limit=limit,
+            offset=offset
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    locations = {}
+    for hit in hits:
+        element_id = hit['element_id']
+        if current_app.config['READER_ANCHOR_MODE'] == ANCHOR_BLOCKS:
+            # Inline elements carry no ID; open the block holding the passage
+            book_locations = locations.setdefault(hit['book_id'], BookLocations(hit['book_id'], True))
+            chapter = book_locations.get(hit['spine_index'])
+            if chapter is not None:
+                element_id = book_locations.element_at(hit['spine_index'], chapter.offset_of(element_id))
+        hit['url'] = url_for('reader.read', book_id=hit['book_id'],
+                             chapter=hit['spine_index'], element=element_id)
+    
+    return jsonify({'hits': hits, 'limit': limit, 'offset': offset})
+
+
+@api_bp.route('/annotations/search', methods=['GET'])
+def search_user_annotations():
+    """
+    Search the current user's notes and highlighted text across all books.
+    
+    Query parameters:
+        q: Search text (every word must match; the last may be a prefix)
+        type: Optional annotation type (highlight, note or bookmark)
+        color: Optional highlight color
+        book_id: Optional book to search within
+        limit: Number of hits (default 20, at most API_PAGE_SIZE)
+        offset: Number of hits to skip
+    
+    Hits are ranked best first and carry an HTML snippet with <mark>ed
+    matches and a reader URL opening the annotation's chapter.
+    """
+    # In a real app, we would use authentication to get the user
+    user_id = 1
+    
+    try:
+        limit = min(request.args.get('limit', 20, type=int), current_app.config['API_PAGE_SIZE'])
+        offset = request.args.get('offset', 0, type=int)
+        if limit < 1 or offset < 0:
+            raise ValueError("limit must be positive and offset non-negative")
+        hits = search_annotations(
+            user_id,
+            request.args.get('q', ''),
+            annotation_type=request.args.get('type'),
+            color=request.args.get('color'),
+            book_id=request.args.get('book_id', type=int),
+            limit=limit,
+            offset=offset
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    for hit in hits:
+        hit['url'] = url_for('reader.read', book_id=hit['book_id'], chapter=hit['chapter_index'])
+    
+    return jsonify({'hits': hits, 'limit': limit, 'offset': offset})
+
+
+@api_bp.route('/sync', methods=['GET'])
+def sync():
+    """
+    Get the annotations and reading states changed since the last sync.
+    
+    Query parameters:
+        since: Cursor returned by the previous sync (omit for a full sync)
+        limit: Page size (default API_PAGE_SIZE, at most API_MAX_PAGE_SIZE)
+    
+    Each change is ``{"entity", "id", "op", "data"}`` with op ``upsert`` or
+    ``delete``. Clients repeat the call with the returned cursor while
+    ``has_more`` is true.
+    """
+    # In a real app, we would use authentication to get the user
+    user_id = 1
+    
+    try:
+        limit = min(
+            request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int),
+            current_app.config['API_MAX_PAGE_SIZE']
+        )
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        result = changes_since(user_id, request.args.get('since'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     return jsonify(result)
 
+
 @api_bp.route('/annotations', methods=['POST'])
 def create_annotation():
     """Create a new annotation"""
     data = request.json
+    book = db.get_or_404(Book, data.get('book_id') if isinstance(data, dict) else None)
     
-    annotation = Annotation(
-        user_id=data.get('user_id', 1),  # Default user_id for now
-        book_id=data['book_id'],
-        content=data.get('content', ''),
-        cfi_range=data['cfi_range'],
-        type=data.get('type', 'highlight'),
-        color=data.get('color', '#ffff00'),
-        text=data.get('text', '')
-    )
+    try:
+        values = parse_annotation(data, locations=BookLocations(book.id))
+    except AnnotationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    annotation = Annotation(user_id=book.user_id, book_id=book.id, **values)
     
     db.session.add(annotation)
     db.session.commit()
@@ -63,7 +339,7 @@ def create_annotation():
 @api_bp.route('/annotations/<int:annotation_id>', methods=['DELETE'])
 def delete_annotation(annotation_id):
     """Delete an annotation"""
-    annotation = db.session.get_or_404(Annotation, annotation_id)
+    annotation = db.get_or_404(Annotation, annotation_id)
     
     db.session.delete(annotation)
     db.session.commit()
@@ -71,14 +347,18 @@ def delete_annotation(annotation_id):
     return jsonify({'status': 'success'}), 200
 
 
-@api_bp.route('/books/<int:book_id>/spine', methods=['GET'])
-def get_book_spine(book_id):
-    """Get the spine (table of contents) for a book"""
-    book = db.session.get_or_404(Book, book_id)
-    
-    # Initialize the EPUB processor
-    processor = EPUBProcessor()
-    extracted_path = processor.extract(book.file_path)
+def _load_spine(processor, file_path):
+    """
+    Extract a book and read its spine.
+
+    Args:
+        processor: EPUB processor session owning the extraction workspace
+        file_path: Path to the EPUB file
+
+    Returns:
+        Tuple of (extracted_path, opf_dir, spine_items)
+    """
+    extracted_path = processor.extract(file_path)
     
     # Get the container.xml path
     container_path = os.path.join(extracted_path, 'META-INF/container.xml')
@@ -92,17 +372,69 @@ def get_book_spine(book_id):
     # Extract spine items
     spine_items = extractor.get_spine_items(opf_full_path)
     
+    return extracted_path, opf_dir, spine_items
+
+
+def _render_spine(file_path):
+    """Build the API representation of a book's spine"""
+    with EPUBProcessor() as processor:
+        extracted_path, _, spine_items = _load_spine(processor, file_path)
+    
     # Format spine items for the API response
     result = []
     for i, item in enumerate(spine_items):
         result.append({
             'id': item['id'],
             'index': i,
-            'href': item['href'],
+            # Relative to the archive root; the workspace is gone after this call
+            'href': os.path.relpath(item['href'], extracted_path),
             'media_type': item.get('media-type', 'application/xhtml+xml'),
             'title': item.get('title', f'Chapter {i+1}')
         })
     
+    return result
+
+
+def _render_content(book_id, file_path, item_id, anchor_mode, stylesheet_url=None, images=None):
+    """Render a spine item for the reader, or return None if it is not in the spine"""
+    with EPUBProcessor() as processor:
+        extracted_path, opf_dir, spine_items = _load_spine(processor, file_path)
+        
+        # Find the requested item
+        content_path = None
+        for item in spine_items:
+            if item['id'] == item_id:
+                content_path = os.path.join(extracted_path, item['href'])
+                break
+        
+        if not content_path:
+            return None
+        
+        # Process the content, isolated from pathological chapters
+        return parser_pool.process_content(
+            content_path,
+            opf_dir,
+            add_data_attributes=True,  # Add data attributes for annotation support
+            anchor_mode=anchor_mode,
+            book_id=book_id,
+            stylesheet_url=stylesheet_url,
+            # Image attributes are looked up by the path chapters resolve to
+            images={os.path.join(extracted_path, path): attributes for path, attributes in (images or {}).items()}
+        )
+
+
+@api_bp.route('/books/<int:book_id>/spine', methods=['GET'])
+@admission.limit('render')
+def get_book_spine(book_id):
+    """Get the spine (table of contents) for a book"""
+    book = db.get_or_404(Book, book_id)
+    
+    # Concurrent readers of the same book share one extraction
+    result = singleflight.do(
+        f'spine:{book.id}',
+        lambda: _render_spine(book.file_path)
+    )
+    
     return jsonify({
         'book_id': book_id,
         'spine': result
@@ -110,77 +442,194 @@ def get_book_spine(book_id):
 
 
 @api_bp.route('/books/<int:book_id>/content/<string:item_id>', methods=['GET'])
+@admission.limit('render')
 def get_book_content(book_id, item_id):
     """Get the content for a specific spine item"""
-    book = db.session.get_or_404(Book, book_id)
+    book = db.get_or_404(Book, book_id)
     
-    # Initialize the EPUB processor
-    processor = EPUBProcessor()
-    extracted_path = processor.extract(book.file_path)
+    anchor_mode = current_app.config['READER_ANCHOR_MODE']
     
-    # Get the container.xml path
-    container_path = os.path.join(extracted_path, 'META-INF/container.xml')
-    
-    # Initialize the metadata extractor
-    extractor = MetadataExtractor()
-    opf_path = extractor.get_opf_path(container_path)
-    opf_dir = os.path.dirname(os.path.join(extracted_path, opf_path))
-    opf_full_path = os.path.join(extracted_path, opf_path)
+    # Chapters of the book's pack are sent as slices of the mapped file
+    packed = reader_packs.chapter(book.id, item_id, anchor_mode, request.accept_encodings['gzip'] > 0)
+    if packed is not None:
+        data, encoding = packed
+        response = Response([data], mimetype='text/html', direct_passthrough=True)
+        response.content_length = len(data)
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.content_encoding = encoding
+        return response
     
-    # Extract spine items to find the requested one
-    spine_items = extractor.get_spine_items(opf_full_path)
+    # Render live, with the stylesheet and images rebuilt if they are stale,
+    # and have the background migration pack the book next
+    artifact_migrator.prioritize(book.id)
+    artifact_migrator.ensure(book, ('stylesheet', 'images'))
+    stylesheet_url, images = reader_assets(book)
     
-    # Find the requested item
-    content_path = None
-    for item in spine_items:
-        if item['id'] == item_id:
-            content_path = os.path.join(extracted_path, item['href'])
-            break
+    # Concurrent readers of the same chapter share one render
+    processed_html = singleflight.do(
+        f'content:{book.id}:{item_id}:{anchor_mode}',
+        lambda: _render_content(book.id, book.file_path, item_id, anchor_mode, stylesheet_url, images)
+    )
     
-    if not content_path:
+    if processed_html is None:
         return jsonify({'error': 'Item not found in book spine'}), 404
     
-    # Process the content
-    content_processor = ContentProcessor()
-    processed_html = content_processor.process_content(
-        content_path,
-        opf_dir,
-        add_data_attributes=True  # Add data attributes for annotation support
-    )
-    
     return processed_html
 
 
+@api_bp.route('/stylesheets/<name>', methods=['GET'])
+@admission.limit('media')
+def get_stylesheet(name):
+    """Get a book stylesheet bundle; bundles are named by content and never change"""
+    path = stylesheet_bundler.path(name)
+    if path is None:
+        return jsonify({'error': 'Stylesheet not found'}), 404
+    response = send_file(path, mimetype='text/css', max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
+
+
+@api_bp.route('/books/<int:book_id>/images/<name>', methods=['GET'])
+@admission.limit('media')
+def get_book_image(book_id, name):
+    """Get a size-capped variant of a book image, rendering it on first request"""
+    book = db.get_or_404(Book, book_id)
+    variant = image_variants.locate_variant(book.id, name)
+    if variant is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    # Variants are named by content; concurrent first requests share one render
+    file_path = book.file_path
+    try:
+        path = singleflight.do(
+            f'image:{name}',
+            lambda: image_variants.render_variant(file_path, variant['member'], variant['path'], variant['width'])
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    
+    response = send_file(path, mimetype=f'image/{image_variants.format}', max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
+
+
+@api_bp.route('/books/<int:book_id>/render-stats', methods=['GET'])
+def get_book_render_stats(book_id):
+    """
+    Get the output size and minification savings of a book's rendered chapters.
+
+    The figures are counted in memory by the process answering the request:
+    with several web workers each reports only the chapters it rendered (live
+    or into the book's pack), and a restart resets them. They describe the
+    renderer's output, not how often the book was read.
+    """
+    book = db.get_or_404(Book, book_id)
+    return jsonify(dict(parser_pool.output_stats(book.id), book_id=book.id))
+
+
+@api_bp.route('/books/<int:book_id>/annotations', methods=['GET'])
+def get_book_annotations(book_id):
+    """
+    Get a book's annotations for one chapter or a range of chapters.
+    
+    Query parameters:
+        chapter: Chapter index (shorthand for from=chapter&to=chapter)
+        from: First chapter index of the range (default 0)
+        to: Last chapter index of the range (default: the last chapter)
+        limit: Page size (default API_MAX_PAGE_SIZE)
+        cursor: Cursor from the previous page's next_cursor
+        start, end: With chapter, return only annotations overlapping the
+                    character range [start, end) (not paginated)
+    
+    Annotations are returned as arrays of values in the order given by
+    ``fields``. Listings of the whole book also return, on their first page,
+    the annotations saved without a chapter.
+    """
+    book = db.get_or_404(Book, book_id)
+    
+    try:
+        chapter = request.args.get('chapter', type=int)
+        start = request.args.get('start', type=int)
+        end = request.args.get('end', type=int)
+        if start is not None or end is not None:
+            if chapter is None or start is None or end is None or not 0 <= start <= end:
+                raise ValueError("Overlap queries need chapter and 0 <= start <= end")
+            rows = overlapping_annotations(book.user_id, book.id, chapter, start, end)
+            return jsonify(compact_annotations(rows, locations=BookLocations(book.id)))
+        
+        first = chapter if chapter is not None else request.args.get('from', 0, type=int)
+        last = chapter if chapter is not None else request.args.get('to', type=int)
+        limit = min(
+            request.args.get('limit', current_app.config['API_MAX_PAGE_SIZE'], type=int),
+            current_app.config['API_MAX_PAGE_SIZE']
+        )
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        
+        # Listings of the whole book include annotations saved without a chapter
+        rows, next_cursor = chapter_annotations(
+            book.user_id, book.id, first, last,
+            cursor=request.args.get('cursor'), limit=limit,
+            unplaced=chapter is None and first == 0 and last is None
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(compact_annotations(rows, next_cursor, BookLocations(book.id)))
+
+
 @api_bp.route('/books/<int:book_id>/annotations', methods=['POST'])
 def create_book_annotation(book_id):
     """Create a new annotation for a book"""
-    book = db.session.get_or_404(Book, book_id)
-    data = request.json
+    book = db.get_or_404(Book, book_id)
+    
+    try:
+        values = parse_annotation(request.json, locations=BookLocations(book.id))
+    except AnnotationError as e:
+        return jsonify({'error': str(e)}), 400
     
     # Create the annotation
     annotation = Annotation(
         user_id=book.user_id,  # Use the book's user ID
         book_id=book_id,
-        start_position=data['start_position'],
-        end_position=data['end_position'],
-        text=data.get('text', ''),
-        note=data.get('note', ''),
-        color=data.get('color', 'yellow')
+        **values
     )
     
     db.session.add(annotation)
     db.session.commit()
     
-    return jsonify({
-        'id': annotation.id,
-        'start_position': annotation.start_position,
-        'end_position': annotation.end_position,
-        'text': annotation.text,
-        'note': annotation.note,
-        'color': annotation.color,
-        'created_at': annotation.created_at.isoformat() if annotation.created_at else None
-    }), 201
+    return jsonify(serialize_annotation(annotation)), 201
+
 
+@api_bp.route('/books/<int:book_id>/annotations/batch', methods=['POST'])
+def batch_book_annotations(book_id):
+    """
+    Create, update and delete many annotations of a book in one transaction.
+    
+    The body is ``{"operations": [...]}``; the response lists one result per
+    operation in the same order.
+    """
+    book = db.get_or_404(Book, book_id)
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    
+    if not isinstance(operations, list):
+        return jsonify({'error': 'operations must be a list'}), 400
+    max_operations = current_app.config['ANNOTATION_BATCH_MAX']
+    if len(operations) > max_operations:
+        return jsonify({'error': f'A batch may hold at most {max_operations} operations'}), 413
+    
+    results = apply_batch(book.user_id, book.id, operations)
+    failed = sum(1 for result in results if result['status'] == 'error')
+    
+    return jsonify({
+        'results': results,
+        'applied': len(results) - failed,
+        'failed': failed
+    }), 200
 
 @api_bp.route('/books/<int:book_id>/annotations/<int:annotation_id>', methods=['DELETE'])
 def delete_book_annotation(book_id, annotation_id):
@@ -194,9 +643,17 @@ def delete_book_annotation(book_id, annotation_id):
 
 
 @api_bp.route('/books/<int:book_id>/cover', methods=['GET'])
+@admission.limit('media')
 def get_book_cover(book_id):
     """Get the cover image for a book"""
-    book = db.session.get_or_404(Book, book_id)
+    book = db.get_or_404(Book, book_id)
+    
+    # Extract the cover on first request, or again once it is stale;
+    # concurrent requests share the work
+    try:
+        artifact_migrator.ensure(book, ('cover',))
+    except (ValueError, OSError) as e:
+        current_app.logger.warning(f"Could not extract the cover of book {book.id}: {str(e)}")
     
     if not book.cover_path or not os.path.exists(book.cover_path):
         # Return a default cover
@@ -206,3 +663,25 @@ def get_book_cover(book_id):
         )
     
     return send_file(book.cover_path)
+
+
+@api_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get runtime counters for coalescing, admission, parsing, workspaces, positions, search, images, packs and artifacts"""
+    return jsonify({
+        'singleflight': dict(singleflight.stats),
+        'admission': admission.snapshot(),
+        'parser_pool': dict(parser_pool.stats),
+        'workspaces': dict(workspace_janitor.stats),
+        'positions': dict(position_buffer.stats),
+        'search': dict(book_text_index.stats),
+        'images': dict(image_variants.stats),
+        'packs': dict(reader_packs.stats),
+        'artifacts': dict(artifact_migrator.stats)
+    })
+
+
+@api_bp.route('/artifacts', methods=['GET'])
+def get_artifact_progress():
+    """Get the progress of rebuilding derived artifacts after an upgrade"""
+    return jsonify(artifact_migrator.progress())
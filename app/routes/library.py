@@ -4,13 +4,21 @@ Library routes for EPUBAR application
 import os
 import uuid
 from werkzeug.utils import secure_filename
-from flask import Blueprint, render_template, request, redirect, url_for, current_app, flash
+from flask import Blueprint, render_template, request, redirect, url_for, current_app, flash, abort
+from sqlalchemy.orm import joinedload, defer
 from app.models.db import db
 from app.models.book import Book
 from app.models.user import User
 from app.models.reading_state import ReadingState
+from app.utils.content.artifacts import artifact_migrator
 from app.utils.epub.processor import EPUBProcessor
 from app.utils.epub.metadata import MetadataExtractor
+from app.utils.reading.positions import position_buffer
+from app.utils.search.fulltext import book_text_index
+from app.utils.search.library import LIBRARY_SORTS, library_filters, library_sort,\
+    library_sort_keys, parse_library_args
+from app.utils.concurrency.admission import admission
+from app.utils.query.keyset import keyset_page
 
 # Create blueprint
 library_bp = Blueprint('library', __name__)
@@ -30,33 +38,39 @@ def index():
         db.session.add(user)
         db.session.commit()
     
-    # Get all books with reading state information
-    books = Book.query.filter_by(user_id=user.id).all()
+    try:
+        options = parse_library_args(request.args)
+        sort_columns, descending = library_sort(options)
+        
+        # One query loads the page of books with their reading states; the
+        # description is only needed on the details page
+        query = Book.query.filter(*library_filters(user.id, options))\
+            .options(joinedload(Book.reading_state), defer(Book.description))
+        
+        books, next_cursor = keyset_page(
+            query,
+            sort_columns,
+            cursor=request.args.get('cursor'),
+            limit=current_app.config['LIBRARY_PAGE_SIZE'],
+            descending=descending,
+            key_names=library_sort_keys(options)
+        )
+    except ValueError:
+        abort(400)
     
-    # Add reading state for each book
+    # Show positions that have not been flushed yet; progress is stored with them
     for book in books:
-        reading_state = ReadingState.query.filter_by(
-            user_id=user.id,
-            book_id=book.id
-        ).first()
-        
-        if reading_state:
-            book.reading_state = reading_state
-            # Calculate progress percentage
-            if reading_state.current_position:
-                state_parts = reading_state.current_position.split(':')
-                if len(state_parts) >= 2:
-                    current_spine = int(state_parts[0])
-                    # This is a simplified calculation
-                    reading_state.progress_percent = min(int(current_spine * 100 / 10), 100)  # Assuming 10 chapters on average
-                else:
-                    reading_state.progress_percent = 0
-            else:
-                reading_state.progress_percent = 0
+        position_buffer.overlay(book.reading_state)
+    
+    # Search and sort arguments are carried over to the next page
+    query_args = {arg: request.args[arg] for arg in ('q', 'language', 'author', 'finished', 'sort', 'order')
+                  if request.args.get(arg)}
     
-    return render_template('library/index.html', books=books, user=user)
+    return render_template('library/index.html', books=books, user=user, next_cursor=next_cursor,
+                           query_args=query_args, sorts=list(LIBRARY_SORTS))
 
 @library_bp.route('/upload', methods=['GET', 'POST'])
+@admission.limit('upload', methods=('POST',))
 def upload():
     """Handle EPUB file uploads"""
     if request.method == 'POST':
@@ -92,44 +106,62 @@ def upload():
         file.save(file_path)
         
         try:
-            # Process the EPUB file
-            processor = EPUBProcessor()
-            extracted_path = processor.extract(file_path)
-            
-            # Get metadata from the EPUB
-            container_path = os.path.join(extracted_path, 'META-INF/container.xml')
-            extractor = MetadataExtractor()
-            opf_path = extractor.get_opf_path(container_path)
-            opf_full_path = os.path.join(extracted_path, opf_path)
-            metadata = extractor.extract_from_opf(opf_full_path)
-            
-            # Create book record in database
-            book = Book(
-                user_id=user.id,
-                title=metadata.get('title', 'Unknown Title'),
-                author=metadata.get('creator', 'Unknown Author'),
-                file_path=file_path,
-                language=metadata.get('language', 'en'),
-                publisher=metadata.get('publisher', ''),
-                publication_date=metadata.get('date', ''),
-                description=metadata.get('description', ''),
-                isbn=metadata.get('identifier', ''),
-                cover_path=''  # We'll handle cover extraction separately in future
-            )
-            
-            db.session.add(book)
-            db.session.commit()
-            
-            # Create initial reading state
-            reading_state = ReadingState(
-                user_id=user.id,
-                book_id=book.id,
-                current_position="0:0",  # Start at the beginning
-                is_finished=False
-            )
-            
-            db.session.add(reading_state)
-            db.session.commit()
+            # Process the EPUB file; the workspace is removed once the book is indexed
+            with EPUBProcessor() as processor:
+                extracted_path = processor.extract(file_path)
+                
+                # Get metadata from the EPUB
+                container_path = os.path.join(extracted_path, 'META-INF/container.xml')
+                extractor = MetadataExtractor()
+                opf_path = extractor.get_opf_path(container_path)
+                opf_full_path = os.path.join(extracted_path, opf_path)
+                metadata = extractor.extract_from_opf(opf_full_path)
+                
+                # Create book record in database
+                book = Book(
+                    user_id=user.id,
+                    title=metadata.get('title', 'Unknown Title'),
+                    author=metadata.get('creator', 'Unknown Author'),
+                    file_path=file_path,
+                    language=metadata.get('language', 'en'),
+                    publisher=metadata.get('publisher', ''),
+                    publication_date=metadata.get('date', ''),
+                    description=metadata.get('description', ''),
+                    subject=metadata.get('subject'),
+                    identifier=metadata.get('identifier', ''),
+                    cover_path=''  # set below with the other derived artifacts
+                )
+                
+                db.session.add(book)
+                db.session.commit()
+                
+                # Create initial reading state
+                reading_state = ReadingState(
+                    user_id=user.id,
+                    book_id=book.id,
+                    current_position="0:0",  # Start at the beginning
+                    is_finished=False
+                )
+                
+                db.session.add(reading_state)
+                db.session.commit()
+                
+                # Index the text while the archive is extracted; a failure
+                # leaves the book to the background backfill
+                try:
+                    book_text_index.index_extracted(book.id, extracted_path)
+                except ValueError as e:
+                    db.session.rollback()
+                    current_app.logger.warning(f"Could not index book {book.id}: {str(e)}")
+                
+                # Bundle the book's CSS, index its images, copy its cover and
+                # pack its rendered chapters; what fails here is built on the
+                # first read or in the background
+                try:
+                    artifact_migrator.derive(book, extracted_path, ('stylesheet', 'images', 'cover', 'pack'))
+                except (ValueError, OSError) as e:
+                    db.session.rollback()
+                    current_app.logger.warning(f"Could not prepare the reader assets of book {book.id}: {str(e)}")
             
             flash(f'Book "{book.title}" uploaded successfully', 'success')
             
@@ -148,5 +180,5 @@ def upload():
 @library_bp.route('/book/<int:book_id>')
 def view_book(book_id):
     """View book details"""
-    book = db.session.get_or_404(Book, book_id)
+    book = db.get_or_404(Book, book_id)
     return render_template('library/book_details.html', book=book)
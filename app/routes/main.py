@@ -2,10 +2,13 @@
 Main routes for EPUBAR application
 """
 from flask import Blueprint, render_template, current_app, redirect, url_for
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from app.models.db import db
 from app.models.user import User
 from app.models.book import Book
 from app.models.reading_state import ReadingState
+from app.utils.reading.positions import position_buffer
 
 # Create blueprint
 main_bp = Blueprint('main', __name__)
@@ -17,23 +20,18 @@ def index():
     # For simplicity, we're using a default user_id for now
     user_id = 1
     
-    # Get books with recent reading activity
+    # Get books with recent reading activity, loading each book in the same query
     recent_states = ReadingState.query.filter_by(user_id=user_id)\
+        .options(joinedload(ReadingState.book).defer(Book.description))\
         .order_by(ReadingState.last_read_at.desc())\
         .limit(4).all()
         
     recent_books = []
     for state in recent_states:
-        book = db.session.get(Book, state.book_id)
+        book = state.book
         if book:
-            # Add reading progress
-            state_parts = state.current_position.split(':')
-            if len(state_parts) >= 2:
-                current_spine = int(state_parts[0])
-                # We'd need to get the total number of spine items for accurate progress
-                # This is a simplified calculation
-                book.reading_state = state
-                book.reading_state.progress_percent = min(int(current_spine * 100 / 10), 100)  # Assuming 10 chapters
+            # Attach the state we already have instead of lazy-loading it again
+            set_committed_value(book, 'reading_state', position_buffer.overlay(state))
             recent_books.append(book)
     
     return render_template('main/index.html', recent_books=recent_books)
@@ -1,11 +1,14 @@
 """
 Reader routes for EPUBAR application
 """
-from flask import Blueprint, render_template, request, session, jsonify
+from flask import Blueprint, render_template, request, session, jsonify, current_app
 from app.models.db import db
 from app.models.book import Book
 from app.models.reading_state import ReadingState
-from app.models.annotation import Annotation
+from app.utils.reading.positions import position_buffer
+from app.utils.reading.anchors import BookLocations
+from app.utils.reading.annotations import chapter_annotations, compact_annotations
+from app.utils.reading.progress import load_starts, progress_percent, spine_index_of
 
 # Create blueprint
 reader_bp = Blueprint('reader', __name__)
@@ -13,7 +16,7 @@ reader_bp = Blueprint('reader', __name__)
 @reader_bp.route('/<int:book_id>')
 def read(book_id):
     """Display the EPUB reader for a specific book"""
-    book = db.session.get_or_404(Book, book_id)
+    book = db.get_or_404(Book, book_id)
     
     # Get or create reading state
     reading_state = ReadingState.query.filter_by(
@@ -31,23 +34,97 @@ def read(book_id):
         db.session.add(reading_state)
         db.session.commit()
     
-    # Get annotations for this book
-    annotations = Annotation.query.filter_by(
-        user_id=book.user_id,
-        book_id=book.id
-    ).all()
+    # Show the newest position even if it has not been flushed yet
+    position_buffer.overlay(reading_state)
+    
+    # Ship only the current chapter's annotations (or those of the chapter a
+    # search hit links to); the reader fetches the others as chapters are opened
+    chapter = request.args.get('chapter', type=int)
+    if chapter is None:
+        try:
+            chapter = int((reading_state.current_position or '0').split(':')[0])
+        except ValueError:
+            chapter = 0
+    # Annotations saved without a chapter cannot be placed, so they come along
+    rows, next_cursor = chapter_annotations(
+        book.user_id, book.id, chapter, chapter,
+        limit=current_app.config['API_MAX_PAGE_SIZE'], unplaced=True
+    )
+    locations = BookLocations(book.id)
+    
+    # Resume at the element now holding the saved character offset
+    resume_element = locations.element_at(spine_index_of(reading_state.current_position),
+                                           reading_state.chapter_offset)
     
     return render_template('reader/index.html', 
                           book=book, 
                           reading_state=reading_state,
-                          annotations=annotations)
+                          resume_element=resume_element,
+                          annotation_chapter=chapter,
+                          annotations=compact_annotations(rows, next_cursor, locations))
 
 @reader_bp.route('/<int:book_id>/state', methods=['POST'])
 def update_state(book_id):
     """Update reading state for a book"""
-    book = db.session.get_or_404(Book, book_id)
+    book = db.get_or_404(Book, book_id)
     data = request.json
     
+    # The first visible element is anchored to its character offset, which
+    # survives changes to element numbering
+    spine_index = spine_index_of(data.get('position'))
+    chapter_offset = None
+    locations = BookLocations(book.id).get(spine_index) if data.get('element') else None
+    if locations is not None:
+        chapter_offset = locations.offset_of(data['element'])
+    
+    # Progress is computed once here from the book's chapter weights, so
+    # listing pages only read the stored percentage
+    percent = None
+    if 'position' in data or data.get('is_finished'):
+        if chapter_offset is not None and locations.length:
+            chapter_fraction = chapter_offset / locations.length
+        else:
+            try:
+                chapter_fraction = float(data.get('chapter_progress') or 0)
+            except (TypeError, ValueError):
+                chapter_fraction = 0.0
+        percent = progress_percent(
+            load_starts(book.chapter_weights),
+            spine_index,
+            chapter_fraction,
+            is_finished=bool(data.get('is_finished'))
+        )
+    
+    if position_buffer.enabled:
+        # Coalesce frequent position reports; they are written in batches
+        pending = position_buffer.record(
+            book.user_id,
+            book.id,
+            position=data.get('position'),
+            is_finished=data.get('is_finished'),
+            progress_percent=percent,
+            chapter_offset=chapter_offset
+        )
+        # Values not reported stay unset in the buffer, so the flush keeps
+        # the stored ones; the response fills them in from the (overlaid)
+        # database row, working on the copy record() returns
+        position, is_finished = pending.position, pending.is_finished
+        if position is None or is_finished is None:
+            reading_state = position_buffer.overlay(ReadingState.query.filter_by(
+                user_id=book.user_id,
+                book_id=book.id
+            ).first())
+            if position is None:
+                position = reading_state.current_position if reading_state else "0:0"
+            if is_finished is None:
+                is_finished = reading_state.is_finished if reading_state else False
+        
+        return jsonify({
+            'status': 'success',
+            'position': position,
+            'is_finished': is_finished
+        })
+    
     reading_state = ReadingState.query.filter_by(
         user_id=book.user_id,
         book_id=book.id
@@ -65,10 +142,14 @@ def update_state(book_id):
     # Update the reading state
     if 'position' in data:
         reading_state.current_position = data['position']
+        reading_state.chapter_offset = chapter_offset
     
     if 'is_finished' in data:
         reading_state.is_finished = data['is_finished']
     
+    if percent is not None:
+        reading_state.progress_percent = percent
+    
     # Update the last read timestamp
     reading_state.last_read_at = db.func.now()
     
@@ -19,6 +19,16 @@ document.addEventListener('DOMContentLoaded', function() {
     let currentSpineIndex = 0;
     let lastReadPosition = currentPosition || "0";
     
+    // Passage to open, e.g. from a search hit: ?chapter=3&element=el-12
+    const urlParams = new URLSearchParams(window.location.search);
+    let targetElement = urlParams.get('element');
+    
+    // Annotations per chapter index, filled as chapters are opened
+    const annotationsByChapter = new Map();
+    if (!initialAnnotations.next_cursor) {
+        annotationsByChapter.set(annotationChapter, expandAnnotations(initialAnnotations));
+    }
+    
     // Read saved preferences
     const savedTheme = localStorage.getItem('epubar-theme') || 'light';
     const savedFontSize = localStorage.getItem('epubar-font-size') || '100';
@@ -78,7 +88,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 spineItems = data.spine;
                 
                 // Determine starting position
-                if (lastReadPosition) {
+                if (urlParams.has('chapter')) {
+                    currentSpineIndex = Math.min(parseInt(urlParams.get('chapter')) || 0, spineItems.length - 1);
+                } else if (lastReadPosition) {
                     const [spineIndex, scrollPos] = lastReadPosition.split(':');
                     currentSpineIndex = parseInt(spineIndex) || 0;
                 }
@@ -114,12 +126,30 @@ document.addEventListener('DOMContentLoaded', function() {
                 applyTheme(localStorage.getItem('epubar-theme') || 'light');
                 applyFontSize(localStorage.getItem('epubar-font-size') || '100');
                 
-                // Apply annotations if any
-                renderAnnotations();
+                // Apply annotations if any, unless the reader moved on meanwhile
+                const chapterIndex = currentSpineIndex;
+                loadChapterAnnotations(chapterIndex)
+                    .then(chapterAnnotations => {
+                        if (chapterIndex === currentSpineIndex) {
+                            renderAnnotations(chapterAnnotations);
+                        }
+                    })
+                    .catch(error => {
+                        console.error('Error loading annotations:', error);
+                    });
                 
-                // Restore scroll position if returning to a chapter
+                // Open the requested passage once, otherwise restore the scroll position
+                const target = targetElement && bookContent.querySelector(`[data-epubar-id="${targetElement}"]`);
+                targetElement = null;
                 const [spineIndex, scrollPos] = lastReadPosition.split(':');
-                if (parseInt(spineIndex) === currentSpineIndex && scrollPos) {
+                const resumeTarget = resumeElement && parseInt(spineIndex) === currentSpineIndex &&
+                    bookContent.querySelector(`[data-epubar-id="${resumeElement}"]`);
+                if (target) {
+                    target.scrollIntoView({block: 'center'});
+                    target.classList.add('epubar-search-target');
+                } else if (resumeTarget) {
+                    resumeTarget.scrollIntoView({block: 'start'});
+                } else if (parseInt(spineIndex) === currentSpineIndex && scrollPos) {
                     bookContent.scrollTop = parseInt(scrollPos) || 0;
                 }
                 
@@ -213,6 +243,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 },
                 body: JSON.stringify({
                     position: readingPosition,
+                    // The server anchors the position to this element's character offset
+                    element: firstVisibleElement(),
+                    // Share of the chapter scrolled past; the server weighs it by chapter length
+                    chapter_progress: Math.min(1, scrollPos / Math.max(1, bookContent.scrollHeight - bookContent.clientHeight)),
                     is_finished: currentSpineIndex === spineItems.length - 1 && 
                                  scrollPos + bookContent.clientHeight >= bookContent.scrollHeight
                 })
@@ -222,6 +256,16 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    /**
+     * Return the data-epubar-id of the element at the top of the reader
+     */
+    function firstVisibleElement() {
+        const rect = bookContent.getBoundingClientRect();
+        const element = document.elementFromPoint(rect.left + rect.width / 2, rect.top + 1);
+        const anchor = element && element.closest('[data-epubar-id]');
+        return anchor && bookContent.contains(anchor) ? anchor.getAttribute('data-epubar-id') : null;
+    }
+    
     /**
      * Handle text selection for annotations
      */
@@ -308,16 +352,27 @@ document.addEventListener('DOMContentLoaded', function() {
             highlightSpan.setAttribute('data-note', noteText);
         }
         
+        // Character range within the chapter and within the anchor element
+        // (with block anchors, the enclosing block), measured before the DOM changes
+        const chapterStart = chapterOffset(range.startContainer, range.startOffset);
+        const chapterEnd = chapterOffset(range.endContainer, range.endOffset);
+        const startNode = range.startContainer.nodeType === Node.TEXT_NODE ?
+            range.startContainer.parentNode : range.startContainer;
+        const anchor = startNode.closest('[data-epubar-id]');
+        const anchorStart = anchor ? textOffset(anchor, range.startContainer, range.startOffset) : 0;
+        
         try {
             range.surroundContents(highlightSpan);
             
             // Save annotation on the server
             saveAnnotation(
-                range.startContainer.parentNode.getAttribute('data-epubar-id'),
-                range.startOffset,
-                range.endOffset,
+                anchor && anchor.getAttribute('data-epubar-id'),
+                anchorStart,
+                anchorStart + chapterEnd - chapterStart,
                 selection.toString(),
-                noteText
+                noteText,
+                chapterStart,
+                chapterEnd
             );
         } catch (e) {
             console.error('Error highlighting selection:', e);
@@ -325,22 +380,68 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    /**
+     * Count the characters of chapter text preceding a DOM position
+     */
+    function chapterOffset(container, offset) {
+        return textOffset(bookContent, container, offset);
+    }
+    
+    /**
+     * Count the characters of text within root preceding a DOM position
+     */
+    function textOffset(root, container, offset) {
+        const walker = document.createTreeWalker(root, NodeFilter.SHOW_TEXT);
+        let count = 0;
+        while (walker.nextNode()) {
+            const node = walker.currentNode;
+            if (node === container) return count + offset;
+            if (container.nodeType !== Node.TEXT_NODE &&
+                    container.childNodes[offset] &&
+                    (container.childNodes[offset] === node ||
+                     container.childNodes[offset].contains(node))) {
+                return count;
+            }
+            count += node.textContent.length;
+        }
+        return count;
+    }
+    
+    /**
+     * Find the text node and offset at a character offset within root
+     */
+    function textPosition(root, offset) {
+        const walker = document.createTreeWalker(root, NodeFilter.SHOW_TEXT);
+        let node = null;
+        while (walker.nextNode()) {
+            node = walker.currentNode;
+            if (offset <= node.textContent.length) return {node, offset};
+            offset -= node.textContent.length;
+        }
+        return node && {node, offset: node.textContent.length};
+    }
+    
     /**
      * Save annotation to server
      */
-    function saveAnnotation(elementId, startOffset, endOffset, text, note) {
-        const position = `${currentSpineIndex}:${elementId}:${startOffset}:${endOffset}`;
-        
+    function saveAnnotation(elementId, startOffset, endOffset, text, note, chapterStart, chapterEnd) {
         fetch(`/api/books/${bookId}/annotations`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({
-                start_position: position,
-                end_position: position,
-                text: text,
-                note: note,
+                type: note ? 'note' : 'highlight',
+                chapter_index: currentSpineIndex,
+                position_data: {
+                    element: elementId,
+                    start: startOffset,
+                    end: endOffset,
+                    start_offset: chapterStart,
+                    end_offset: chapterEnd,
+                    text: text
+                },
+                content: note,
                 color: 'yellow'  // Default color
             })
         })
@@ -349,7 +450,10 @@ document.addEventListener('DOMContentLoaded', function() {
             return response.json();
         })
         .then(data => {
-            console.log('Annotation saved:', data);
+            const chapterAnnotations = annotationsByChapter.get(data.chapter_index);
+            if (chapterAnnotations) {
+                chapterAnnotations.push(data);
+            }
         })
         .catch(error => {
             console.error('Error saving annotation:', error);
@@ -357,36 +461,75 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     /**
-     * Render existing annotations on the page
+     * Convert a compact annotation page into annotation objects
      */
-    function renderAnnotations() {
-        // Only render annotations for current chapter
-        const chapterAnnotations = annotations.filter(anno => {
-            const [spineIndex] = anno.start.split(':');
-            return parseInt(spineIndex) === currentSpineIndex;
+    function expandAnnotations(page) {
+        return page.annotations.map(row => {
+            const annotation = {};
+            page.fields.forEach((field, i) => { annotation[field] = row[i]; });
+            return annotation;
         });
+    }
+    
+    /**
+     * Load (once) the annotations of a chapter, following page cursors
+     */
+    function loadChapterAnnotations(chapterIndex) {
+        if (annotationsByChapter.has(chapterIndex)) {
+            return Promise.resolve(annotationsByChapter.get(chapterIndex));
+        }
+        
+        const collected = [];
+        const fetchPage = cursor => {
+            let url = `/api/books/${bookId}/annotations?chapter=${chapterIndex}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+            return fetch(url)
+                .then(response => {
+                    if (!response.ok) throw new Error('Failed to load annotations');
+                    return response.json();
+                })
+                .then(page => {
+                    collected.push(...expandAnnotations(page));
+                    return page.next_cursor ? fetchPage(page.next_cursor) : collected;
+                });
+        };
         
+        return fetchPage(null).then(chapterAnnotations => {
+            annotationsByChapter.set(chapterIndex, chapterAnnotations);
+            return chapterAnnotations;
+        });
+    }
+    
+    /**
+     * Render a chapter's annotations on the page
+     */
+    function renderAnnotations(chapterAnnotations) {
         chapterAnnotations.forEach(annotation => {
             // Parse position data
-            const [_, elementId, startOffset, endOffset] = annotation.start.split(':');
+            const elementId = annotation.position_data.element;
+            const startOffset = annotation.position_data.start;
+            const endOffset = annotation.position_data.end;
             
-            // Find the element by data-epubar-id
+            // Find the element by data-epubar-id; offsets count all of its text,
+            // so inline positions inside a block anchor resolve here too
             const element = document.querySelector(`[data-epubar-id="${elementId}"]`);
-            if (!element || !element.firstChild) return;
+            const start = element && textPosition(element, parseInt(startOffset));
+            const end = element && textPosition(element, parseInt(endOffset));
+            if (!start || !end) return;
             
             try {
                 // Create range
                 const range = document.createRange();
-                range.setStart(element.firstChild, parseInt(startOffset));
-                range.setEnd(element.firstChild, parseInt(endOffset));
+                range.setStart(start.node, start.offset);
+                range.setEnd(end.node, end.offset);
                 
                 // Create highlight span
                 const highlightSpan = document.createElement('span');
                 highlightSpan.className = 'epubar-highlight';
                 highlightSpan.setAttribute('data-annotation-id', annotation.id);
                 
-                if (annotation.text) {
-                    highlightSpan.setAttribute('data-note', annotation.text);
+                if (annotation.content) {
+                    highlightSpan.setAttribute('data-note', annotation.content);
                     
                     // Add tooltip functionality
                     highlightSpan.addEventListener('click', function(e) {
@@ -411,7 +554,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const tooltip = document.createElement('div');
         tooltip.className = 'annotation-tooltip';
         tooltip.innerHTML = `
-            <div class="mb-2">${annotation.text}</div>
+            <div class="mb-2">${annotation.content}</div>
             <div class="text-end">
                 <small class="text-muted">${new Date(annotation.created_at).toLocaleString()}</small>
                 <button class="btn btn-sm btn-danger delete-annotation-btn ms-2">Delete</button>
@@ -449,6 +592,13 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(response => {
             if (!response.ok) throw new Error('Failed to delete annotation');
             
+            annotationsByChapter.forEach((chapterAnnotations, chapterIndex) => {
+                annotationsByChapter.set(
+                    chapterIndex,
+                    chapterAnnotations.filter(annotation => annotation.id !== annotationId)
+                );
+            });
+            
             // Remove highlight from DOM
             const highlightSpan = document.querySelector(`[data-annotation-id="${annotationId}"]`);
             if (highlightSpan) {
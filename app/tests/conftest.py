@@ -2,6 +2,7 @@
 Test configuration for EPUBAR application
 """
 import os
+import shutil
 import tempfile
 import pytest
 from app import create_app
@@ -9,7 +10,7 @@ from app.models.db import db as _db
 from app.models.user import User
 
 @pytest.fixture
-def app():
+def app(tmp_path_factory):
     """Create and configure a Flask app for testing"""
     # Create a temporary file to isolate the database for each test
     db_fd, db_path = tempfile.mkstemp()
@@ -20,6 +21,14 @@ def app():
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
         'UPLOAD_FOLDER': tempfile.mkdtemp(),
         'WTF_CSRF_ENABLED': False,
+        # Write reading positions through so tests can read them back at once
+        'POSITION_FLUSH_INTERVAL': 0,
+        # Tests index books and build packs explicitly
+        'SEARCH_BACKFILL_INTERVAL': 0,
+        'ARTIFACT_REBUILD_INTERVAL': 0,
+        # Keep coalescing and fallback files out of the shared temp dir
+        'SINGLEFLIGHT_LOCK_DIR': str(tmp_path_factory.mktemp('locks')),
+        'PARSER_FALLBACK_DIR': str(tmp_path_factory.mktemp('fallbacks')),
     })
     
     # Create the database and the tables
@@ -38,8 +47,11 @@ def app():
     # Close and remove the temporary database
     os.close(db_fd)
     os.unlink(db_path)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
     # Remove temporary upload folder
-    os.rmdir(app.config['UPLOAD_FOLDER'])
+    shutil.rmtree(app.config['UPLOAD_FOLDER'], ignore_errors=True)
 
 @pytest.fixture
 def client(app):
@@ -0,0 +1,72 @@
+"""
+Tests for admission control on expensive endpoints
+"""
+import threading
+import pytest
+
+from app.models.book import Book
+from app.utils.concurrency.admission import AdmissionGate, admission
+
+
+def test_gate_rejects_when_queue_is_full():
+    """Test that a saturated gate with a full queue rejects immediately"""
+    gate = AdmissionGate('render', concurrency=1, queue=0)
+
+    assert gate.acquire(timeout=1)
+    assert not gate.acquire(timeout=1)
+
+    stats = gate.snapshot()
+    assert stats['active'] == 1
+    assert stats['rejected_queue_full'] == 1
+
+    gate.release()
+    assert gate.acquire(timeout=1)
+    gate.release()
+
+
+def test_gate_queues_then_times_out():
+    """Test that a queued request waits for a slot and gives up after the timeout"""
+    gate = AdmissionGate('render', concurrency=1, queue=1)
+    assert gate.acquire(timeout=1)
+
+    # A slot freed while waiting is handed to the queued request
+    releaser = threading.Timer(0.1, gate.release)
+    releaser.start()
+    assert gate.acquire(timeout=2)
+    releaser.join()
+
+    assert not gate.acquire(timeout=0.1)
+    assert gate.snapshot()['rejected_timeout'] == 1
+    assert gate.snapshot()['queue_depth'] == 0
+
+
+def test_busy_render_class_returns_503(client, app, test_user, sample_book, db):
+    """Test that a saturated render class turns requests away with Retry-After"""
+    with app.app_context():
+        book = Book(
+            user_id=test_user.id,
+            title="Test Book",
+            author="Test Author",
+            file_path=sample_book,
+            language="en"
+        )
+        db.session.add(book)
+        db.session.commit()
+
+        gate = admission.gates['render']
+        held = [gate.acquire(timeout=0) for _ in range(gate.concurrency)]
+        admission.queue_timeout = 0.05
+        try:
+            response = client.get(f"/api/books/{book.id}/spine")
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == str(admission.retry_after)
+
+            # Cheap endpoints are not gated by heavy renders
+            response = client.post(f"/reader/{book.id}/state", json={'position': '0:0'})
+            assert response.status_code == 200
+        finally:
+            for _ in held:
+                gate.release()
+
+        metrics = client.get("/api/metrics").get_json()
+        assert metrics['admission']['render']['rejected_timeout'] >= 1
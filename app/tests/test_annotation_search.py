@@ -0,0 +1,115 @@
+"""
+Tests for full-text search over annotations
+"""
+import pytest
+from sqlalchemy import text
+
+from app.models.book import Book
+from app.utils.search.annotations import _SEARCH_SQL
+
+
+@pytest.fixture
+def books(db, test_user):
+    """Create two books to annotate"""
+    books = [
+        Book(user_id=test_user.id, title='Moby Dick', author='Herman Melville', file_path='/uploads/moby.epub'),
+        Book(user_id=test_user.id, title='Walden', author='Henry David Thoreau', file_path='/uploads/walden.epub'),
+    ]
+    db.session.add_all(books)
+    db.session.commit()
+    return books
+
+
+def _annotate(client, book, operations):
+    """Create annotations through the batch API and return their IDs"""
+    response = client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': [
+        dict({'op': 'create', 'chapter_index': 0, 'position_data': {'text': ''}}, **operation)
+        for operation in operations
+    ]})
+    assert response.json['failed'] == 0
+    return [result['id'] for result in response.json['results']]
+
+
+def _search(client, query):
+    response = client.get(f'/api/annotations/search?{query}')
+    assert response.status_code == 200, response.json
+    return response.json['hits']
+
+
+def test_search_finds_notes_and_highlighted_text(client, books):
+    """Test that notes and highlighted passages are searchable across books"""
+    whale, = _annotate(client, books[0], [
+        {'chapter_index': 3, 'color': 'yellow', 'position_data': {'text': 'Call me Ishmael, the whale hunter'}},
+    ])
+    note, = _annotate(client, books[1], [
+        {'type': 'note', 'content': 'Compare with the whale chapter', 'position_data': {'text': 'I went to the woods'}},
+    ])
+
+    hits = _search(client, 'q=whale')
+    assert {hit['id'] for hit in hits} == {whale, note}
+    assert all('<mark>whale</mark>' in hit['snippet'] for hit in hits)
+
+    hits = _search(client, 'q=ishm')
+    assert [hit['id'] for hit in hits] == [whale]
+    assert hits[0]['book_title'] == 'Moby Dick'
+    assert hits[0]['url'] == f'/reader/{books[0].id}?chapter=3'
+
+    assert [hit['id'] for hit in _search(client, 'q=woods')] == [note]
+
+
+def test_search_filters_and_paginates(client, books):
+    """Test filtering by type, color and book and paging ranked hits"""
+    ids = _annotate(client, books[0], [
+        {'color': 'yellow', 'position_data': {'text': 'the sea the sea the sea'}},
+        {'color': 'blue', 'position_data': {'text': 'a quiet sea'}},
+        {'type': 'note', 'content': 'sea voyage'},
+    ])
+    other, = _annotate(client, books[1], [{'position_data': {'text': 'sea of pines'}}])
+
+    assert [hit['id'] for hit in _search(client, 'q=sea&color=blue')] == [ids[1]]
+    assert [hit['id'] for hit in _search(client, 'q=sea&type=note')] == [ids[2]]
+    assert [hit['id'] for hit in _search(client, f'q=sea&book_id={books[1].id}')] == [other]
+
+    ranked = _search(client, 'q=sea')
+    assert len(ranked) == 4
+    assert ranked[0]['id'] == ids[0]
+    assert [hit['score'] for hit in ranked] == sorted((hit['score'] for hit in ranked), reverse=True)
+
+    pages = _search(client, 'q=sea&limit=3') + _search(client, 'q=sea&limit=3&offset=3')
+    assert [hit['id'] for hit in pages] == [hit['id'] for hit in ranked]
+
+    assert client.get('/api/annotations/search?q=sea&type=comment').status_code == 400
+    assert client.get('/api/annotations/search?q=').status_code == 400
+
+
+def test_index_follows_updates_and_deletes(client, db, books):
+    """Test that the index changes in the same transaction as the annotation"""
+    first, second = _annotate(client, books[0], [
+        {'type': 'note', 'content': 'albatross omen'},
+        {'type': 'note', 'content': 'doubloon'},
+    ])
+
+    client.post(f'/api/books/{books[0].id}/annotations/batch', json={'operations': [
+        {'op': 'update', 'id': first, 'content': 'pequod crew'},
+        {'op': 'delete', 'id': second},
+    ]})
+    assert _search(client, 'q=albatross') == []
+    assert _search(client, 'q=doubloon') == []
+    assert [hit['id'] for hit in _search(client, 'q=pequod')] == [first]
+
+    client.delete(f'/api/books/{books[0].id}/annotations/{first}')
+    assert _search(client, 'q=pequod') == []
+    assert db.session.execute(text('SELECT COUNT(*) FROM annotations_fts')).scalar() == 0
+
+
+def test_search_is_driven_by_the_index(db, books):
+    """Test that matches come from the FTS index and annotations are looked up by ID"""
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + _SEARCH_SQL.format(filters=''),
+            {'query': 'whale', 'user_id': 1, 'limit': 20, 'offset': 0,
+             'match_start': '', 'match_end': '', 'snippet_tokens': 12}
+        )
+        plan = [str(row[-1]) for row in rows]
+    assert plan[0].startswith('SCAN annotations_fts VIRTUAL TABLE'), plan
+    assert plan[1].startswith('SEARCH a USING INTEGER PRIMARY KEY'), plan
@@ -0,0 +1,227 @@
+"""
+Tests for the annotation API
+"""
+import pytest
+from sqlalchemy import event, text
+
+from app.models.book import Book
+from app.models.annotation import Annotation, AnnotationType
+
+
+@pytest.fixture
+def book(db, test_user):
+    """Create a book to annotate"""
+    book = Book(
+        user_id=test_user.id,
+        title='Annotated Book',
+        author='Annotation Author',
+        file_path='/uploads/annotated.epub'
+    )
+    db.session.add(book)
+    db.session.commit()
+    return book
+
+
+def _highlight(chapter, start, end, **fields):
+    """Build a create operation for a highlight"""
+    return {
+        'op': 'create',
+        'type': 'highlight',
+        'chapter_index': chapter,
+        'position_data': {'element': f'p-{start}', 'start': start, 'end': end},
+        'color': 'yellow',
+        **fields
+    }
+
+
+def test_create_book_annotation(client, book):
+    """Test creating a single annotation"""
+    response = client.post(f'/api/books/{book.id}/annotations', json={
+        'type': 'note',
+        'chapter_index': 2,
+        'position_data': {'element': 'p-1', 'start': 0, 'end': 12},
+        'content': 'Remember this'
+    })
+    assert response.status_code == 201
+    assert response.json['type'] == 'note'
+    assert response.json['position_data'] == {'element': 'p-1', 'start': 0, 'end': 12}
+
+    response = client.post(f'/api/books/{book.id}/annotations', json={'type': 'scribble'})
+    assert response.status_code == 400
+
+
+def test_batch_applies_operations_in_one_transaction(client, app, db, book):
+    """Test that a large batch is written with a constant number of statements"""
+    operations = [_highlight(i % 10, i, i + 5) for i in range(500)]
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': operations})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    assert response.status_code == 200
+    assert response.json['applied'] == 500
+    assert [r['status'] for r in response.json['results']] == ['created'] * 500
+    assert len([s for s in statements if s.startswith('INSERT')]) <= 2
+    assert Annotation.query.filter_by(book_id=book.id).count() == 500
+
+
+def test_batch_reports_per_item_results(client, db, book):
+    """Test that invalid operations are reported while valid ones are applied"""
+    created = client.post(f'/api/books/{book.id}/annotations/batch', json={
+        'operations': [_highlight(0, 0, 5), _highlight(0, 10, 15)]
+    }).json['results']
+    first, second = created[0]['id'], created[1]['id']
+
+    response = client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': [
+        {'op': 'update', 'id': first, 'color': 'green', 'type': 'note', 'content': 'Updated'},
+        {'op': 'delete', 'id': second},
+        _highlight(1, 0, 3),
+        {'op': 'update', 'id': 999999, 'color': 'red'},
+        {'op': 'create', 'type': 'highlight'},
+        {'op': 'rename', 'id': first},
+        {'op': 'delete', 'id': first},
+    ]})
+
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [r['status'] for r in results] == [
+        'updated', 'deleted', 'created', 'error', 'error', 'error', 'error'
+    ]
+    assert response.json['applied'] == 3
+    assert 'not found' in results[3]['error']
+    assert 'position_data' in results[4]['error']
+
+    db.session.expire_all()
+    updated = db.session.get(Annotation, first)
+    assert updated.color == 'green'
+    assert updated.type == AnnotationType.NOTE
+    assert updated.content == 'Updated'
+    assert db.session.get(Annotation, second) is None
+
+
+def test_batch_rejects_malformed_requests(client, app, book):
+    """Test the batch endpoint's request validation"""
+    response = client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': 'all'})
+    assert response.status_code == 400
+
+    app.config['ANNOTATION_BATCH_MAX'] = 2
+    response = client.post(f'/api/books/{book.id}/annotations/batch', json={
+        'operations': [_highlight(0, i, i + 1) for i in range(3)]
+    })
+    assert response.status_code == 413
+
+    response = client.post('/api/books/999/annotations/batch', json={'operations': []})
+    assert response.status_code == 404
+
+
+def test_get_annotations_by_chapter(client, book):
+    """Test loading compact annotations for a chapter and a chapter range"""
+    client.post(f'/api/books/{book.id}/annotations/batch', json={
+        'operations': [_highlight(i % 4, i, i + 2) for i in range(12)]
+    })
+
+    response = client.get(f'/api/books/{book.id}/annotations?chapter=2')
+    assert response.status_code == 200
+    fields = response.json['fields']
+    rows = [dict(zip(fields, row)) for row in response.json['annotations']]
+    assert [row['chapter_index'] for row in rows] == [2, 2, 2]
+    assert rows[0]['position_data'] == {'element': 'p-2', 'start': 2, 'end': 4}
+    assert response.json['next_cursor'] is None
+
+    # A range is returned in chapter order, one keyset page at a time
+    seen = []
+    cursor = None
+    while True:
+        url = f'/api/books/{book.id}/annotations?from=1&to=3&limit=4'
+        if cursor:
+            url += f'&cursor={cursor}'
+        page = client.get(url).json
+        seen += [row[fields.index('chapter_index')] for row in page['annotations']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert seen == [1, 1, 1, 2, 2, 2, 3, 3, 3]
+
+    assert client.get(f'/api/books/{book.id}/annotations?cursor=bogus').status_code == 400
+
+
+def test_reader_embeds_only_current_chapter(client, db, test_user, book):
+    """Test that the reader page ships the current chapter's annotations only"""
+    client.post(f'/api/books/{book.id}/annotations/batch', json={
+        'operations': [_highlight(0, 0, 5, content='first chapter note'),
+                       _highlight(3, 0, 5, content='third chapter note')]
+    })
+    client.post(f'/reader/{book.id}/state', json={'position': '3:250'})
+
+    response = client.get(f'/reader/{book.id}')
+    assert response.status_code == 200
+    assert b'third chapter note' in response.data
+    assert b'first chapter note' not in response.data
+
+
+def test_annotations_without_chapter_are_still_loaded(client, db, test_user, book):
+    """Test that legacy annotations without a chapter reach the reader and whole-book listings"""
+    client.post(f'/api/books/{book.id}/annotations/batch', json={
+        'operations': [_highlight(None, 0, 5, content='unplaced note'), _highlight(2, 0, 5)]
+    })
+
+    response = client.get(f'/reader/{book.id}')
+    assert b'unplaced note' in response.data
+
+    page = client.get(f'/api/books/{book.id}/annotations').json
+    assert [row[page['fields'].index('chapter_index')] for row in page['annotations']] == [None, 2]
+    # Chapter pages hold only their chapter
+    chapter = client.get(f'/api/books/{book.id}/annotations?chapter=2').json
+    assert [row[chapter['fields'].index('chapter_index')] for row in chapter['annotations']] == [2]
+
+
+def test_overlap_query(client, db, book):
+    """Test finding annotations that overlap a character range"""
+    ranges = [(0, 10), (5, 15), (20, 30), (25, 25), (100, 400), (31, 40)]
+    client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': [
+        {'op': 'create', 'chapter_index': 1, 'position_data': {'start_offset': s, 'end_offset': e}}
+        for s, e in ranges
+    ] + [
+        {'op': 'create', 'chapter_index': 2, 'position_data': {'start_offset': 0, 'end_offset': 1000}}
+    ]})
+
+    def overlapping(start, end):
+        response = client.get(f'/api/books/{book.id}/annotations?chapter=1&start={start}&end={end}')
+        assert response.status_code == 200
+        fields = response.json['fields']
+        return [(row[fields.index('start_offset')], row[fields.index('end_offset')])
+                for row in response.json['annotations']]
+
+    assert overlapping(8, 22) == [(0, 10), (5, 15), (20, 30)]
+    assert overlapping(10, 20) == [(5, 15)]
+    assert overlapping(25, 31) == [(20, 30), (25, 25)]
+    # The long annotation is found although it starts far before the range
+    assert overlapping(390, 395) == [(100, 400)]
+    assert overlapping(400, 500) == []
+
+    assert client.get(f'/api/books/{book.id}/annotations?start=1&end=2').status_code == 400
+    response = client.post(f'/api/books/{book.id}/annotations', json={
+        'position_data': {'start_offset': 9, 'end_offset': 3}
+    })
+    assert response.status_code == 400
+
+
+def test_overlap_query_uses_indexes(app, db):
+    """Test that both overlap queries are answered from indexes"""
+    queries = [
+        'SELECT MAX(end_offset - start_offset) FROM annotations '
+        'WHERE user_id = 1 AND book_id = 1 AND chapter_index = 1',
+        'SELECT id FROM annotations WHERE user_id = 1 AND book_id = 1 AND chapter_index = 1 '
+        'AND start_offset >= 10 AND start_offset < 20 AND end_offset > 15',
+    ]
+    with db.engine.connect() as conn:
+        for query in queries:
+            plan = ' '.join(str(row[-1]) for row in conn.execute(text(f'EXPLAIN QUERY PLAN {query}')))
+            assert 'ix_annotations_chapter_' in plan, plan
@@ -0,0 +1,110 @@
+"""
+Tests for the JSON API endpoints
+"""
+import json
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import event
+
+from app.models.book import Book
+from app.utils.query.keyset import encode_cursor
+
+
+@pytest.fixture
+def catalog(db, test_user):
+    """Create a small catalog of books for the test user"""
+    added = datetime(2025, 1, 1)
+    books = []
+    for i in range(5):
+        book = Book(
+            user_id=test_user.id,
+            title=f'Catalog Book {i}',
+            author=f'Author {i}',
+            description='Long description',
+            file_path=f'/uploads/catalog_{i}.epub',
+            created_at=added + timedelta(days=i)
+        )
+        db.session.add(book)
+        books.append(book)
+    db.session.commit()
+    return books
+
+
+def test_get_books_default_fields(client, catalog):
+    """Test that the book listing keeps its default shape"""
+    response = client.get('/api/books')
+    
+    assert response.status_code == 200
+    books = response.get_json()
+    assert [book['title'] for book in books] == [f'Catalog Book {i}' for i in reversed(range(5))]
+    assert set(books[0]) == {'id', 'title', 'author', 'cover_path', 'file_path', 'added_at'}
+    assert 'X-Next-Cursor' not in response.headers
+
+
+def test_get_books_without_limit_returns_everything(app, client, catalog):
+    """Test that clients not asking for pages still get the whole library"""
+    app.config['API_PAGE_SIZE'] = 2
+    app.config['API_MAX_PAGE_SIZE'] = 2
+    response = client.get('/api/books')
+    
+    assert [book['title'] for book in response.get_json()] == [f'Catalog Book {i}' for i in reversed(range(5))]
+    assert 'X-Next-Cursor' not in response.headers
+    assert 'X-Next-Cursor' in client.get('/api/books?limit=2').headers
+
+
+def test_get_books_cursor_pagination(client, catalog):
+    """Test walking the book listing with X-Next-Cursor"""
+    titles = []
+    cursor = None
+    while True:
+        url = '/api/books?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        titles.extend(book['title'] for book in response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+        assert 'rel="next"' in response.headers['Link']
+    
+    assert titles == [f'Catalog Book {i}' for i in reversed(range(5))]
+
+
+def test_get_books_rejects_tampered_cursor(client, catalog):
+    """Test that well-formed cursors with values of the wrong type are a client error"""
+    for values in (['notadate', 5], [{'dt': '2024-01-01T00:00:00'}, 'five'], [True, 5], [{'dt': 5}, 1],
+                   [{'dt': 'yesterday'}, 1]):
+        response = client.get(f'/api/books?limit=2&cursor={encode_cursor(values)}')
+        assert response.status_code == 400
+        assert 'cursor' in response.get_json()['error']
+
+
+def test_get_books_field_projection(client, db, catalog):
+    """Test that fields= selects only the requested columns"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get('/api/books?fields=id,title')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    
+    assert response.status_code == 200
+    assert set(response.get_json()[0]) == {'id', 'title'}
+    assert 'description' not in statements[-1]
+    assert 'file_path' not in statements[-1]
+    
+    response = client.get('/api/books?fields=id,password')
+    assert response.status_code == 400
+
+
+def test_get_books_ndjson_stream(client, catalog):
+    """Test streaming the whole catalog as NDJSON in keyset batches"""
+    response = client.get('/api/books?format=ndjson&limit=2&fields=title')
+    
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode('utf-8').splitlines()
+    assert [json.loads(line)['title'] for line in lines] == [f'Catalog Book {i}' for i in reversed(range(5))]
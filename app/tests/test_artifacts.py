@@ -0,0 +1,101 @@
+"""
+Tests for the version stamps of derived artifacts and their migration
+"""
+import os
+from datetime import datetime
+
+from app.models.book import Book
+from app.models.book_artifact import BookArtifact
+from app.models.migrations import _book_artifacts
+from app.utils.content.artifacts import artifact_migrator
+from app.utils.content.packs import reader_packs
+from app.utils.epub.content import ContentProcessor
+from app.utils.epub import styles
+
+
+def test_stale_artifacts_are_rebuilt_on_access_and_in_background(app, client, db, test_user, sample_book,
+                                                                  monkeypatch):
+    """Test that a generator upgrade outdates stamps, and reads and the background job rebuild them"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+    url = f'/api/books/{book.id}/content/{spine[1]["id"]}'
+    client.get(url)
+
+    # The first read built what it needed; the rest is left to the background job
+    assert artifact_migrator.stale(book) == ['cover', 'pack']
+    with app.test_request_context():
+        assert artifact_migrator.rebuild() == 1
+    assert artifact_migrator.stale(book) == []
+    progress = client.get('/api/artifacts').json
+    assert (progress['stale_books'], progress['percent']) == (0, 100.0)
+    assert 'text' not in artifact_migrator.stale(book) and progress['artifacts']['text']['stale'] == 0
+
+    # New scoping rules outdate the bundle and the pack embedding its URL
+    monkeypatch.setattr(styles, 'VERSION', styles.VERSION + 1)
+    assert artifact_migrator.stale(book) == ['stylesheet', 'pack']
+    progress = client.get('/api/artifacts').json
+    assert progress['artifacts']['stylesheet'] == {'version': f'{styles.VERSION}.1', 'current': 0, 'stale': 1}
+    assert progress['stale_books'] == 1
+
+    # The pack keeps serving, as its renderer is current
+    lazy = artifact_migrator.stats['lazy_rebuilds']
+    hits = reader_packs.stats['hits']
+    assert client.get(url).status_code == 200
+    assert (reader_packs.stats['hits'], artifact_migrator.stats['lazy_rebuilds']) == (hits + 1, lazy)
+
+    # Once the renderer changes too, reading renders live with a rebuilt stylesheet
+    monkeypatch.setattr(ContentProcessor, 'VERSION', ContentProcessor.VERSION + 1)
+    assert client.get(url).status_code == 200
+    assert artifact_migrator.stats['lazy_rebuilds'] == lazy + 1
+    stamp = BookArtifact.query.filter_by(book_id=book.id, name='stylesheet').one()
+    assert stamp.version == f'{styles.VERSION}.1'
+    assert artifact_migrator.stale(book) == ['pack']
+    with app.test_request_context():
+        assert artifact_migrator.rebuild() == 1
+        assert artifact_migrator.rebuild() == 0
+    assert client.get('/api/artifacts').json['stale_books'] == 0
+
+
+def test_cover_is_extracted_again_when_gone(client, db, test_user, sample_book):
+    """Test that a stamped cover whose file was removed is extracted on the next request"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    assert client.get(f'/api/books/{book.id}/cover').status_code == 200
+    cover_path = db.session.get(Book, book.id).cover_path
+    os.remove(cover_path)
+
+    assert artifact_migrator.stale(book, ('cover',)) == ['cover']
+    assert client.get(f'/api/books/{book.id}/cover').status_code == 200
+    assert os.path.exists(cover_path)
+
+
+def test_migration_credits_existing_artifacts_to_their_versions(app, db, test_user):
+    """Test that artifacts built before stamps existed count as current, so an upgrade rebuilds nothing"""
+    book = Book(user_id=test_user.id, title='Existing', file_path='existing.epub', stylesheet='',
+                text_indexed_at=datetime.utcnow(), images_indexed_at=datetime.utcnow(),
+                cover_path=__file__, pack_version=10001)
+    db.session.add(book)
+    db.session.commit()
+    assert len(artifact_migrator.stale(book)) == 5
+
+    with db.engine.begin() as conn:
+        _book_artifacts(conn, {'anchor_mode': app.config['READER_ANCHOR_MODE']})
+    # Only the pack file is missing from disk
+    with app.app_context():
+        assert artifact_migrator.stale(db.session.get(Book, book.id)) == ['pack']
+
+
+def test_unreadable_book_gets_the_default_cover_once_tried(client, db, test_user):
+    """Test that a book whose archive is gone serves the default cover without retrying extraction"""
+    book = Book(user_id=test_user.id, title='Missing', file_path='/nonexistent/missing.epub')
+    db.session.add(book)
+    db.session.commit()
+    failures = artifact_migrator.stats['failures']
+
+    for _ in range(2):
+        response = client.get(f'/api/books/{book.id}/cover')
+        assert (response.status_code, response.mimetype) == (200, 'image/jpeg')
+    assert artifact_migrator.stats['failures'] == failures + 1
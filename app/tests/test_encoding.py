@@ -0,0 +1,72 @@
+"""
+Tests for encoding detection and the byte-oriented content API
+"""
+import codecs
+
+import pytest
+
+from app.models.book import Book
+from app.utils.epub.content import ContentProcessor
+from app.utils.epub.encoding import decode_markup, detect_encoding
+from app.utils.epub.locations import ChapterLocations
+
+CHAPTER = (
+    '<?xml version="1.0" encoding="{declared}"?>'
+    '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Été</title></head>'
+    '<body><p>Déjà vu, naïve café.</p></body></html>'
+)
+
+
+@pytest.mark.parametrize('head, expected', [
+    (b'<html><body>plain</body></html>', 'utf-8'),
+    (codecs.BOM_UTF8 + b'<html/>', 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE + '<html/>'.encode('utf-16-le'), 'utf-16'),
+    (codecs.BOM_UTF32_LE + '<html/>'.encode('utf-32-le'), 'utf-32'),
+    ('<html/>'.encode('utf-16-be'), 'utf-16-be'),
+    (b'<?xml version="1.0" encoding="ISO-8859-1"?><html/>', 'iso8859-1'),
+    (b'<html><head><meta charset="windows-1252"></head></html>', 'cp1252'),
+    (b'<html><head><meta http-equiv="Content-Type" content="text/html; charset=latin1"/></head></html>',
+     'iso8859-1'),
+    (b'<?xml version="1.0" encoding="no-such-codec"?><html/>', 'utf-8'),
+    # A UTF-16 declaration read from ASCII-compatible bytes cannot be right
+    (b'<?xml version="1.0" encoding="UTF-16"?><html/>', 'utf-8'),
+])
+def test_detect_encoding(head, expected):
+    """Test detection from byte order marks, NUL patterns and declarations"""
+    assert detect_encoding(head) == expected
+
+
+@pytest.mark.parametrize('declared, codec', [
+    ('UTF-8', 'utf-8'),
+    ('ISO-8859-1', 'latin-1'),
+    ('UTF-16', 'utf-16'),
+])
+def test_chapters_render_from_their_declared_encoding(tmp_path, declared, codec):
+    """Test that Latin-1 and UTF-16 chapters render to the same UTF-8 document"""
+    chapter = tmp_path / 'chapter.xhtml'
+    chapter.write_bytes(CHAPTER.format(declared=declared).encode(codec))
+    data = chapter.read_bytes()
+
+    rendered = ContentProcessor().process_bytes(data, str(chapter), str(tmp_path), add_data_attributes=True)
+    assert isinstance(rendered, bytes)
+    assert '<p class="epubar-paragraph" data-epubar-id="el-0">Déjà vu, naïve café.</p>'.encode('utf-8') in rendered
+    assert decode_markup(data).endswith('</html>')
+
+    locations = ChapterLocations()
+    texts = dict(ContentProcessor().iter_text(str(chapter), chunk_size=5, locations=locations))
+    assert texts['el-0'] == 'Déjà vu, naïve café.'
+    assert locations.ends[0] - locations.starts[0] == len('Déjà vu, naïve café.')
+
+
+def test_content_route_sends_utf8(client, db, test_user, sample_book):
+    """Test that rendered chapters are served as UTF-8 HTML"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+
+    response = client.get(f'/api/books/{book.id}/content/{spine[1]["id"]}')
+    assert response.status_code == 200
+    assert response.content_type == 'text/html; charset=utf-8'
+    assert response.data.startswith(b'<!DOCTYPE html>')
+    response.data.decode('utf-8')
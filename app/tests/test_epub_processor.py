@@ -10,7 +10,7 @@ from unittest.mock import patch, MagicMock
 from bs4 import BeautifulSoup
 
 # Import the modules we're going to test
-from app.utils.epub.processor import EPUBProcessor
+from app.utils.epub.processor import EPUBProcessor, DecompressionBudget, DecompressionLimitExceeded
 from app.utils.epub.metadata import MetadataExtractor
 from app.utils.epub.content import ContentProcessor
 
@@ -173,6 +173,20 @@ class TestMetadataExtractor:
         # Clean up
         processor.cleanup()
     
+    def test_cover_meta_with_quotes(self, tmp_path):
+        """Test that an EPUB 2 cover reference is matched literally, quotes included"""
+        opf_path = tmp_path / 'content.opf'
+        opf_path.write_text(
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Quoted</dc:title>'
+            '<meta name="cover" content="cover&quot;img"/></metadata>'
+            '<manifest><item id="cover&quot;img" href="images/cover.png" media-type="image/png"/></manifest>'
+            '</package>'
+        )
+        
+        metadata = MetadataExtractor().extract_from_opf(str(opf_path))
+        assert metadata['cover'] == str(tmp_path / 'images/cover.png')
+    
     def test_get_spine_items(self, sample_epub):
         """Test extracting spine items for navigation"""
         processor = EPUBProcessor()
@@ -265,3 +279,74 @@ class TestContentProcessor:
         
         # Clean up
         processor.cleanup()
+
+
+class TestDecompressionBudget:
+    """Test cases for zip-bomb protection during extraction"""
+    
+    def _write_epub(self, path, members):
+        """Write an EPUB-like archive with a mimetype entry followed by members"""
+        with zipfile.ZipFile(path, 'w') as epub:
+            epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            for name, data in members.items():
+                epub.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED)
+        return path
+    
+    def test_rejects_high_compression_ratio(self, tmp_path):
+        """Test that a highly compressed large entry is rejected before extraction"""
+        epub_path = self._write_epub(str(tmp_path / 'bomb.epub'), {
+            'META-INF/container.xml': '<container/>',
+            'OEBPS/zeros.xhtml': b'\0' * (4 * 1024 * 1024),
+        })
+        
+        processor = EPUBProcessor()
+        with pytest.raises(DecompressionLimitExceeded):
+            processor.extract(epub_path)
+        
+        # The partially created workspace is removed
+        assert processor.temp_dir is None
+        
+        is_valid, errors = processor.validate(epub_path)
+        assert not is_valid
+        assert 'compression ratio' in errors[0]
+    
+    def test_rejects_too_many_entries(self, tmp_path):
+        """Test that the entry-count budget is enforced"""
+        members = {f'OEBPS/file{i}.xhtml': '<p/>' for i in range(5)}
+        members['META-INF/container.xml'] = '<container/>'
+        epub_path = self._write_epub(str(tmp_path / 'many.epub'), members)
+        
+        processor = EPUBProcessor(budget=DecompressionBudget(max_entries=3))
+        with pytest.raises(DecompressionLimitExceeded):
+            processor.extract(epub_path)
+    
+    def test_rejects_total_uncompressed_size(self, tmp_path):
+        """Test that the total byte budget is enforced"""
+        epub_path = self._write_epub(str(tmp_path / 'large.epub'), {
+            'META-INF/container.xml': '<container/>',
+            'OEBPS/chapter1.xhtml': os.urandom(2048),
+        })
+        
+        processor = EPUBProcessor(budget=DecompressionBudget(max_total_bytes=1024))
+        with pytest.raises(DecompressionLimitExceeded):
+            processor.extract(epub_path)
+    
+    def test_rejects_path_traversal(self, tmp_path):
+        """Test that members cannot be written outside the workspace"""
+        epub_path = self._write_epub(str(tmp_path / 'slip.epub'), {
+            'META-INF/container.xml': '<container/>',
+            '../../escaped.txt': 'outside',
+        })
+        
+        processor = EPUBProcessor()
+        with pytest.raises(ValueError):
+            processor.extract(epub_path)
+        processor.cleanup()
+    
+    def test_extracts_within_budget(self, sample_epub):
+        """Test that a normal book extracts under a tight but sufficient budget"""
+        processor = EPUBProcessor(budget=DecompressionBudget(max_total_bytes=1024 * 1024, max_entries=10))
+        extracted_path = processor.extract(sample_epub)
+        
+        assert os.path.exists(os.path.join(extracted_path, 'OEBPS/chapter1.xhtml'))
+        processor.cleanup()
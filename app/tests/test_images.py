@@ -0,0 +1,71 @@
+"""
+Tests for the image index and responsive image variants
+"""
+import io
+import os
+
+from bs4 import BeautifulSoup
+from PIL import Image
+
+from app.models.book import Book
+from app.models.book_image import BookImage
+from app.utils.content.images import image_variants
+
+
+def _save(path, size, mode='RGB', **params):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new(mode, size).save(path, **params)
+
+
+def test_index_records_sizes_and_hashes(db, test_user, tmp_path):
+    """Test that raster images are indexed by archive path and animated or unreadable ones skipped"""
+    book = Book(user_id=test_user.id, title='Plates', file_path='plates.epub')
+    db.session.add(book)
+    db.session.commit()
+    _save(str(tmp_path / 'OEBPS/images/plate.png'), (2000, 1000))
+    _save(str(tmp_path / 'OEBPS/images/icon.png'), (300, 200), 'RGBA')
+    frames = [Image.new('RGB', (40, 40), color) for color in ('red', 'blue')]
+    frames[0].save(str(tmp_path / 'OEBPS/images/spinner.gif'), save_all=True, append_images=frames[1:])
+    (tmp_path / 'OEBPS/images/broken.jpg').write_bytes(b'not an image')
+
+    assert image_variants.index_extracted(book.id, str(tmp_path)) == 2
+    rows = {row.path: row for row in BookImage.query.filter_by(book_id=book.id)}
+    assert sorted(rows) == ['OEBPS/images/icon.png', 'OEBPS/images/plate.png']
+    assert (rows['OEBPS/images/plate.png'].width, rows['OEBPS/images/plate.png'].height) == (2000, 1000)
+    assert len(rows['OEBPS/images/plate.png'].digest) == 64
+    assert book.images_indexed_at is not None
+
+    assert image_variants.variant_widths(2000) == [480, 960, 1600]
+    assert image_variants.variant_widths(1000) == [480, 960, 1000]
+    assert image_variants.variant_widths(300) == [300]
+
+
+def test_chapters_get_dimensions_and_variants(client, db, test_user, sample_book):
+    """Test that chapter images carry their size and srcset, and variants render once"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+
+    html = client.get(f'/api/books/{book.id}/content/{spine[0]["id"]}').data
+    img = BeautifulSoup(html, 'html.parser').find('img')
+    assert (img['width'], img['height'], img['loading']) == ('1108', '1584', 'lazy')
+    sources = [candidate.split() for candidate in img['srcset'].split(', ')]
+    assert [width for _, width in sources] == ['480w', '960w', '1108w']
+    assert img['src'] == sources[-1][0]
+
+    rendered = image_variants.stats['variants_rendered']
+    url = sources[0][0]
+    for _ in range(2):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.mimetype == f'image/{image_variants.format}'
+        assert 'immutable' in response.headers['Cache-Control']
+        with Image.open(io.BytesIO(response.data)) as variant:
+            assert variant.size == (480, 686)
+    assert image_variants.stats['variants_rendered'] == rendered + 1
+    assert len(response.data) < os.path.getsize(sample_book)
+
+    # Only the widths offered for the image are rendered
+    assert client.get(url.replace('-480.', '-700.')).status_code == 404
+    assert client.get(f'/api/books/{book.id}/images/{"0" * 64}-480.{image_variants.format}').status_code == 404
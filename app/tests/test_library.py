@@ -0,0 +1,95 @@
+"""
+Tests for the library and home page views
+"""
+import re
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import event
+
+from app.models.book import Book
+from app.models.reading_state import ReadingState
+
+
+@pytest.fixture
+def library(db, test_user):
+    """Create books with reading states, each added a minute after the previous one"""
+    added = datetime(2025, 1, 1)
+    books = []
+    for i in range(7):
+        book = Book(
+            user_id=test_user.id,
+            title=f'Library Book {i}',
+            author='Library Author',
+            description='A long description ' * 100,
+            file_path=f'/uploads/library_{i}.epub',
+            created_at=added + timedelta(minutes=i)
+        )
+        db.session.add(book)
+        db.session.flush()
+        db.session.add(ReadingState(
+            user_id=test_user.id,
+            book_id=book.id,
+            current_position=f'{i}:0',
+            last_read_at=added + timedelta(minutes=i)
+        ))
+        books.append(book)
+    db.session.commit()
+    return books
+
+
+@pytest.fixture
+def count_queries(db):
+    """Count the SQL statements executed while the fixture is active"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_library_index_query_count(client, library, count_queries):
+    """Test that the library page does not issue one query per book"""
+    response = client.get('/library/')
+    
+    assert response.status_code == 200
+    body = response.data.decode('utf-8')
+    assert all(book.title in body for book in library)
+    # User lookup plus one joined query for the books and their states
+    assert len(count_queries) <= 3
+
+
+def test_library_keyset_pagination(client, app, library):
+    """Test walking the library page by page with cursors"""
+    app.config['LIBRARY_PAGE_SIZE'] = 3
+    seen = []
+    url = '/library/'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        body = response.data.decode('utf-8')
+        seen.extend(re.findall(r'book-title text-truncate">(Library Book \d)<', body))
+        match = re.search(r'href="(/library/\?cursor=[^"]+)"', body)
+        url = match.group(1) if match else None
+    
+    # Newest first, every book exactly once
+    assert seen == [f'Library Book {i}' for i in reversed(range(7))]
+
+
+def test_library_rejects_malformed_cursor(client, library):
+    """Test that a malformed cursor is a client error"""
+    response = client.get('/library/?cursor=not-a-cursor')
+    assert response.status_code == 400
+
+
+def test_home_recent_books_query_count(client, library, count_queries):
+    """Test that the home page loads recent books in a single query"""
+    response = client.get('/')
+    
+    assert response.status_code == 200
+    body = response.data.decode('utf-8')
+    assert 'Library Book 6' in body
+    assert 'Library Book 2' not in body
+    assert len(count_queries) == 1
@@ -0,0 +1,151 @@
+"""
+Tests for searching, sorting and faceting the library
+"""
+import time
+
+import pytest
+from sqlalchemy import insert, text
+
+from app.models.book import Book
+from app.models.reading_state import ReadingState
+
+
+@pytest.fixture
+def library(db, test_user):
+    """Create a small library with one finished book"""
+    books = [
+        Book(user_id=test_user.id, title='Dune', author='Frank Herbert', language='en',
+             publisher='Chilton', subject='Science fiction', file_path='/uploads/dune.epub'),
+        Book(user_id=test_user.id, title='Emma', author='Jane Austen', language='en',
+             publisher='John Murray', subject='Romance', file_path='/uploads/emma.epub'),
+        Book(user_id=test_user.id, title='Persuasion', author='Jane Austen', language='en',
+             publisher='John Murray', subject='Romance', file_path='/uploads/persuasion.epub'),
+        Book(user_id=test_user.id, title='Madame Bovary', author='Gustave Flaubert', language='fr',
+             publisher='Michel Lévy', subject='Realism', file_path='/uploads/bovary.epub'),
+        Book(user_id=test_user.id, title='Anonymous Tales', language='en',
+             file_path='/uploads/anonymous.epub'),
+    ]
+    db.session.add_all(books)
+    db.session.commit()
+    db.session.add(ReadingState(user_id=test_user.id, book_id=books[1].id, is_finished=True))
+    db.session.commit()
+    return books
+
+
+def _titles(response):
+    assert response.status_code == 200, response.json
+    return [book['title'] for book in response.json]
+
+
+def test_search_matches_metadata_prefixes(client, library):
+    """Test that search covers title, author, publisher and subject with a prefix last word"""
+    assert _titles(client.get('/api/books?q=austen&sort=title')) == ['Emma', 'Persuasion']
+    assert _titles(client.get('/api/books?q=jane aust&sort=title')) == ['Emma', 'Persuasion']
+    assert _titles(client.get('/api/books?q=chilt')) == ['Dune']
+    assert _titles(client.get('/api/books?q=science')) == ['Dune']
+    assert _titles(client.get('/api/books?q=nothing')) == []
+    assert client.get('/api/books?q=%22%22').status_code == 400
+
+
+def test_search_follows_metadata_changes(client, db, library):
+    """Test that the metadata index is kept up to date by triggers"""
+    library[0].title = 'Children of Dune'
+    db.session.commit()
+    assert _titles(client.get('/api/books?q=children')) == ['Children of Dune']
+
+    db.session.delete(library[0])
+    db.session.commit()
+    assert _titles(client.get('/api/books?q=herbert')) == []
+
+
+def test_sort_and_filters_paginate(client, library):
+    """Test sorting by author with filters and cursors that keep the query"""
+    response = client.get('/api/books?sort=author&limit=2&fields=title,author')
+    assert _titles(response) == ['Anonymous Tales', 'Dune']
+    assert 'sort=author' in response.headers['Link']
+
+    titles = []
+    cursor = None
+    while True:
+        url = '/api/books?sort=author&order=desc&limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        titles += _titles(response)
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert titles == ['Persuasion', 'Emma', 'Madame Bovary', 'Dune', 'Anonymous Tales']
+
+    assert _titles(client.get('/api/books?language=fr')) == ['Madame Bovary']
+    assert _titles(client.get('/api/books?author=Jane Austen&finished=true')) == ['Emma']
+    assert _titles(client.get('/api/books?author=Jane Austen&finished=false')) == ['Persuasion']
+    assert client.get('/api/books?sort=pages').status_code == 400
+    assert client.get('/api/books?finished=maybe').status_code == 400
+
+
+def test_facets_count_with_other_filters(client, library):
+    """Test that each facet is counted with every filter except its own"""
+    response = client.get('/api/books/facets')
+    assert response.status_code == 200
+    facets = response.json
+    assert facets['language'] == [{'value': 'en', 'count': 4}, {'value': 'fr', 'count': 1}]
+    assert facets['author'][0] == {'value': 'Jane Austen', 'count': 2}
+    assert {'value': '', 'count': 1} in facets['author']
+    assert facets['finished'] == {'finished': 1, 'unfinished': 4}
+
+    facets = client.get('/api/books/facets?language=fr&q=romance').json
+    assert facets['language'] == [{'value': 'en', 'count': 2}]
+    assert facets['author'] == []
+    assert facets['finished'] == {'finished': 0, 'unfinished': 0}
+
+
+def test_library_page_searches(client, library):
+    """Test that the library page accepts the search and sort options"""
+    response = client.get('/library/?q=bovary')
+    assert response.status_code == 200
+    assert b'Madame Bovary' in response.data
+    assert b'Persuasion' not in response.data
+    assert client.get('/library/?sort=author').status_code == 200
+    assert client.get('/library/?sort=pages').status_code == 400
+
+
+def test_library_queries_use_indexes(db, library):
+    """Test that sorting and facet counting are answered from indexes"""
+    with db.engine.connect() as conn:
+        def plan(sql):
+            return ' '.join(str(row[-1]) for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}'))
+
+        assert 'ix_books_user_title' in plan(
+            'SELECT id FROM books WHERE user_id = 1 ORDER BY title, id LIMIT 20')
+        assert 'ix_books_user_author' in plan(
+            "SELECT id FROM books WHERE user_id = 1 ORDER BY coalesce(author, ''), id LIMIT 20")
+        assert 'ix_books_user_language' in plan(
+            'SELECT language, count(id) FROM books WHERE user_id = 1 GROUP BY language')
+
+
+def test_facets_and_search_are_fast(client, db, test_user):
+    """Test facet counts and searches over a 50k book library"""
+    rows = [
+        {
+            'user_id': test_user.id,
+            'title': f'Book {i}',
+            'author': f'Author {i % 500}',
+            'language': ('en', 'fr', 'de', 'es')[i % 4],
+            'subject': ('Fiction', 'History', 'Poetry')[i % 3],
+            'file_path': f'/uploads/{i}.epub',
+        }
+        for i in range(50000)
+    ]
+    db.session.execute(insert(Book), rows)
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+    for url in ('/api/books/facets', '/api/books/facets?q=poetry', '/api/books/facets?q=author 12',
+                '/api/books?q=author 12&sort=title&limit=100', '/api/books?sort=author&language=fr&limit=100'):
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            response = client.get(url)
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200
+        # Well under 50 ms locally; the bound leaves room for slow machines
+        assert min(timings) < 0.25, f'{url} took {min(timings) * 1000:.1f} ms'
@@ -0,0 +1,210 @@
+"""
+Tests for the character-offset index of chapters
+"""
+import json
+import os
+
+import pytest
+from bs4 import BeautifulSoup
+from sqlalchemy import text
+
+from app.models.book import Book
+from app.models.reading_state import ReadingState
+from app.utils.epub.anchor_benchmark import compare_anchor_modes, write_span_heavy_epub
+from app.utils.epub.content import ANCHOR_BLOCKS, ANNOTATABLE_TAGS, ContentProcessor
+from app.utils.epub.locations import ChapterLocations
+from app.utils.epub.processor import EPUBProcessor
+from app.utils.epub.metadata import MetadataExtractor
+from app.utils.reading.anchors import BookLocations, block_position
+from app.utils.search.fulltext import book_text_index
+
+
+def _locations(tmp_path, html):
+    chapter = tmp_path / 'chapter.xhtml'
+    chapter.write_text(html)
+    locations = ChapterLocations()
+    list(ContentProcessor().iter_text(str(chapter), chunk_size=7, locations=locations))
+    return locations
+
+
+@pytest.fixture
+def indexed_book(db, test_user, sample_book):
+    """Create a book from the sample EPUB with its text and locations indexed"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    book_text_index.index_book(book)
+    return book
+
+
+def test_locations_map_elements_and_offsets(tmp_path):
+    """Test conversions between element IDs and character offsets"""
+    locations = _locations(tmp_path, (
+        '<html><head><title>Skip</title></head><body>'
+        '<h1>Title</h1>'                          # el-0: [0, 5)
+        '<div>Intro <p>First</p><span/>'         # el-1: [5, 21), el-2: [11, 16), el-3 empty
+        '<p>Second</p> tail</div>'               # el-4: [16, 22)... tail stays in el-1
+        '<script>var x = "not text";</script>'
+        '</body></html>'
+    ))
+    assert list(locations.starts) == [0, 5, 11, 16, 16]
+    assert list(locations.ends) == [5, 27, 16, 16, 22]
+    assert list(locations.parents) == [-1, -1, 1, 1, 1]
+    assert locations.length == 27
+
+    assert locations.offset_of('el-2') == 11
+    assert locations.offset_of('el-4', 3) == 19
+    assert locations.offset_of('el-9') is None
+    assert locations.offset_of('bogus') is None
+
+    assert locations.element_at(0) == ('el-0', 0)
+    assert locations.element_at(12) == ('el-2', 1)
+    assert locations.element_at(16) == ('el-4', 0)
+    # After the last paragraph the enclosing div holds the text
+    assert locations.element_at(24) == ('el-1', 19)
+
+    restored = ChapterLocations.unpack(*locations.pack(), length=locations.length)
+    assert list(restored.ends) == list(locations.ends)
+    assert restored.element_at(12) == ('el-2', 1)
+
+
+def test_offsets_match_rendered_elements(sample_book):
+    """Test that indexed ranges hold exactly the text of the rendered elements"""
+    extractor = MetadataExtractor()
+    with EPUBProcessor() as processor:
+        extracted = processor.extract(sample_book)
+        opf_path = extractor.get_opf_path(os.path.join(extracted, 'META-INF/container.xml'))
+        chapter_path = extractor.get_spine_items(os.path.join(extracted, opf_path))[1]['href']
+
+        locations = ChapterLocations()
+        list(ContentProcessor().iter_text(chapter_path, chunk_size=1000, locations=locations))
+        rendered = ContentProcessor().process_content(chapter_path, extracted, add_data_attributes=True)
+
+    content = BeautifulSoup(rendered, 'html.parser').find(class_='epubar-chapter-content')
+    chapter_text = content.get_text()
+    starts = {}
+    offset = 0
+    for node in content.descendants:
+        if isinstance(node, str):
+            offset += len(node)
+        elif node.get('data-epubar-id'):
+            starts[node['data-epubar-id']] = offset
+    elements = content.find_all(ANNOTATABLE_TAGS)
+    assert len(elements) == len(locations) > 50
+
+    # Offsets count from the start of the document, the rendered text from the body
+    shift = locations.starts[0] - starts['el-0']
+    for number, element in enumerate(elements):
+        start = locations.starts[number] - shift
+        assert starts[f'el-{number}'] == start
+        assert chapter_text[start:locations.ends[number] - shift] == element.get_text()
+
+
+def test_annotations_are_anchored_to_offsets(client, db, indexed_book):
+    """Test that highlights are stored as offsets and served at the current element"""
+    locations = BookLocations(indexed_book.id).get(1)
+    response = client.post(f'/api/books/{indexed_book.id}/annotations', json={
+        'chapter_index': 1,
+        'position_data': {'element': 'el-5', 'start': 4, 'end': 10, 'start_offset': 999, 'end_offset': 1005}
+    })
+    assert response.status_code == 201
+    annotation = response.json
+    assert annotation['start_offset'] == locations.offset_of('el-5', 4)
+    assert annotation['end_offset'] == annotation['start_offset'] + 6
+
+    # Element IDs from an older renderer are replaced using the stored offsets
+    db.session.execute(text("UPDATE annotations SET position_data = json_set(position_data, '$.element', 'el-77')"))
+    db.session.commit()
+    served = client.get(f'/api/books/{indexed_book.id}/annotations?chapter=1').json
+    position_data = served['annotations'][0][served['fields'].index('position_data')]
+    assert (position_data['element'], position_data['start'], position_data['end']) == ('el-5', 4, 10)
+
+
+def test_reading_position_resolves_through_index(client, db, indexed_book):
+    """Test that the first visible element is stored as an offset and resumed from it"""
+    locations = BookLocations(indexed_book.id).get(1)
+    client.post(f'/reader/{indexed_book.id}/state', json={'position': '1:800', 'element': 'el-12'})
+
+    state = ReadingState.query.filter_by(book_id=indexed_book.id).one()
+    assert state.chapter_offset == locations.offset_of('el-12')
+    starts = json.loads(indexed_book.chapter_weights)
+    fraction = state.chapter_offset / locations.length
+    expected = round((starts[1] + (starts[2] - starts[1]) * fraction) * 100 / starts[-1], 1)
+    assert state.progress_percent == expected
+
+    page = client.get(f'/reader/{indexed_book.id}').data
+    assert b'const resumeElement = "el-12";' in page
+
+
+def test_block_anchors_resolve_inline_positions(tmp_path):
+    """Test that positions inside inline elements convert to their enclosing block"""
+    locations = _locations(tmp_path, (
+        '<html><body>'
+        '<p>One <span>two</span> three</p>'      # el-0: [0, 13), el-1: [4, 7)
+        '<span>loose</span>'                     # el-2: [13, 18), in no block
+        '<li>four <span>five</span></li>'        # el-3: [18, 27), el-4: [23, 27)
+        '</body></html>'
+    ))
+    assert list(locations.blocks) == [1, 0, 0, 1, 0]
+    assert locations.element_at(5) == ('el-1', 1)
+    assert locations.element_at(5, blocks_only=True) == ('el-0', 5)
+    assert locations.element_at(15, blocks_only=True) == ('el-0', 15)
+    assert locations.element_at(24, blocks_only=True) == ('el-3', 6)
+
+    position = {'element': 'el-4', 'start': 1, 'end': 3, 'text': 'iv'}
+    assert block_position(position, locations) == {'element': 'el-3', 'start': 6, 'end': 8, 'text': 'iv'}
+    assert block_position({'element': 'el-9', 'start': 0, 'end': 1}, locations)['element'] == 'el-9'
+
+    # Indexes built before block flags existed treat every element as a block
+    restored = ChapterLocations.unpack(*locations.pack(), length=locations.length)
+    assert restored.element_at(5, blocks_only=True) == ('el-1', 1)
+
+
+def test_block_mode_shrinks_span_heavy_chapters(tmp_path):
+    """Test that block anchors keep block IDs and drop those of inline elements"""
+    spans = ''.join(f'<span class="c{i}">word {i} </span>' for i in range(20))
+    chapter = tmp_path / 'chapter.xhtml'
+    chapter.write_text('<html><body>' + f'<h1>Title</h1><p>{spans}</p>' * 50 + '</body></html>')
+
+    processor = ContentProcessor()
+    elements = processor.process_content(str(chapter), str(tmp_path), True)
+    blocks = processor.process_content(str(chapter), str(tmp_path), True, ANCHOR_BLOCKS)
+    block_soup = BeautifulSoup(blocks, 'html.parser')
+
+    assert not block_soup.find('span', attrs={'data-epubar-id': True})
+    assert [p['data-epubar-id'] for p in block_soup.find_all('p')][:2] == ['el-1', 'el-23']
+    assert elements.count('data-epubar-id') == 1100
+    assert blocks.count('data-epubar-id') == 100
+    assert len(blocks) < len(elements) * 0.8
+
+
+def test_block_mode_serves_block_relative_positions(app, client, indexed_book):
+    """Test that annotations and resume points are served against block anchors"""
+    app.config['READER_ANCHOR_MODE'] = ANCHOR_BLOCKS
+    locations = BookLocations(indexed_book.id).get(1)
+    span = next(number for number in range(len(locations)) if not locations.is_block(number))
+    block, local = locations.element_at(locations.starts[span], blocks_only=True)
+
+    response = client.post(f'/api/books/{indexed_book.id}/annotations', json={
+        'chapter_index': 1,
+        'position_data': {'element': f'el-{span}', 'start': 0, 'end': 2}
+    })
+    assert response.json['start_offset'] == locations.starts[span]
+    served = client.get(f'/api/books/{indexed_book.id}/annotations?chapter=1').json
+    position_data = served['annotations'][0][served['fields'].index('position_data')]
+    assert (position_data['element'], position_data['start'], position_data['end']) == (block, local, local + 2)
+
+    client.post(f'/reader/{indexed_book.id}/state', json={'position': '1:0', 'element': f'el-{span}'})
+    page = client.get(f'/reader/{indexed_book.id}').data
+    assert f'const resumeElement = "{block}";'.encode() in page
+
+
+def test_block_anchors_shrink_span_heavy_chapters(tmp_path):
+    """Test that block anchoring drops the anchors of inline elements on span-heavy markup"""
+    epub_path = write_span_heavy_epub(str(tmp_path / 'spans.epub'), chapters=1, paragraphs=20)
+    results = compare_anchor_modes(epub_path, repeat=1)
+
+    elements, blocks = results['elements'], results[ANCHOR_BLOCKS]
+    # One anchor per paragraph and heading instead of one per span as well
+    assert (elements['anchors'], blocks['anchors']) == (181, 21)
+    assert blocks['bytes'] < 0.8 * elements['bytes']
@@ -0,0 +1,117 @@
+"""
+Tests for the per-book reader packs of rendered chapters
+"""
+import gzip
+import weakref
+
+from app.models.book import Book
+from app.utils.content.artifacts import artifact_migrator
+from app.utils.content.packs import ReaderPack, ReaderPacks, pack_version, reader_packs, write_pack
+from app.utils.epub.content import ANCHOR_BLOCKS, ContentProcessor
+
+
+def test_packs_round_trip(tmp_path):
+    """Test that chapters and their gzip encodings are read back as slices"""
+    path = str(tmp_path / 'book.pack')
+    chapters = [('intro', b'<p>Intro</p>'), ('ch1', b'<p>' + b'word ' * 200 + b'</p>'), ('empty', b'')]
+    size = write_pack(path, chapters, 7, ANCHOR_BLOCKS)
+
+    pack = ReaderPack(path)
+    assert (pack.version, pack.anchor_mode, len(pack)) == (7, ANCHOR_BLOCKS, 3)
+    assert tmp_path.joinpath('book.pack').stat().st_size == size
+    data, encoding = pack.chapter('ch1')
+    assert isinstance(data, memoryview) and encoding is None
+    assert bytes(data) == chapters[1][1]
+    data, encoding = pack.chapter('ch1', encoded=True)
+    assert encoding == 'gzip' and gzip.decompress(data) == chapters[1][1]
+    assert bytes(pack.chapter('empty')[0]) == b''
+    assert pack.chapter('missing') is None
+
+    write_pack(path, chapters[:1], 7, ANCHOR_BLOCKS, compress=False)
+    assert ReaderPack(path).chapter('intro', encoded=True)[1] is None
+
+
+def test_least_recently_read_packs_are_unmapped(tmp_path):
+    """Test that only max_open packs stay mapped, and evicted ones close once unused"""
+    packs = ReaderPacks(str(tmp_path), max_open=2)
+    for book_id in range(1, 4):
+        write_pack(packs.path(book_id), [('ch1', b'<p>Book %d</p>' % book_id)], pack_version(), ANCHOR_BLOCKS)
+
+    packs._open(1)
+    packs._open(2)
+    packs._open(1)
+    data, _ = packs.chapter(3, 'ch1', ANCHOR_BLOCKS)
+    assert list(packs._packs) == [1, 3] and packs.stats['evictions'] == 1
+
+    # Book 3's mapping outlives its eviction while a slice of it is in use
+    third = weakref.ref(packs._packs[3])
+    packs._open(2)
+    packs._open(1)
+    assert list(packs._packs) == [2, 1] and packs.stats['evictions'] == 3
+    assert bytes(data) == b'<p>Book 3</p>'
+    del data
+    assert third() is None
+
+
+def test_chapters_are_served_from_current_packs(app, client, db, test_user, sample_book, monkeypatch):
+    """Test that packed chapters match live renders and outdated packs are rebuilt"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+    url = f'/api/books/{book.id}/content/{spine[1]["id"]}'
+    rendered = client.get(url).data
+
+    # Reading the book queues it for packing
+    with app.test_request_context():
+        assert artifact_migrator.rebuild() == 1
+    book = db.session.get(Book, book.id)
+    assert book.pack_version == pack_version()
+    # Packed chapters count towards the book's render statistics
+    assert client.get(f'/api/books/{book.id}/render-stats').json['chapters'] == 1 + len(spine)
+    hits = reader_packs.stats['hits']
+    assert client.get(url).data == rendered
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.content_encoding == 'gzip'
+    assert gzip.decompress(response.data) == rendered
+    assert reader_packs.stats['hits'] == hits + 2
+
+    # A renderer upgrade outdates the pack: chapters are rendered live until it is rebuilt
+    monkeypatch.setattr(ContentProcessor, 'VERSION', ContentProcessor.VERSION + 1)
+    stale = reader_packs.stats['stale']
+    assert client.get(url).data == rendered
+    assert reader_packs.stats['stale'] == stale + 1
+    with app.test_request_context():
+        assert artifact_migrator.rebuild() == 1
+        assert artifact_migrator.rebuild() == 0
+    assert db.session.get(Book, book.id).pack_version == pack_version()
+    assert client.get(url).data == rendered
+    assert reader_packs.stats['hits'] == hits + 3
+
+
+def test_failed_chapters_are_left_out_of_packs(app, client, db, test_user, sample_book, monkeypatch):
+    """Test that a chapter failing at pack time is rendered on request instead of packed degraded"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+    process_bytes = ContentProcessor.process_bytes
+
+    def flaky(self, data, html_path, *args, **kwargs):
+        if html_path.endswith(spine[1]['href']):
+            raise ValueError('transient failure')
+        return process_bytes(self, data, html_path, *args, **kwargs)
+
+    monkeypatch.setattr(ContentProcessor, 'process_bytes', flaky)
+    skipped = reader_packs.stats['chapters_skipped']
+    with app.test_request_context():
+        assert artifact_migrator.rebuild() == 1
+    assert reader_packs.stats['chapters_skipped'] == skipped + 1
+
+    # The pack still serves the other chapters, and the failed one renders once it can
+    monkeypatch.undo()
+    hits, misses = reader_packs.stats['hits'], reader_packs.stats['misses']
+    assert client.get(f'/api/books/{book.id}/content/{spine[0]["id"]}').status_code == 200
+    response = client.get(f'/api/books/{book.id}/content/{spine[1]["id"]}')
+    assert b'epubar-degraded' not in response.data
+    assert (reader_packs.stats['hits'], reader_packs.stats['misses']) == (hits + 1, misses + 1)
@@ -0,0 +1,135 @@
+"""
+Tests for sandboxed chapter parsing workers
+"""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from app.utils.content.workers import ParserPool, _worker_main, render_plain_text
+from app.utils.epub.content import ContentProcessor
+
+
+@pytest.fixture
+def chapter(tmp_path):
+    """Write a small chapter to disk"""
+    path = tmp_path / 'chapter1.xhtml'
+    path.write_text(
+        '<html><head><style>p { color: red; }</style></head>'
+        '<body><h1>Chapter 1</h1><p>First &amp; <em>only</em> paragraph.</p>'
+        '<script>alert(1)</script></body></html>',
+        encoding='utf-8'
+    )
+    return str(path)
+
+
+def test_plain_text_fallback(chapter):
+    """Test that the degraded rendering keeps text and drops markup and scripts"""
+    html = render_plain_text(chapter)
+
+    assert 'epubar-chapter-content' in html
+    assert '<p class="epubar-paragraph epubar-degraded">Chapter 1</p>' in html
+    assert 'First &amp; only paragraph.' in html
+    assert 'alert' not in html
+    assert 'color: red' not in html
+
+
+def test_worker_renders_chapter(chapter, tmp_path):
+    """Test rendering a chapter in a sandboxed worker process"""
+    pool = ParserPool(size=1, timeout=30, max_tasks=1, fallback_dir=str(tmp_path / 'fallbacks'))
+    os.makedirs(pool.fallback_dir)
+    try:
+        html = pool.process_content(chapter, str(tmp_path), add_data_attributes=True)
+    finally:
+        pool.shutdown()
+
+    assert b'data-epubar-id' in html
+    assert b'epubar-degraded' not in html
+    assert pool.stats['rendered'] == 1
+    # max_tasks=1 retires the worker after its first chapter
+    assert pool.stats['workers_recycled'] == 1
+
+
+def test_timeouts_fall_back_without_caching(chapter, tmp_path):
+    """Test that a timed-out chapter falls back to text and is retried on the next request"""
+    pool = ParserPool(size=1, timeout=0, fallback_dir=str(tmp_path / 'fallbacks'))
+    os.makedirs(pool.fallback_dir)
+    try:
+        first = pool.process_content(chapter, str(tmp_path))
+        second = pool.process_content(chapter, str(tmp_path))
+    finally:
+        pool.shutdown()
+
+    assert b'epubar-degraded' in first
+    assert second == first
+    assert pool.stats['timeouts'] == 2
+    assert pool.stats['fallbacks_served'] == 2
+    assert not os.listdir(pool.fallback_dir)
+
+
+def test_rejected_chapters_cache_their_fallback_per_version(chapter, tmp_path, monkeypatch):
+    """Test that parser failures are cached until the renderer version changes"""
+    pool = ParserPool(fallback_dir=str(tmp_path / 'fallbacks'))
+    os.makedirs(pool.fallback_dir)
+
+    def reject(*args, **kwargs):
+        raise ValueError('unparseable')
+
+    monkeypatch.setattr(ContentProcessor, 'process_bytes', reject)
+    first = pool.process_content(chapter, str(tmp_path))
+    assert b'epubar-degraded' in first
+    assert len(os.listdir(pool.fallback_dir)) == 1
+    assert pool.process_content(chapter, str(tmp_path)) == first
+    assert pool.stats['failures'] == 2
+
+    # Fallbacks of another renderer version are not reused
+    monkeypatch.setattr(ContentProcessor, 'VERSION', ContentProcessor.VERSION + 1)
+    pool.process_content(chapter, str(tmp_path))
+    assert len(os.listdir(pool.fallback_dir)) == 2
+
+    # The cache is only consulted once rendering failed
+    monkeypatch.undo()
+    assert b'epubar-degraded' not in pool.process_content(chapter, str(tmp_path))
+    assert pool.stats['rendered'] == 1
+
+
+@pytest.mark.parametrize('error', [MemoryError, RecursionError])
+def test_resource_limits_are_not_cached(chapter, tmp_path, monkeypatch, error):
+    """Test that running out of memory or stack falls back without caching, like a timeout"""
+    pool = ParserPool(fallback_dir=str(tmp_path / 'fallbacks'))
+    os.makedirs(pool.fallback_dir)
+
+    def exhaust(*args, **kwargs):
+        raise error('limit')
+
+    monkeypatch.setattr(ContentProcessor, 'process_bytes', exhaust)
+    assert b'epubar-degraded' in pool.process_content(chapter, str(tmp_path))
+    assert not os.listdir(pool.fallback_dir)
+
+    # A worker reports the crash and exits, so a fresh worker retries the chapter
+    parent, child = multiprocessing.Pipe()
+    with open(chapter, 'rb') as f:
+        parent.send((f.read(), chapter, str(tmp_path), False, 'elements', None, None))
+    _worker_main(child, 0)
+    status, message = parent.recv()
+    assert (status, message) == ('crash', f'{error.__name__}: limit')
+
+
+def test_fallback_cache_is_swept(tmp_path):
+    """Test that fallbacks of older renderers and unused ones are removed"""
+    pool = ParserPool(fallback_dir=str(tmp_path), fallback_max_age=60)
+    stale = time.time() - 120
+    names = {
+        'old_version': f'{ContentProcessor.VERSION - 1}-aa.html',
+        'unused': f'{ContentProcessor.VERSION}-bb.html',
+        'recent': f'{ContentProcessor.VERSION}-cc.html',
+        'writing': 'tmpxyz.tmp',
+    }
+    for name in names.values():
+        (tmp_path / name).write_bytes(b'<p>fallback</p>')
+    os.utime(tmp_path / names['unused'], (stale, stale))
+
+    assert pool.sweep_fallbacks() == 2
+    assert sorted(os.listdir(tmp_path)) == sorted([names['recent'], names['writing']])
+    assert pool.stats['fallbacks_swept'] == 2
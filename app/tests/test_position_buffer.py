@@ -0,0 +1,134 @@
+"""
+Tests for write-behind buffering of reading positions
+"""
+import pytest
+from sqlalchemy import event
+
+from app.models.book import Book
+from app.models.reading_state import ReadingState
+from app.utils.reading.positions import PositionBuffer, position_buffer
+
+
+@pytest.fixture
+def books(db, test_user):
+    """Create three books, the first of which already has a reading state"""
+    books = []
+    for i in range(3):
+        book = Book(
+            user_id=test_user.id,
+            title=f'Buffered Book {i}',
+            author='Buffer Author',
+            file_path=f'/uploads/buffered_{i}.epub'
+        )
+        db.session.add(book)
+        books.append(book)
+    db.session.flush()
+    db.session.add(ReadingState(user_id=test_user.id, book_id=books[0].id, current_position='0:0'))
+    db.session.commit()
+    return books
+
+
+@pytest.fixture
+def buffer(app):
+    """A buffer flushed only on demand"""
+    buffer = PositionBuffer(flush_interval=3600)
+    buffer.app = app
+    return buffer
+
+
+def _count_statements(engine):
+    """Collect the SQL statements executed on an engine"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements, lambda: event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_record_coalesces_updates(buffer, test_user):
+    """Test that repeated reports for a book keep only the latest values"""
+    for i in range(50):
+        buffer.record(test_user.id, 1, position=f'3:{i}')
+    buffer.record(test_user.id, 1, is_finished=True)
+
+    pending = buffer.get(test_user.id, 1)
+    assert pending.position == '3:49'
+    assert pending.is_finished is True
+    assert buffer.stats['updates'] == 51
+    assert buffer.stats['pending'] == 1
+    # Callers get copies; the buffered entry only changes through record()
+    buffer.record(test_user.id, 1).position = '0:0'
+    assert buffer.get(test_user.id, 1).position == '3:49'
+
+
+def test_flush_writes_batch_in_one_transaction(buffer, db, test_user, books):
+    """Test that a flush updates existing states and inserts new ones in bulk"""
+    for book in books:
+        for i in range(10):
+            buffer.record(test_user.id, book.id, position=f'2:{i * 100}')
+
+    statements, stop = _count_statements(db.engine)
+    try:
+        assert buffer.flush() == 3
+    finally:
+        stop()
+
+    # One lookup, one bulk UPDATE and one bulk INSERT, however many reports
+    writes = [s for s in statements if s.startswith(('UPDATE', 'INSERT'))]
+    assert len(writes) == 2
+    assert buffer.stats['rows_flushed'] == 3
+    assert buffer.stats['pending'] == 0
+
+    db.session.expire_all()
+    states = ReadingState.query.filter_by(user_id=test_user.id).all()
+    assert len(states) == 3
+    assert {state.current_position for state in states} == {'2:900'}
+
+
+def test_reads_see_unflushed_positions(client, app, db, test_user, books):
+    """Test that the reader and API report positions still held in the buffer"""
+    book = books[0]
+    position_buffer.flush_interval = 3600
+    try:
+        response = client.post(f'/reader/{book.id}/state', json={'position': '5:1200'})
+        assert response.status_code == 200
+        assert response.json['position'] == '5:1200'
+        assert response.json['is_finished'] is False
+
+        # Nothing has been written yet
+        db.session.expire_all()
+        assert db.session.get(ReadingState, 1).current_position == '0:0'
+
+        response = client.get(f'/reader/{book.id}')
+        assert b'const currentPosition = "5:1200"' in response.data
+
+        assert position_buffer.flush() == 1
+        db.session.expire_all()
+        assert db.session.get(ReadingState, 1).current_position == '5:1200'
+        assert client.get('/api/metrics').json['positions']['rows_flushed'] >= 1
+    finally:
+        position_buffer.flush_interval = 0
+        position_buffer.flush()
+
+
+def test_finishing_a_book_keeps_its_chapter_offset(client, db, test_user, books):
+    """Test that a report without a position leaves the stored position and offset alone"""
+    book = books[0]
+    state = db.session.get(ReadingState, 1)
+    state.current_position, state.chapter_offset = '2:0', 480
+    db.session.commit()
+    position_buffer.flush_interval = 3600
+    try:
+        response = client.post(f'/reader/{book.id}/state', json={'is_finished': True})
+        assert (response.json['position'], response.json['is_finished']) == ('2:0', True)
+        assert position_buffer.get(test_user.id, book.id).position is None
+
+        assert position_buffer.flush() == 1
+        db.session.expire_all()
+        state = db.session.get(ReadingState, 1)
+        assert (state.current_position, state.chapter_offset, state.is_finished) == ('2:0', 480, True)
+    finally:
+        position_buffer.flush_interval = 0
+        position_buffer.flush()
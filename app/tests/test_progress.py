@@ -0,0 +1,124 @@
+"""
+Tests for reading progress from chapter weights
+"""
+import json
+
+import pytest
+from sqlalchemy import insert
+
+from app.models.book import Book
+from app.models.book_text import BookTextSegment
+from app.models.migrations import _chapter_weights
+from app.models.reading_state import ReadingState
+from app.utils.reading.positions import position_buffer
+from app.utils.reading.progress import ChapterWeights, load_starts, progress_percent
+from app.utils.search.fulltext import book_text_index
+
+
+@pytest.fixture
+def weighed_book(db, test_user):
+    """Create a book whose three chapters hold 100, 300 and 600 characters"""
+    weights = ChapterWeights(3)
+    for spine_index, chars in enumerate((100, 300, 600)):
+        weights.add(spine_index, 'x' * chars)
+    book = Book(user_id=test_user.id, title='Weighed', file_path='/uploads/weighed.epub', **weights.columns())
+    db.session.add(book)
+    db.session.commit()
+    return book
+
+
+def test_progress_follows_chapter_lengths():
+    """Test that progress is weighted by chapter length, not chapter count"""
+    weights = ChapterWeights(4)
+    weights.add(0, 'one two')
+    weights.add(1, 'three four five')
+    weights.add(3, 'six')
+    starts = weights.starts()
+    assert starts == [0, 7, 22, 22, 25]
+    assert weights.columns()['word_count'] == 6
+    assert weights.columns()['total_pages'] == 1
+
+    assert progress_percent(starts, 0) == 0.0
+    assert progress_percent(starts, 1) == 28.0
+    assert progress_percent(starts, 1, 0.5) == 58.0
+    assert progress_percent(starts, 3, 1.0) == 100.0
+    assert progress_percent(starts, 9) == 100.0
+    assert progress_percent(starts, 0, is_finished=True) == 100.0
+    assert progress_percent(None, 1) is None
+    assert progress_percent(starts, None) is None
+    assert load_starts('not json') is None
+
+
+def test_indexing_weighs_chapters(db, test_user, sample_book):
+    """Test that indexing a book stores its chapter weights and page count"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    book_text_index.index_book(book)
+    db.session.refresh(book)
+
+    starts = json.loads(book.chapter_weights)
+    assert starts[0] == 0
+    assert starts == sorted(starts)
+    assert starts[-1] > 200000
+    assert 40000 < book.word_count < 60000
+    assert book.total_pages == -(-book.word_count // 250)
+
+
+def test_saved_position_stores_progress(client, db, weighed_book):
+    """Test that saving a position stores its weighted progress"""
+    client.post(f'/reader/{weighed_book.id}/state', json={'position': '1:0'})
+    state = ReadingState.query.filter_by(book_id=weighed_book.id).one()
+    assert state.progress_percent == 10.0
+
+    client.post(f'/reader/{weighed_book.id}/state', json={'position': '2:1200', 'chapter_progress': 0.5})
+    db.session.refresh(state)
+    assert state.progress_percent == 70.0
+
+    client.post(f'/reader/{weighed_book.id}/state', json={'is_finished': True})
+    db.session.refresh(state)
+    assert state.progress_percent == 100.0
+
+    # Listing pages read the stored value without rewriting it
+    assert b'width: 100%' in client.get('/library/').data
+    db.session.refresh(state)
+    assert state.progress_percent == 100.0
+
+
+def test_buffered_position_carries_progress(client, db, weighed_book):
+    """Test that buffered positions show and flush their progress"""
+    client.post(f'/reader/{weighed_book.id}/state', json={'position': '0:0'})
+    position_buffer.flush_interval = 3600
+    try:
+        client.post(f'/reader/{weighed_book.id}/state', json={'position': '2:0', 'chapter_progress': 0.25})
+        assert b'width: 55%' in client.get('/library/').data
+        position_buffer.flush()
+    finally:
+        position_buffer.flush_interval = 0
+
+    state = ReadingState.query.filter_by(book_id=weighed_book.id).one()
+    assert state.progress_percent == 55.0
+
+
+def test_migration_weighs_indexed_books(db, test_user):
+    """Test that the migration derives weights from indexed text and fixes stored progress"""
+    book = Book(user_id=test_user.id, title='Indexed', file_path='/uploads/indexed.epub')
+    db.session.add(book)
+    db.session.commit()
+    db.session.execute(insert(BookTextSegment), [
+        {'book_id': book.id, 'spine_index': 0, 'element_id': 'el-0', 'text': 'a b c d e'},
+        {'book_id': book.id, 'spine_index': 2, 'element_id': 'el-0', 'text': 'f g h i j'},
+        {'book_id': book.id, 'spine_index': 2, 'element_id': 'el-1', 'text': 'k l m n o p q r s t'},
+    ])
+    db.session.add(ReadingState(user_id=test_user.id, book_id=book.id, current_position='2:500',
+                                progress_percent=20.0))
+    db.session.commit()
+
+    with db.engine.begin() as conn:
+        _chapter_weights(conn, {})
+
+    db.session.expire_all()
+    book = db.session.get(Book, book.id)
+    assert json.loads(book.chapter_weights) == [0, 9, 9, 37]
+    assert book.word_count == 20
+    assert ReadingState.query.filter_by(book_id=book.id).one().progress_percent == 24.3
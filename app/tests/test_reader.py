@@ -147,3 +147,26 @@ def test_update_reading_state(client, app, test_user, sample_book, db):
         
         assert updated_state.current_position == new_position
         assert updated_state.is_finished is False
+
+
+def test_api_get_book_cover_extracts_cover(client, app, test_user, sample_book, db):
+    """Test that the cover endpoint extracts and stores the book's cover"""
+    with app.app_context():
+        book = Book(
+            user_id=test_user.id,
+            title="Test Book",
+            author="Test Author",
+            file_path=sample_book,
+            language="en"
+        )
+        db.session.add(book)
+        db.session.commit()
+        
+        response = client.get(f"/api/books/{book.id}/cover")
+        assert response.status_code == 200
+        assert response.mimetype.startswith('image/')
+        
+        # The extracted cover is remembered for later requests
+        db.session.refresh(book)
+        assert book.cover_path
+        assert book.cover_path.startswith(app.config['UPLOAD_FOLDER'])
@@ -0,0 +1,118 @@
+"""
+Tests for full-text search over book contents
+"""
+import pytest
+from sqlalchemy import text
+
+from app.models.book import Book
+from app.models.book_text import BookTextSegment
+from app.utils.epub.content import ContentProcessor
+from app.utils.search.fulltext import book_text_index, fts_query
+
+
+@pytest.fixture
+def indexed_book(db, test_user, sample_book):
+    """Create a book from the sample EPUB and index its text"""
+    book = Book(
+        user_id=test_user.id,
+        title='The Great Gatsby',
+        author='F. Scott Fitzgerald',
+        file_path=sample_book
+    )
+    db.session.add(book)
+    db.session.commit()
+    book_text_index.index_book(book)
+    return book
+
+
+def test_iter_text_streams_elements(tmp_path):
+    """Test that chapter text is split by annotatable element, numbered like the renderer"""
+    chapter = tmp_path / 'chapter.xhtml'
+    chapter.write_text(
+        '<html><head><title>Skip</title><style>p {}</style></head><body>'
+        '<h1>Chapter &amp; One</h1>'
+        '<div><p>First <b>bold</b> paragraph.</p><span/>'
+        '<p>Second <span>inner</span> paragraph.</p></div>'
+        '<script>var skipped = 1;</script>'
+        '</body></html>'
+    )
+
+    segments = list(ContentProcessor().iter_text(str(chapter), chunk_size=16))
+
+    assert segments == [
+        ('el-0', 'Chapter & One'),
+        ('el-2', 'First bold paragraph.'),
+        ('el-5', 'inner'),
+        ('el-4', 'Second paragraph.'),
+    ]
+
+
+def test_search_returns_ranked_hits_with_locations(client, indexed_book):
+    """Test that a search finds passages with snippets and reader locations"""
+    response = client.get('/api/search?q=green light')
+    assert response.status_code == 200
+    hits = response.json['hits']
+    assert hits
+    assert all(hit['book_id'] == indexed_book.id for hit in hits)
+    assert '<mark>' in hits[0]['snippet']
+    assert hits[0]['url'].startswith(f'/reader/{indexed_book.id}?chapter=')
+    assert [hit['score'] for hit in hits] == sorted((hit['score'] for hit in hits), reverse=True)
+
+    # The location points at an element of the rendered chapter
+    spine = client.get(f'/api/books/{indexed_book.id}/spine').json['spine']
+    chapter = spine[hits[0]['spine_index']]
+    html = client.get(f"/api/books/{indexed_book.id}/content/{chapter['id']}").get_data(as_text=True)
+    assert f'data-epubar-id="{hits[0]["element_id"]}"' in html
+
+
+def test_search_rejects_empty_queries(client, indexed_book):
+    """Test query validation and that FTS syntax in the input is searched literally"""
+    assert client.get('/api/search?q=').status_code == 400
+    assert client.get('/api/search?q=***').status_code == 400
+    assert client.get('/api/search?q=gatsby NEAR( OR').status_code == 200
+    assert fts_query('Gatsby AND "Daisy') == '"Gatsby" "AND" "Daisy"*'
+
+
+def test_reindexing_replaces_segments(db, indexed_book):
+    """Test that indexing a book again replaces its rows in the table and the FTS index"""
+    count = BookTextSegment.query.filter_by(book_id=indexed_book.id).count()
+    assert count > 0
+
+    assert book_text_index.index_book(indexed_book) == count
+    assert BookTextSegment.query.filter_by(book_id=indexed_book.id).count() == count
+    fts_rows = db.session.execute(text(
+        "SELECT COUNT(*) FROM book_text_fts WHERE book_text_fts MATCH 'gatsby'"
+    )).scalar()
+    segment_rows = db.session.execute(text(
+        "SELECT COUNT(*) FROM book_text_segments WHERE text LIKE '%gatsby%'"
+    )).scalar()
+    assert fts_rows == segment_rows
+
+
+def test_backfill_indexes_unindexed_books(db, test_user, sample_book):
+    """Test that the backfill indexes books uploaded before the index existed"""
+    books = [
+        Book(user_id=test_user.id, title='Old Upload', file_path=sample_book),
+        Book(user_id=test_user.id, title='Missing File', file_path='/nonexistent.epub'),
+    ]
+    db.session.add_all(books)
+    db.session.commit()
+
+    assert book_text_index.backfill(limit=10) == 1
+    db.session.expire_all()
+    assert books[0].text_indexed_at is not None
+    assert books[1].text_indexed_at is None
+    # The failed book is not retried on every run
+    assert book_text_index.backfill(limit=10) == 0
+
+
+def test_upload_indexes_book_text(client, db, sample_book):
+    """Test that uploading a book makes its text searchable"""
+    with open(sample_book, 'rb') as f:
+        response = client.post('/library/upload', data={'epub_file': (f, 'gatsby.epub')},
+                               content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    book = Book.query.filter_by(title='The Great Gatsby').one()
+    assert book.text_indexed_at is not None
+    assert client.get(f'/api/search?q=gatsby&book_id={book.id}').json['hits']
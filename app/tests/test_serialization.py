@@ -0,0 +1,103 @@
+"""
+Tests for the canonical, minified serialization of rendered chapters
+"""
+import json
+
+from app.models.annotation import Annotation, AnnotationType
+from app.models.book import Book
+from app.models.chapter_location import ChapterLocation
+from app.utils.epub.content import ContentProcessor
+from app.utils.epub.locations import ChapterLocations
+from app.utils.reading.anchors import BookLocations
+from app.utils.search.fulltext import book_text_index
+
+
+def _render(tmp_path, body, name='chapter.xhtml'):
+    chapter = tmp_path / name
+    chapter.write_text(f'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>T</title></head><body>{body}</body></html>')
+    stats = {}
+    html = ContentProcessor().process_content(str(chapter), str(tmp_path), True, stats=stats)
+    return html, stats
+
+
+def test_chapters_serialize_canonically(tmp_path):
+    """Test that whitespace, comments and redundant attributes are dropped outside pre"""
+    html, stats = _render(tmp_path, (
+        '\n  <!-- generated -->\n'
+        '  <p id="" class="note note">Some\n      text  <a shape="rect" href="n.html" title="t">here</a></p>\n'
+        '  <pre>  keep\n    this  </pre>\n'
+        '  <table><tr><td colspan="1" rowspan="2">cell</td></tr></table>\n'
+    ))
+    content = html.split('<div class="epubar-chapter-content epubar-content">', 1)[1]
+    assert content.startswith('  <p class="note epubar-paragraph" data-epubar-id="el-0">Some text <a href="n.html" title="t">here</a></p> ')
+    assert '<pre>  keep\n    this  </pre>' in content
+    assert '<td rowspan="2">cell</td>' in content
+    assert 'generated' not in content
+    assert stats['bytes_out'] == len(html.encode('utf-8'))
+    assert stats['bytes_saved'] > 50
+
+    # The same chapter with other attribute order and line breaks renders the same
+    same, _ = _render(tmp_path, (
+        ' <p class="note" id="">Some text \n<a title="t" href="n.html">here</a></p> '
+        '<pre>  keep\n    this  </pre> '
+        '<table><tr><td rowspan="2">cell</td></tr></table> '
+    ), 'other.xhtml')
+    assert same == html.replace('  <p', ' <p')
+
+
+def test_offsets_count_collapsed_whitespace(tmp_path):
+    """Test that the offset index counts text as the minified chapter displays it"""
+    chapter = tmp_path / 'chapter.xhtml'
+    chapter.write_text('<html><body><p>One   \n  two</p><pre>a   b</pre><p>  three  <!-- x -->  four</p></body></html>')
+    locations = ChapterLocations()
+    list(ContentProcessor().iter_text(str(chapter), chunk_size=3, locations=locations))
+    assert list(locations.starts) == [0, 12]
+    assert list(locations.ends) == [7, 24]
+    assert locations.length == 24
+
+
+def test_render_stats_are_reported_per_book(client, db, test_user, sample_book):
+    """Test that a book reports the bytes its rendered chapters saved"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+    html = client.get(f'/api/books/{book.id}/content/{spine[1]["id"]}').data
+
+    stats = client.get(f'/api/books/{book.id}/render-stats').json
+    assert stats['chapters'] == 1
+    assert stats['bytes_out'] == len(html)
+    assert stats['bytes_saved'] > 0
+    assert stats['saved_percent'] == round(stats['bytes_saved'] * 100 / (len(html) + stats['bytes_saved']), 1)
+
+
+def test_reindexing_moves_stored_offsets(db, test_user, sample_book):
+    """Test that rebuilding chapter indexes keeps annotations on their text"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    book_text_index.index_book(book)
+    current = BookLocations(book.id).get(1)
+
+    # An index built when every element started 7 characters later
+    shifted = ChapterLocations(
+        *(type(current.starts)('i', [value + 7 for value in values]) for values in (current.starts, current.ends)),
+        current.parents, current.length + 7, current.blocks
+    )
+    row = ChapterLocation.query.filter_by(book_id=book.id, spine_index=1).one()
+    row.starts, row.ends, row.parents = shifted.pack()
+    row.length = shifted.length
+    start = shifted.offset_of('el-5', 4)
+    db.session.add(Annotation(
+        user_id=test_user.id, book_id=book.id, type=AnnotationType.HIGHLIGHT, chapter_index=1,
+        position_data=json.dumps({'element': 'el-5', 'start': 4, 'end': 10, 'start_offset': start,
+                                  'end_offset': start + 6}),
+        start_offset=start, end_offset=start + 6
+    ))
+    db.session.commit()
+
+    book_text_index.index_book(book)
+    annotation = Annotation.query.filter_by(book_id=book.id).one()
+    assert annotation.start_offset == current.offset_of('el-5', 4)
+    assert annotation.end_offset == annotation.start_offset + 6
+    assert json.loads(annotation.position_data)['start_offset'] == annotation.start_offset
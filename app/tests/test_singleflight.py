@@ -0,0 +1,124 @@
+"""
+Tests for single-flight request coalescing
+"""
+import threading
+import time
+import pytest
+
+from app.utils.concurrency.singleflight import SingleFlight
+
+
+def _run_concurrently(callers, count=8):
+    """Start ``count`` threads per caller at once and collect results and errors"""
+    barrier = threading.Barrier(count * len(callers))
+    results, errors = [], []
+
+    def worker(call):
+        barrier.wait()
+        try:
+            results.append(call())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(call,)) for call in callers for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_concurrent_calls_share_one_computation():
+    """Test that threads asking for the same key run the computation once"""
+    group = SingleFlight()
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return '<p>chapter</p>'
+
+    results, errors = _run_concurrently([lambda: group.do('content:1:ch1', render)])
+
+    assert not errors
+    assert results == ['<p>chapter</p>'] * 8
+    assert len(calls) == 1
+    assert group.stats['shared'] == 7
+
+
+def test_errors_are_shared_and_not_cached():
+    """Test that waiters receive the leader's exception and later calls retry"""
+    group = SingleFlight()
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('broken chapter')
+
+    results, errors = _run_concurrently([lambda: group.do('content:1:bad', fail)], count=4)
+
+    assert not results
+    assert len(errors) == 4
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert group.do('content:1:bad', lambda: 'recovered') == 'recovered'
+
+
+def test_coalescing_across_processes(tmp_path):
+    """Test that separate groups sharing a lock directory share one computation"""
+    # Independent groups stand in for worker processes: their in-memory maps are
+    # separate, so only the file lock can coalesce them
+    groups = [SingleFlight(lock_dir=str(tmp_path)) for _ in range(2)]
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.3)
+        return {'spine': ['ch1', 'ch2']}
+
+    results, errors = _run_concurrently(
+        [lambda group=group: group.do('spine:1', render) for group in groups],
+        count=1
+    )
+
+    assert not errors
+    assert results == [{'spine': ['ch1', 'ch2']}] * 2
+    assert len(calls) == 1
+
+
+def test_rendered_bytes_are_shared_across_processes(tmp_path):
+    """Test that byte results, which JSON cannot hold, are still published to waiters"""
+    groups = [SingleFlight(lock_dir=str(tmp_path)) for _ in range(2)]
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.3)
+        return '<p>caf\u00e9</p>'.encode('utf-8')
+
+    results, errors = _run_concurrently(
+        [lambda group=group: group.do('content:1:ch1', render) for group in groups],
+        count=1
+    )
+
+    assert not errors
+    assert results == ['<p>caf\u00e9</p>'.encode('utf-8')] * 2
+    assert len(calls) == 1
+
+
+def test_finished_results_are_not_reused(tmp_path):
+    """Test that a later, uncontended call recomputes instead of reading stale output"""
+    group = SingleFlight(lock_dir=str(tmp_path))
+
+    assert group.do('cover:1', lambda: 'first') == 'first'
+    assert group.do('cover:1', lambda: 'second') == 'second'
+
+
+def test_expired_lock_and_result_files_are_swept(tmp_path):
+    """Test that files of finished flights are removed once older than the TTL"""
+    group = SingleFlight(lock_dir=str(tmp_path))
+    group.do('content:1:ch1', lambda: b'<p>chapter</p>')
+    group.do('spine:1', lambda: ['ch1'])
+    assert len(list(tmp_path.iterdir())) == 5
+
+    assert group.sweep() == 0
+    assert group.sweep(max_age=-1) == 5
+    assert not list(tmp_path.iterdir())
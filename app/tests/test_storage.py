@@ -0,0 +1,96 @@
+"""
+Tests for the SQLite storage profile and schema migrations
+"""
+import pytest
+from sqlalchemy import create_engine, text
+
+from app.models.db import apply_sqlite_profile, DEFAULT_SQLITE_PRAGMAS
+from app.models.migrations import upgrade, MIGRATIONS
+
+
+def _create_original_schema(conn):
+    """Create the tables as the first release of the application did"""
+    conn.execute(text("""
+        CREATE TABLE books (
+            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, title VARCHAR(255) NOT NULL,
+            author VARCHAR(255), publisher VARCHAR(255), language VARCHAR(50),
+            identifier VARCHAR(255), publication_date VARCHAR(50), description TEXT,
+            file_path VARCHAR(255) NOT NULL, cover_path VARCHAR(255), file_size INTEGER,
+            total_pages INTEGER, created_at DATETIME, updated_at DATETIME
+        )
+    """))
+    conn.execute(text("""
+        CREATE TABLE reading_states (
+            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, book_id INTEGER NOT NULL,
+            current_position VARCHAR(255), progress_percent FLOAT, is_finished BOOLEAN,
+            last_read_at DATETIME, created_at DATETIME, updated_at DATETIME
+        )
+    """))
+    conn.execute(text("""
+        CREATE TABLE annotations (
+            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, book_id INTEGER NOT NULL,
+            type VARCHAR(9) NOT NULL, content TEXT, color VARCHAR(50), position_data TEXT NOT NULL,
+            chapter_index INTEGER, created_at DATETIME, updated_at DATETIME
+        )
+    """))
+
+
+def test_storage_profile_applied_on_connect(app, db):
+    """Test that application connections use the tuned PRAGMA settings"""
+    with db.engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar().lower() == 'wal'
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+        assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+        assert conn.execute(text('PRAGMA cache_size')).scalar() == DEFAULT_SQLITE_PRAGMAS['cache_size']
+
+
+def test_hot_queries_use_indexes(app, db):
+    """Test that the (user_id, book_id) and (book_id, chapter_index) lookups are index searches"""
+    queries = [
+        'SELECT * FROM reading_states WHERE user_id = 1 AND book_id = 1',
+        'SELECT * FROM annotations WHERE user_id = 1 AND book_id = 1',
+        'SELECT * FROM annotations WHERE book_id = 1 AND chapter_index = 2',
+        'SELECT * FROM books WHERE user_id = 1 ORDER BY created_at DESC, id DESC',
+    ]
+    with db.engine.connect() as conn:
+        for query in queries:
+            plan = ' '.join(str(row[-1]) for row in conn.execute(text(f'EXPLAIN QUERY PLAN {query}')))
+            assert 'USING INDEX' in plan or 'USING COVERING INDEX' in plan, plan
+
+
+def test_upgrade_adds_indexes_to_existing_database(tmp_path):
+    """Test migrating a database created before the indexes existed"""
+    engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    apply_sqlite_profile(engine, DEFAULT_SQLITE_PRAGMAS)
+    with engine.begin() as conn:
+        _create_original_schema(conn)
+    
+    assert upgrade(engine) == MIGRATIONS[-1][0]
+    # Upgrading again is a no-op
+    assert upgrade(engine) == MIGRATIONS[-1][0]
+    
+    with engine.connect() as conn:
+        indexes = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    assert {'ix_books_user_created', 'ix_reading_states_user_book',
+            'ix_annotations_user_book_chapter', 'ix_annotations_book_chapter'} <= indexes
+
+
+def test_upgrade_copies_annotation_ranges(tmp_path):
+    """Test that upgrading moves character ranges out of position_data"""
+    engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    with engine.begin() as conn:
+        _create_original_schema(conn)
+        conn.execute(text("""
+            INSERT INTO annotations (user_id, book_id, type, chapter_index, position_data) VALUES
+                (1, 1, 'HIGHLIGHT', 0, '{"start_offset": 10, "end_offset": 20}'),
+                (1, 1, 'HIGHLIGHT', 0, '{"start": 3, "end": 7}'),
+                (1, 1, 'HIGHLIGHT', 0, '{"element": "p-1", "start": 3, "end": 7}'),
+                (1, 1, 'HIGHLIGHT', 0, '{"start_offset": 9, "end_offset": 2}'),
+                (1, 1, 'HIGHLIGHT', 0, 'not json')
+        """))
+    
+    upgrade(engine)
+    
+    with engine.connect() as conn:
+        ranges = conn.execute(text('SELECT start_offset, end_offset FROM annotations ORDER BY id')).all()
+    assert [tuple(r) for r in ranges] == [(10, 20), (3, 7), (None, None), (None, None), (None, None)]
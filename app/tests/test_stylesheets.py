@@ -0,0 +1,78 @@
+"""
+Tests for the scoped per-book stylesheet bundles
+"""
+import os
+import re
+
+from app.models.book import Book
+from app.utils.content.stylesheets import stylesheet_bundler
+from app.utils.epub.content import ContentProcessor
+from app.utils.epub.styles import bundle_stylesheets, inline_style_class, scope_stylesheet
+
+
+def test_stylesheets_are_scoped_and_minified():
+    """Test that rules apply under the chapter element and reader-owned declarations are dropped"""
+    css = '''@charset "utf-8";
+    @import url(other.css);
+    /* page setup */
+    html, body.calibre { margin: 0 5%; color: #000 }
+    html > body p , h2+p { text-indent : 1em ; background: url(paper.png) ; font-family: "Old  Style", serif }
+    @media screen and (max-width: 600px) { p { margin : 0 } .note { color: red } }
+    @font-face { font-family: Old; src: url(old.ttf) }
+    h1 { font-size: 24px; letter-spacing: 0.1em } h2 { font-size: 1.5em }
+    '''
+    assert scope_stylesheet(css) == (
+        '.epubar-content,.epubar-content.calibre{margin:0 5%}'
+        '.epubar-content p,.epubar-content h2+p{text-indent:1em;font-family:"Old  Style",serif}'
+        '@media screen and (max-width: 600px){.epubar-content p{margin:0}}'
+        '.epubar-content h1{letter-spacing:0.1em}'
+        '.epubar-content h2{font-size:1.5em}'
+    )
+
+
+def test_inline_styles_become_bundle_classes(tmp_path):
+    """Test that style attributes turn into classes the bundle defines, and styles leave the chapter"""
+    chapter = tmp_path / 'chapter.xhtml'
+    chapter.write_text(
+        '<html><head><link href="book.css" rel="stylesheet"/></head><body class="calibre">'
+        '<style>p { color: red }</style>'
+        '<p style="text-align: center; color: blue">One</p><p style="color: blue">Two</p>'
+        '</body></html>'
+    )
+    html = ContentProcessor().process_content(str(chapter), str(tmp_path), stylesheet_url='/api/stylesheets/x.css')
+
+    name = inline_style_class('text-align:center;color:blue')
+    assert '<link href="/api/stylesheets/x.css" rel="stylesheet"></head>' in html
+    assert '<div class="epubar-chapter-content epubar-content calibre">' in html
+    assert f'<p class="epubar-paragraph {name}" data-epubar-id="el-0">One</p>' in html
+    assert '<p class="epubar-paragraph" data-epubar-id="el-1">Two</p>' in html
+    assert 'style' not in html.split('</head>', 1)[1]
+
+    bundle = bundle_stylesheets(['p{margin:0}', 'p{margin:0}'], ['text-align: center; color: blue', 'color: blue'])
+    assert bundle == f'.epubar-content p{{margin:0}}.epubar-content .{name}{{text-align:center!important}}'
+
+
+def test_books_link_one_cached_bundle(client, db, test_user, sample_book):
+    """Test that chapters link the book's bundle, built once and served as immutable"""
+    book = Book(user_id=test_user.id, title='The Great Gatsby', file_path=sample_book)
+    db.session.add(book)
+    db.session.commit()
+    spine = client.get(f'/api/books/{book.id}/spine').json['spine']
+
+    first = client.get(f'/api/books/{book.id}/content/{spine[1]["id"]}').data.decode('utf-8')
+    second = client.get(f'/api/books/{book.id}/content/{spine[2]["id"]}').data.decode('utf-8')
+    links = [re.search(r'<link href="([^"]+)" rel="stylesheet">', html).group(1) for html in (first, second)]
+    assert links[0] == links[1] == f'/api/stylesheets/{book.stylesheet}'
+    assert '.css"' not in first.split('</head>', 1)[1]
+
+    response = client.get(links[0])
+    assert response.status_code == 200
+    assert response.mimetype == 'text/css'
+    assert 'immutable' in response.headers['Cache-Control']
+    css = response.data.decode('utf-8')
+    # Rules of both of the book's stylesheets, in the order the spine first links them
+    assert css.index('.epubar-content div.pgebub-root-div') < css.index('.epubar-content p{margin:0;text-indent:1em}')
+    assert os.path.basename(stylesheet_bundler.path(book.stylesheet)) == book.stylesheet
+
+    assert client.get('/api/stylesheets/../app.db').status_code == 404
+    assert client.get('/api/stylesheets/0123456789abcdef.css').status_code == 404
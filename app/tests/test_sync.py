@@ -0,0 +1,123 @@
+"""
+Tests for delta sync of annotations and reading states
+"""
+import pytest
+from sqlalchemy import event, text
+
+from app.models.book import Book
+from app.utils.reading.positions import position_buffer
+
+
+@pytest.fixture
+def book(db, test_user):
+    """Create a book to sync"""
+    book = Book(
+        user_id=test_user.id,
+        title='Synced Book',
+        author='Sync Author',
+        file_path='/uploads/synced.epub'
+    )
+    db.session.add(book)
+    db.session.commit()
+    return book
+
+
+def _create(client, book, count):
+    """Create highlights through the batch API and return their IDs"""
+    response = client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': [
+        {'op': 'create', 'chapter_index': 0, 'position_data': {'start_offset': i, 'end_offset': i + 1}}
+        for i in range(count)
+    ]})
+    return [result['id'] for result in response.json['results']]
+
+
+def _sync_all(client, cursor=None, limit=100):
+    """Follow sync pages until has_more is false"""
+    changes = []
+    while True:
+        url = f'/api/sync?limit={limit}' + (f'&since={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        changes += response.json['changes']
+        cursor = response.json['cursor']
+        if not response.json['has_more']:
+            return changes, cursor
+
+
+def test_sync_returns_only_changes_after_cursor(client, book):
+    """Test a full sync followed by delta syncs with updates and deletes"""
+    first, second, third = _create(client, book, 3)
+    client.post(f'/reader/{book.id}/state', json={'position': '2:10'})
+
+    changes, cursor = _sync_all(client, limit=2)
+    assert {(c['entity'], c['id']) for c in changes} == {
+        ('annotation', first), ('annotation', second), ('annotation', third), ('reading_state', 1)
+    }
+    state = next(c for c in changes if c['entity'] == 'reading_state')
+    assert state['data']['position'] == '2:10'
+
+    # Nothing changed: the same cursor comes back with no changes
+    changes, same_cursor = _sync_all(client, cursor)
+    assert changes == []
+    assert same_cursor == cursor
+
+    client.post(f'/api/books/{book.id}/annotations/batch', json={'operations': [
+        {'op': 'update', 'id': first, 'color': 'blue'},
+        {'op': 'delete', 'id': second},
+    ]})
+    changes, cursor = _sync_all(client, cursor)
+    assert [(c['id'], c['op']) for c in changes] == [(first, 'upsert'), (second, 'delete')]
+    assert changes[0]['data']['color'] == 'blue'
+    assert 'data' not in changes[1]
+
+
+def test_sync_logs_one_entry_per_row(client, db, book):
+    """Test that repeated changes to a row keep a single log entry"""
+    client.post(f'/reader/{book.id}/state', json={'position': '0:0'})
+    for i in range(5):
+        client.post(f'/reader/{book.id}/state', json={'position': f'1:{i}'})
+
+    count = db.session.execute(text(
+        "SELECT COUNT(*) FROM sync_changes WHERE entity = 'reading_state'"
+    )).scalar()
+    assert count == 1
+
+
+def test_sync_sees_buffered_position_flushes(client, db, book):
+    """Test that bulk writes from the position buffer are logged by the triggers"""
+    _, cursor = _sync_all(client)
+    position_buffer.flush_interval = 3600
+    try:
+        client.post(f'/reader/{book.id}/state', json={'position': '4:400'})
+        position_buffer.flush()
+    finally:
+        position_buffer.flush_interval = 0
+
+    changes, _ = _sync_all(client, cursor)
+    assert [c['data']['position'] for c in changes] == ['4:400']
+
+
+def test_idle_poll_is_one_indexed_query(client, db, book):
+    """Test that a poll without changes runs a single index range scan"""
+    _create(client, book, 20)
+    _, cursor = _sync_all(client)
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        assert client.get(f'/api/sync?since={cursor}').json['changes'] == []
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    selects = [s for s in statements if s.lstrip().startswith('SELECT')]
+    assert len(selects) == 1
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {selects[0]}', (1, 0, 1, 0))
+        plan = ' '.join(str(row[-1]) for row in rows)
+    assert 'ix_sync_changes_user_seq' in plan, plan
+
+    assert client.get('/api/sync?since=bogus').status_code == 400
@@ -0,0 +1,71 @@
+"""
+Tests for extraction workspace lifecycle management
+"""
+import os
+import time
+import pytest
+
+from app.utils.epub.processor import EPUBProcessor
+from app.utils.epub.workspace import WorkspaceJanitor, WorkspaceQuotaExceeded
+
+
+def _make_orphan(root, name, size, age):
+    """Create a workspace directory holding ``size`` bytes, last modified ``age`` seconds ago"""
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, 'chapter.xhtml'), 'wb') as f:
+        f.write(b'x' * size)
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_processor_session_removes_workspace(sample_book):
+    """Test that a context-managed session leaves no workspace behind"""
+    with EPUBProcessor() as processor:
+        extracted_path = processor.extract(sample_book)
+        workspace = processor.temp_dir
+        assert os.path.exists(extracted_path)
+
+    assert not os.path.exists(workspace)
+    assert processor.temp_dir is None
+
+
+def test_sweep_removes_only_old_orphans(tmp_path):
+    """Test that the sweeper reclaims old workspaces and keeps fresh and held ones"""
+    janitor = WorkspaceJanitor(root=str(tmp_path), max_age=60)
+    old = _make_orphan(str(tmp_path), 'epubar_old', 1000, age=3600)
+    fresh = _make_orphan(str(tmp_path), 'epubar_fresh', 10, age=0)
+    unrelated = _make_orphan(str(tmp_path), 'other_old', 10, age=3600)
+    held = janitor.create()
+    stamp = time.time() - 3600
+    os.utime(held, (stamp, stamp))
+
+    assert janitor.sweep() == 1
+
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+    assert os.path.exists(unrelated)
+    assert os.path.exists(held)
+    assert janitor.stats['bytes_reclaimed'] == 1000
+    assert janitor.stats['bytes_in_use'] == 10
+
+
+def test_quota_guard_sweeps_then_rejects(tmp_path):
+    """Test that the quota guard reclaims orphans before refusing new workspaces"""
+    janitor = WorkspaceJanitor(root=str(tmp_path), max_age=60, quota_bytes=1000)
+    _make_orphan(str(tmp_path), 'epubar_orphan', 900, age=3600)
+    janitor.sweep(max_age=7200)
+    assert janitor.stats['bytes_in_use'] == 900
+
+    # Sweeping the orphan makes room for the new workspace
+    workspace = janitor.create(required_bytes=500)
+    assert os.path.isdir(workspace)
+
+    with pytest.raises(WorkspaceQuotaExceeded):
+        janitor.create(required_bytes=600)
+    assert janitor.stats['quota_rejections'] == 1
+
+    janitor.release(workspace)
+    assert not os.path.exists(workspace)
+    assert janitor.stats['bytes_in_use'] == 0
@@ -0,0 +1,175 @@
+"""
+Admission control for expensive endpoints.
+
+Each endpoint class (uploads, chapter renders, media) gets its own concurrency
+limit and a short bounded wait queue. Requests that find the queue full, or
+that wait longer than the queue timeout, are turned away with ``503`` and a
+``Retry-After`` header instead of piling up inside the worker. Endpoints that
+are not assigned a class are never gated, so cheap requests such as
+reading-state updates are not starved by heavy renders.
+"""
+import functools
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from flask import jsonify, request
+
+
+DEFAULT_LIMITS = {
+    'upload': {'concurrency': 2, 'queue': 4},
+    'render': {'concurrency': 4, 'queue': 16},
+    'media': {'concurrency': 8, 'queue': 32},
+}
+
+
+class AdmissionGate:
+    """
+    Concurrency limit with a bounded wait queue for one endpoint class.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue: int):
+        """
+        Initialize the gate.
+
+        Args:
+            name: Endpoint class name
+            concurrency: Maximum number of requests running at once
+            queue: Maximum number of requests waiting for a slot
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def acquire(self, timeout: float) -> bool:
+        """
+        Try to take a slot, waiting in the queue for at most ``timeout`` seconds.
+
+        Args:
+            timeout: Maximum time to wait for a slot
+
+        Returns:
+            True if a slot was taken, False if the request was rejected
+        """
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if self.waiting >= self.queue:
+                    self.rejected_queue_full += 1
+                    return False
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+
+        with self._lock:
+            if acquired:
+                self.active += 1
+                self.admitted += 1
+            else:
+                self.rejected_timeout += 1
+        return acquired
+
+    def release(self) -> None:
+        """Release a slot taken with acquire()"""
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def snapshot(self) -> Dict[str, int]:
+        """Return the gate's configuration, queue depth and counters"""
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'queue_limit': self.queue,
+                'active': self.active,
+                'queue_depth': self.waiting,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+            }
+
+
+class AdmissionController:
+    """
+    Registry of admission gates, configured from the Flask application.
+    """
+
+    def __init__(self):
+        """Initialize the controller with the default limits."""
+        self.queue_timeout = 5.0
+        self.retry_after = 2
+        self.gates: Dict[str, AdmissionGate] = {}
+        self._configure(DEFAULT_LIMITS)
+
+    def init_app(self, app) -> None:
+        """
+        Configure gates from ADMISSION_LIMITS, ADMISSION_QUEUE_TIMEOUT and
+        ADMISSION_RETRY_AFTER.
+
+        Args:
+            app: Flask application
+        """
+        self.queue_timeout = app.config.get('ADMISSION_QUEUE_TIMEOUT', self.queue_timeout)
+        self.retry_after = app.config.get('ADMISSION_RETRY_AFTER', self.retry_after)
+        self._configure(app.config.get('ADMISSION_LIMITS', DEFAULT_LIMITS))
+
+    def _configure(self, limits: Dict[str, Dict[str, int]]) -> None:
+        """Create one gate per configured endpoint class"""
+        self.gates = {
+            name: AdmissionGate(name, limit['concurrency'], limit.get('queue', 0))
+            for name, limit in limits.items()
+        }
+
+    def limit(self, endpoint_class: str, methods: Optional[Iterable[str]] = None) -> Callable:
+        """
+        Decorate a view so it only runs when its endpoint class has capacity.
+
+        Args:
+            endpoint_class: Name of the gate guarding the view
+            methods: Optional HTTP methods to gate; other methods pass through
+
+        Returns:
+            View decorator
+        """
+        def decorator(view: Callable) -> Callable:
+            @functools.wraps(view)
+            def wrapped(*args: Any, **kwargs: Any):
+                gate = self.gates.get(endpoint_class)
+                if gate is None or (methods and request.method not in methods):
+                    return view(*args, **kwargs)
+
+                if not gate.acquire(self.queue_timeout):
+                    return self._reject(gate)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    gate.release()
+            return wrapped
+        return decorator
+
+    def _reject(self, gate: AdmissionGate):
+        """Build the 503 response for a rejected request"""
+        response = jsonify({
+            'error': 'Server busy, please retry',
+            'endpoint_class': gate.name
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """Return queue depth and rejection counters for every gate"""
+        return {name: gate.snapshot() for name, gate in self.gates.items()}
+
+
+# Shared controller used by the routes
+admission = AdmissionController()
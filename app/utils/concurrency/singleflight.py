@@ -0,0 +1,290 @@
+"""
+Single-flight request coalescing.
+
+This module lets concurrent callers asking for the same key share one in-flight
+computation instead of repeating it. Within a process, waiters block on the
+leader's event; across worker processes, the leader holds an exclusive file
+lock and publishes its result to a sidecar file that waiters read once the
+lock is released. Waiters read the result within moments of the release, so
+lock and result files older than a TTL are swept by the next leader.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+
+class _Call:
+    """State of one in-flight computation shared by the threads waiting on it."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent computations of the same key.
+
+    The first caller for a key becomes the leader and runs the computation;
+    callers that arrive while it is running wait and receive the same result
+    (or the same exception). Nothing is cached once the computation finishes.
+    """
+
+    def __init__(self, lock_dir: Optional[str] = None, result_ttl: float = 60.0):
+        """
+        Initialize the single-flight group.
+
+        Args:
+            lock_dir: Optional directory for cross-process lock and result files.
+                      Without it, coalescing only happens between threads.
+            result_ttl: Seconds lock and result files are kept after their
+                        last use; expired ones are swept at most once per TTL
+        """
+        self.lock_dir = lock_dir
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._last_sweep = time.monotonic()
+        self.stats = {'leaders': 0, 'shared': 0, 'shared_across_processes': 0, 'files_swept': 0}
+
+    def init_app(self, app) -> None:
+        """
+        Configure the group from a Flask application.
+
+        Args:
+            app: Flask application providing SINGLEFLIGHT_LOCK_DIR and
+                 SINGLEFLIGHT_RESULT_TTL
+        """
+        self.lock_dir = app.config.get('SINGLEFLIGHT_LOCK_DIR')
+        self.result_ttl = app.config.get('SINGLEFLIGHT_RESULT_TTL', self.result_ttl)
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Run ``fn`` once for all concurrent callers of ``key``.
+
+        Args:
+            key: Identifier of the computation (e.g. ``content:3:chapter1``)
+            fn: Zero-argument callable producing the result
+
+        Returns:
+            The result of the leader's computation
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            with self._lock:
+                self.stats['shared'] += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, fn)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self.stats['leaders'] += 1
+                del self._calls[key]
+            call.event.set()
+
+    def _run(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Run the computation, coalescing with other processes when configured.
+
+        Args:
+            key: Identifier of the computation
+            fn: Zero-argument callable producing the result
+
+        Returns:
+            The computed or shared result
+        """
+        if not self.lock_dir or fcntl is None:
+            return fn()
+
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        lock_path = os.path.join(self.lock_dir, f'{name}.lock')
+        result_path = os.path.join(self.lock_dir, f'{name}.json')
+
+        with open(lock_path, 'a+') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                contended = False
+            except BlockingIOError:
+                # Another process is computing this key; wait for it to finish
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                contended = True
+
+            try:
+                if contended:
+                    found, result = self._read_result(result_path, lock_file)
+                    if found:
+                        with self._lock:
+                            self.stats['shared_across_processes'] += 1
+                        return result
+
+                # Invalidate the previous token so a failure here is never
+                # mistaken for a published result by the next waiter
+                self._set_generation(lock_file, '')
+                result = fn()
+                self._write_result(result_path, lock_file, result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                self._maybe_sweep()
+
+    def _maybe_sweep(self) -> None:
+        """Sweep expired files if the last sweep is older than the TTL."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < self.result_ttl:
+                return
+            self._last_sweep = now
+        self.sweep()
+
+    def sweep(self, max_age: Optional[float] = None) -> int:
+        """
+        Remove lock and result files that have not been used for a while.
+
+        Result files are only read by the waiters of the flight that wrote
+        them, right after it. Lock files are removed only when no process
+        holds them; a process that opened one just before its removal may
+        compute its key once more instead of sharing, which is harmless.
+
+        Args:
+            max_age: Optional override of the TTL in seconds
+
+        Returns:
+            Number of files removed
+        """
+        if not self.lock_dir or fcntl is None:
+            return 0
+        cutoff = time.time() - (self.result_ttl if max_age is None else max_age)
+        removed = 0
+        try:
+            entries = list(os.scandir(self.lock_dir))
+        except OSError:
+            return 0
+
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False) or entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.name.endswith('.lock'):
+                    with open(entry.path, 'a+') as lock_file:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        os.unlink(entry.path)
+                else:
+                    os.unlink(entry.path)
+                removed += 1
+            except OSError:
+                continue
+
+        with self._lock:
+            self.stats['files_swept'] += removed
+        return removed
+
+    def _read_result(self, result_path: str, lock_file) -> tuple:
+        """
+        Read the result published by the process that held the lock before us.
+
+        The lock file records a generation token next to the result, so a result
+        left over from an earlier (finished) flight is never mistaken for the
+        one we waited on.
+
+        Args:
+            result_path: Path to the result sidecar file
+            lock_file: Open lock file holding the generation token
+
+        Returns:
+            Tuple of (found, result)
+        """
+        try:
+            lock_file.seek(0)
+            generation = lock_file.read().strip()
+            with open(result_path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            if generation and payload.get('generation') == generation and payload.get('bytes'):
+                with open(f'{result_path}.bin', 'rb') as f:
+                    return True, f.read()
+        except (OSError, ValueError):
+            return False, None
+
+        if not generation or payload.get('generation') != generation:
+            return False, None
+        return True, payload.get('value')
+
+    def _write_result(self, result_path: str, lock_file, result: Any) -> None:
+        """
+        Publish a result for processes waiting on the same key.
+
+        Bytes (rendered documents) are written as is to a ``.bin`` sidecar.
+        Other results that cannot be serialized as JSON are not shared;
+        waiting processes then compute their own.
+
+        Args:
+            result_path: Path to the result sidecar file
+            lock_file: Open lock file receiving the generation token
+            result: Result to publish
+        """
+        generation = os.urandom(8).hex()
+        try:
+            if isinstance(result, bytes):
+                fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(result)
+                os.replace(tmp_path, f'{result_path}.bin')
+                payload = json.dumps({'generation': generation, 'bytes': True})
+            else:
+                payload = json.dumps({'generation': generation, 'value': result})
+        except (TypeError, ValueError):
+            generation = ''
+            payload = None
+
+        if payload is not None:
+            fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, result_path)
+
+        self._set_generation(lock_file, generation)
+
+    def _set_generation(self, lock_file, generation: str) -> None:
+        """
+        Record the generation token of the latest published result.
+
+        Args:
+            lock_file: Open lock file
+            generation: Token matching the result sidecar, or '' for none
+        """
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(generation)
+        lock_file.flush()
+
+
+# Shared group used by the API routes
+singleflight = SingleFlight()
@@ -0,0 +1,416 @@
+"""
+Versioned artifacts derived from books, and their migration after upgrades.
+
+Everything built from a book's archive and kept between requests is an
+artifact: the text index, the stylesheet bundle, the image index, the cover
+and the reader pack. Each is stamped in ``book_artifacts`` with the version of
+the code that generated it, as reported by that code (ContentProcessor,
+MetadataExtractor, the scoping rules, ImageVariants and the pack layout). An
+upgrade that bumps one of these versions leaves the stamps behind, which makes
+the artifacts stale without touching them:
+
+- stale artifacts a request needs (stylesheet, images, cover) are rebuilt
+  on access, once for concurrent requests;
+- a background job rebuilds a few books per interval, starting with the
+  books readers open, so the library converges without a startup rebuild;
+- until then, stale artifacts keep being served where that is safe: an
+  outdated pack still serves chapters if its renderer version matches, and
+  otherwise chapters are rendered live.
+
+Progress of the migration is reported by ArtifactMigrator.progress().
+"""
+import os
+import shutil
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set
+
+from flask import current_app
+from sqlalchemy import and_, exists, func, or_
+
+from app.models.db import db
+from app.models.book import Book
+from app.models.book_artifact import BookArtifact, stamp_artifact
+from app.utils.concurrency.singleflight import singleflight
+from app.utils.content.images import ImageVariants, image_variants
+from app.utils.content.packs import pack_version, reader_packs
+from app.utils.content.stylesheets import stylesheet_bundler
+from app.utils.epub import styles
+from app.utils.epub.metadata import MetadataExtractor
+from app.utils.epub.processor import EPUBProcessor
+from app.utils.search.fulltext import book_text_index, text_index_version
+
+
+class Artifact:
+    """
+    One kind of data derived from a book.
+    """
+
+    def __init__(self, name: str, version: Callable[[], str], build: Callable[[Book, str], Any],
+                 requires=None, missing: Optional[Callable[[Book], bool]] = None):
+        """
+        Describe an artifact.
+
+        Args:
+            name: Name of the artifact in ``book_artifacts``
+            version: Function returning the version the current code builds
+            build: Function building the artifact of a book from its extracted
+                   archive; it may set columns of the book but leaves
+                   committing them to the caller
+            requires: Book column that must be set for the book to have the
+                      artifact at all (other books are left to their own backfill)
+            missing: Function telling whether a stamped artifact is gone from disk
+        """
+        self.name = name
+        self.version = version
+        self.build = build
+        self.requires = requires
+        self.missing = missing
+
+    def applies(self, book: Book) -> bool:
+        """Whether a book has this artifact"""
+        return self.requires is None or getattr(book, self.requires.key) is not None
+
+
+def extract_cover(book_id: int, extracted_path: str, covers_dir: str) -> Optional[str]:
+    """
+    Copy a book's cover image into the covers directory.
+
+    Args:
+        book_id: Book ID
+        extracted_path: Directory the EPUB was extracted to
+        covers_dir: Directory holding the covers
+
+    Returns:
+        Path to the copied cover, or None if the book declares no cover
+    """
+    extractor = MetadataExtractor()
+    opf_path = extractor.get_opf_path(os.path.join(extracted_path, 'META-INF/container.xml'))
+    metadata = extractor.extract_from_opf(os.path.join(extracted_path, opf_path))
+
+    source = metadata.get('cover')
+    if not source or not os.path.isfile(source):
+        return None
+
+    os.makedirs(covers_dir, exist_ok=True)
+    cover_path = os.path.join(covers_dir, f'{book_id}{os.path.splitext(source)[1].lower()}')
+    shutil.copyfile(source, cover_path)
+    return cover_path
+
+
+def _build_stylesheet(book: Book, extracted_path: str) -> None:
+    book.stylesheet = stylesheet_bundler.build(extracted_path)
+
+
+def _build_cover(book: Book, extracted_path: str) -> None:
+    covers_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'covers')
+    book.cover_path = extract_cover(book.id, extracted_path, covers_dir)
+
+
+def _pack_artifact_version() -> str:
+    # The pack embeds the spine, the stylesheet bundle and the image
+    # attributes, so it is outdated by any of their generators
+    return (f'{pack_version()}.{MetadataExtractor.VERSION}.{styles.VERSION}.{ImageVariants.VERSION}.'
+            f"{current_app.config['READER_ANCHOR_MODE']}")
+
+
+# Artifacts in build order: the pack is rendered with the stylesheet and images
+ARTIFACTS = (
+    Artifact('text', text_index_version,
+             lambda book, path: book_text_index.index_extracted(book.id, path),
+             requires=Book.text_indexed_at),
+    Artifact('stylesheet', lambda: f'{styles.VERSION}.{MetadataExtractor.VERSION}', _build_stylesheet,
+             missing=lambda book: bool(book.stylesheet) and not stylesheet_bundler.path(book.stylesheet)),
+    Artifact('images', lambda: str(ImageVariants.VERSION),
+             lambda book, path: image_variants.index_extracted(book.id, path)),
+    Artifact('cover', lambda: str(MetadataExtractor.VERSION), _build_cover,
+             missing=lambda book: bool(book.cover_path) and not os.path.exists(book.cover_path)),
+    Artifact('pack', _pack_artifact_version, reader_packs.build_extracted,
+             missing=lambda book: not os.path.exists(reader_packs.path(book.id))),
+)
+
+
+class ArtifactMigrator:
+    """
+    Find stale book artifacts and rebuild them, on access or in the background.
+    """
+
+    def __init__(self, artifacts: Sequence[Artifact] = ARTIFACTS, rebuild_interval: float = 0,
+                 rebuild_batch: int = 2):
+        """
+        Initialize the migrator.
+
+        Args:
+            artifacts: Artifacts in build order
+            rebuild_interval: Seconds between background rebuild runs (0 disables them)
+            rebuild_batch: Books rebuilt per run
+        """
+        self.artifacts = {artifact.name: artifact for artifact in artifacts}
+        self.rebuild_interval = rebuild_interval
+        self.rebuild_batch = rebuild_batch
+        self.app = None
+        self.base_url: Optional[str] = None
+        self.last_run: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._queued: Dict[int, None] = {}
+        self._failed: Set[int] = set()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {'runs': 0, 'books_rebuilt': 0, 'artifacts_rebuilt': 0, 'lazy_rebuilds': 0, 'failures': 0}
+
+    def init_app(self, app) -> None:
+        """
+        Configure the migrator from ARTIFACT_* settings and start the background job.
+
+        Args:
+            app: Flask application; packs rebuilt in the background link their
+                 assets under ARTIFACT_BASE_URL, which defaults to SERVER_NAME
+                 and APPLICATION_ROOT
+        """
+        self.stop()
+        self.app = app
+        self.base_url = app.config.get('ARTIFACT_BASE_URL')
+        self.rebuild_interval = app.config.get('ARTIFACT_REBUILD_INTERVAL', self.rebuild_interval)
+        self.rebuild_batch = app.config.get('ARTIFACT_REBUILD_BATCH', self.rebuild_batch)
+        # Book IDs are only meaningful within one application's database
+        with self._lock:
+            self._queued = {}
+            self._failed = set()
+            self.last_run = None
+        if self.rebuild_interval:
+            self.start()
+
+    def stale(self, book: Book, names: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Find the stale artifacts of a book.
+
+        Args:
+            book: Book
+            names: Artifacts to check (defaults to all)
+
+        Returns:
+            Names of the artifacts that are unstamped, stamped with another
+            version or gone from disk, in build order
+        """
+        wanted = set(self.artifacts if names is None else names)
+        stamps = dict(db.session.query(BookArtifact.name, BookArtifact.version).filter_by(book_id=book.id))
+        return [
+            name for name, artifact in self.artifacts.items()
+            if name in wanted and artifact.applies(book) and (
+                stamps.get(name) != artifact.version() or (artifact.missing and artifact.missing(book))
+            )
+        ]
+
+    def derive(self, book: Book, extracted_path: str, names: Iterable[str]) -> List[str]:
+        """
+        Build artifacts of an extracted book and stamp them with their versions.
+
+        Each artifact is committed with its stamp before the next is built,
+        so a failure keeps the artifacts built before it.
+
+        Args:
+            book: Book
+            extracted_path: Directory the EPUB was extracted to
+            names: Artifacts to build; they are built in registry order
+
+        Returns:
+            Names of the artifacts built
+
+        Raises:
+            ValueError: If the book cannot be read
+            OSError: If an artifact cannot be written
+        """
+        wanted = set(names)
+        built = []
+        for name, artifact in self.artifacts.items():
+            if name not in wanted:
+                continue
+            artifact.build(book, extracted_path)
+            stamp_artifact(book.id, name, artifact.version())
+            db.session.commit()
+            built.append(name)
+            self._count('artifacts_rebuilt')
+        return built
+
+    def ensure(self, book: Book, names: Iterable[str]) -> List[str]:
+        """
+        Rebuild the stale artifacts among those a request needs.
+
+        Concurrent requests for the same book share one rebuild. A book
+        that failed to rebuild is not tried again until the process restarts.
+
+        Args:
+            book: Book
+            names: Artifacts needed
+
+        Returns:
+            Names of the artifacts rebuilt
+
+        Raises:
+            ValueError: If the book cannot be read
+            OSError: If the book's file cannot be opened
+        """
+        with self._lock:
+            if book.id in self._failed:
+                return []
+        stale = self.stale(book, names)
+        if not stale:
+            return []
+        book_id, file_path = book.id, book.file_path
+
+        def rebuild():
+            with EPUBProcessor() as processor:
+                extracted_path = processor.extract(file_path)
+                return self.derive(db.session.get(Book, book_id), extracted_path, stale)
+
+        try:
+            built = singleflight.do(f"artifacts:{book_id}:{','.join(stale)}", rebuild)
+        except (ValueError, OSError):
+            db.session.rollback()
+            with self._lock:
+                self._failed.add(book_id)
+            self._count('failures')
+            raise
+        # Requests that shared another request's rebuild read its columns again
+        db.session.expire(book)
+        self._count('lazy_rebuilds')
+        self.prioritize(book_id)
+        return built
+
+    def prioritize(self, book_id: int) -> None:
+        """Queue a book for the next background run, ahead of the rest of the library"""
+        with self._lock:
+            if book_id not in self._failed:
+                self._queued[book_id] = None
+
+    def rebuild(self, limit: Optional[int] = None) -> int:
+        """
+        Rebuild every stale artifact of queued books, then of other stale books.
+
+        Books that fail are skipped until the process restarts. Needs a
+        request context for the asset URLs of packs.
+
+        Args:
+            limit: Maximum number of books to rebuild (defaults to rebuild_batch)
+
+        Returns:
+            Number of books rebuilt
+        """
+        limit = limit or self.rebuild_batch
+        with self._lock:
+            queued = list(self._queued)[:limit]
+            for book_id in queued:
+                del self._queued[book_id]
+        books = Book.query.filter(Book.id.in_(queued)).all() if queued else []
+        if len(books) < limit:
+            query = Book.query.filter(self._stale_condition())
+            skipped = self._failed | {book.id for book in books}
+            if skipped:
+                query = query.filter(Book.id.notin_(skipped))
+            books += query.order_by(Book.id).limit(limit - len(books)).all()
+
+        rebuilt = 0
+        for book in books:
+            names = self.stale(book)
+            if not names:
+                continue
+            try:
+                with EPUBProcessor() as processor:
+                    self.derive(book, processor.extract(book.file_path), names)
+                rebuilt += 1
+                self._count('books_rebuilt')
+            except (ValueError, OSError) as e:
+                db.session.rollback()
+                with self._lock:
+                    self._failed.add(book.id)
+                self._count('failures')
+                current_app.logger.warning(f"Could not rebuild the artifacts of book {book.id}: {str(e)}")
+        with self._lock:
+            self.stats['runs'] += 1
+            self.last_run = datetime.utcnow()
+        return rebuilt
+
+    def progress(self) -> Dict[str, Any]:
+        """
+        Report how far the library is from the current artifact versions.
+
+        Returns:
+            Per artifact, the current version and the number of books whose
+            artifact is up to date or stale; the number of books left to
+            rebuild, the share of artifacts up to date, and the job counters
+        """
+        artifacts = {}
+        current_total = total = 0
+        for name, artifact in self.artifacts.items():
+            version = artifact.version()
+            books = db.session.query(func.count(Book.id))
+            if artifact.requires is not None:
+                books = books.filter(artifact.requires.isnot(None))
+            eligible = books.scalar()
+            current = books.filter(self._current(name, version)).scalar()
+            artifacts[name] = {'version': version, 'current': current, 'stale': eligible - current}
+            current_total += current
+            total += eligible
+
+        with self._lock:
+            queued, failed, last_run = len(self._queued), len(self._failed), self.last_run
+        return {
+            'artifacts': artifacts,
+            'stale_books': db.session.query(func.count(Book.id)).filter(self._stale_condition()).scalar(),
+            'percent': round(100.0 * current_total / total, 1) if total else 100.0,
+            'queued': queued,
+            'failed': failed,
+            'running': bool(self._thread and self._thread.is_alive()),
+            'last_run': last_run.isoformat() if last_run else None,
+            **self.stats,
+        }
+
+    def _current(self, name: str, version: str):
+        """SQL condition: a book's artifact is stamped with a version"""
+        return exists().where(
+            BookArtifact.book_id == Book.id, BookArtifact.name == name, BookArtifact.version == version
+        )
+
+    def _stale_condition(self):
+        """SQL condition: a book has an unstamped or outdated artifact"""
+        conditions = []
+        for name, artifact in self.artifacts.items():
+            condition = ~self._current(name, artifact.version())
+            if artifact.requires is not None:
+                condition = and_(artifact.requires.isnot(None), condition)
+            conditions.append(condition)
+        return or_(*conditions)
+
+    def start(self) -> None:
+        """Start the background rebuild thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='epubar-artifact-rebuild', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background rebuild thread."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self) -> None:
+        """Rebuild a few books per interval until stopped."""
+        while not self._stop.wait(self.rebuild_interval):
+            try:
+                # Asset URLs are built with url_for, which needs a request
+                # context rooted where the application is served
+                with self.app.test_request_context(base_url=self.base_url):
+                    self.rebuild()
+            except Exception as e:
+                self.app.logger.error(f"Error rebuilding book artifacts: {str(e)}")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+
+# Shared migrator used at ingest, by the API routes and in the background
+artifact_migrator = ArtifactMigrator()
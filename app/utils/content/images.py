@@ -0,0 +1,251 @@
+"""
+Responsive variants of book images.
+
+At ingest the raster images of a book are indexed once: their archive path,
+content hash and intrinsic size go to ``book_images``. Rendering a chapter
+then gives every indexed ``img`` its dimensions, a ``srcset`` of size-capped
+variants and lazy loading without opening a single image. A variant is
+created from the archive member on its first request, transcoded to WebP (or
+JPEG where Pillow lacks WebP support), and cached under the image's content
+hash, so books sharing an image share its variants.
+
+Animated images and formats Pillow cannot read (such as SVG) are not indexed
+and keep their markup.
+"""
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from PIL import Image, features
+from sqlalchemy import delete, insert, update
+
+from app.models.db import db
+from app.models.book import Book
+from app.models.book_image import BookImage
+from app.utils.epub.processor import EPUBProcessor
+
+# Archive members considered for indexing
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
+
+# Variant file names: <SHA-256 of the source>-<width>.<format>
+VARIANT_NAME = re.compile(r'^([0-9a-f]{64})-(\d+)\.(webp|jpeg)$')
+
+# Displayed width of images in the reader column (see .page-content in reader.css)
+IMAGE_SIZES = '(max-width: 800px) 100vw, 800px'
+
+
+class ImageVariants:
+    """
+    Index book images and serve size-capped variants of them.
+    """
+
+    # Version of the image index; bump it with every change to what indexing records
+    VERSION = 1
+
+    def __init__(self, cache_dir: Optional[str] = None, widths: Sequence[int] = (480, 960, 1600),
+                 quality: int = 80):
+        """
+        Initialize the variant store.
+
+        Args:
+            cache_dir: Directory caching rendered variants
+            widths: Widths of the variants offered for each image, ascending
+            quality: Encoder quality of the variants (1-100)
+        """
+        self.cache_dir = cache_dir
+        self.widths = tuple(sorted(widths))
+        self.quality = quality
+        self.format = 'webp' if features.check('webp') else 'jpeg'
+        self._lock = threading.Lock()
+        self.stats = {'images_indexed': 0, 'variants_rendered': 0, 'variant_bytes_in': 0, 'variant_bytes_out': 0}
+
+    def init_app(self, app) -> None:
+        """
+        Configure the store from IMAGE_* settings.
+
+        Args:
+            app: Flask application; without IMAGE_CACHE_DIR, variants are kept
+                 in an ``images`` directory in UPLOAD_FOLDER
+        """
+        self.cache_dir = (app.config.get('IMAGE_CACHE_DIR')
+                          or os.path.join(app.config['UPLOAD_FOLDER'], 'images'))
+        self.widths = tuple(sorted(app.config.get('IMAGE_WIDTHS', self.widths)))
+        self.quality = app.config.get('IMAGE_QUALITY', self.quality)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def index_extracted(self, book_id: int, extracted_path: str) -> int:
+        """
+        Index the raster images of an extracted book, replacing earlier entries.
+
+        Only image headers are decoded, so indexing stays cheap for large scans.
+
+        Args:
+            book_id: Book ID
+            extracted_path: Directory the EPUB was extracted to
+
+        Returns:
+            Number of images indexed
+        """
+        rows: List[Dict[str, Any]] = []
+        for directory, _, files in os.walk(extracted_path):
+            for filename in sorted(files):
+                if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, filename)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                try:
+                    with Image.open(io.BytesIO(data)) as image:
+                        if getattr(image, 'is_animated', False):
+                            continue
+                        width, height = image.size
+                except (OSError, ValueError, Image.DecompressionBombError):
+                    continue
+                rows.append({
+                    'book_id': book_id,
+                    'path': os.path.relpath(path, extracted_path).replace(os.sep, '/'),
+                    'digest': hashlib.sha256(data).hexdigest(),
+                    'width': width,
+                    'height': height,
+                })
+
+        session = db.session
+        session.execute(delete(BookImage).where(BookImage.book_id == book_id))
+        if rows:
+            session.execute(insert(BookImage), rows)
+        session.execute(update(Book).where(Book.id == book_id).values(images_indexed_at=datetime.utcnow()))
+        session.commit()
+        with self._lock:
+            self.stats['images_indexed'] += len(rows)
+        return len(rows)
+
+    def variant_widths(self, width: int) -> List[int]:
+        """
+        Widths of the variants offered for an image.
+
+        Args:
+            width: Intrinsic width of the image
+
+        Returns:
+            The image's width capped at the largest configured width,
+            preceded by the configured widths below it
+        """
+        largest = min(width, self.widths[-1])
+        return [w for w in self.widths if w < largest] + [largest]
+
+    def variant_name(self, digest: str, width: int) -> str:
+        """Name of the variant of an image at a width"""
+        return f'{digest}-{width}.{self.format}'
+
+    def reader_images(self, book_id: int, url: Callable[[str], str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Build the attributes of every indexed image of a book for rendering.
+
+        Args:
+            book_id: Book ID
+            url: Function returning the URL of a variant name
+
+        Returns:
+            Dictionary mapping archive paths to the ``src``, ``srcset``,
+            ``sizes``, ``width`` and ``height`` of the image's ``img`` tags
+        """
+        images = {}
+        rows = db.session.query(BookImage.path, BookImage.digest, BookImage.width, BookImage.height)
+        for path, digest, width, height in rows.filter(BookImage.book_id == book_id):
+            widths = self.variant_widths(width)
+            images[path] = {
+                'src': url(self.variant_name(digest, widths[-1])),
+                'srcset': ', '.join(f'{url(self.variant_name(digest, w))} {w}w' for w in widths),
+                'sizes': IMAGE_SIZES,
+                'width': width,
+                'height': height,
+            }
+        return images
+
+    def locate_variant(self, book_id: int, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Resolve a requested variant of one of a book's images.
+
+        Args:
+            book_id: Book ID
+            name: Variant name as built by variant_name()
+
+        Returns:
+            Dictionary with the variant's cache ``path`` (which may not exist
+            yet), the source's archive ``member``, its ``digest`` and the
+            variant ``width``; None unless the book has the image and offers
+            that width
+        """
+        match = VARIANT_NAME.match(name)
+        if not match or match.group(3) != self.format or not self.cache_dir:
+            return None
+        digest, width = match.group(1), int(match.group(2))
+        row = BookImage.query.filter_by(book_id=book_id, digest=digest).first()
+        if row is None or width not in self.variant_widths(row.width):
+            return None
+        return {'path': os.path.join(self.cache_dir, name), 'member': row.path, 'digest': digest, 'width': width}
+
+    def render_variant(self, epub_path: str, member: str, path: str, width: int) -> str:
+        """
+        Create a variant from its source in the archive, unless it is cached.
+
+        Args:
+            epub_path: Path to the EPUB file
+            member: Archive member of the source image
+            path: Cache path of the variant
+            width: Maximum width of the variant
+
+        Returns:
+            Path of the variant
+
+        Raises:
+            ValueError: If the source cannot be read or decoded
+        """
+        if os.path.exists(path):
+            return path
+        try:
+            with zipfile.ZipFile(epub_path) as epub:
+                data = EPUBProcessor().read_member(epub, member)
+            output = self._transcode(data, width)
+        except (KeyError, OSError, zipfile.BadZipFile, Image.DecompressionBombError) as e:
+            raise ValueError(f"Cannot render image {member}: {e}")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(output)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.stats['variants_rendered'] += 1
+            self.stats['variant_bytes_in'] += len(data)
+            self.stats['variant_bytes_out'] += len(output)
+        return path
+
+    def _transcode(self, data: bytes, width: int) -> bytes:
+        """Scale an image down to a width and encode it in the variant format"""
+        with Image.open(io.BytesIO(data)) as image:
+            height = max(1, round(image.height * width / image.width))
+            # JPEG sources decode at a reduced scale when that is enough
+            image.draft('RGB', (width, height))
+            transparent = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if transparent else 'RGB')
+            if image.width > width:
+                image = image.resize((width, height), Image.LANCZOS)
+            if transparent and self.format == 'jpeg':
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+
+            buffer = io.BytesIO()
+            image.save(buffer, self.format.upper(), quality=self.quality)
+            return buffer.getvalue()
+
+
+# Shared variant store used by the upload and API routes
+image_variants = ImageVariants()
@@ -0,0 +1,320 @@
+"""
+Reader packs: every rendered chapter of a book in one memory-mapped file.
+
+A pack is written at ingest and holds each spine item exactly as the content
+endpoint would render it, optionally with a gzip encoding of it next to it.
+Serving maps the file once and answers chapter requests with slices of the
+mapping, without parsing, rendering or copying. Layout (little-endian):
+
+    header  magic, pack version, anchor mode, entry count, length of the IDs
+    ids     spine item IDs, UTF-8, separated by newlines
+    index   per entry: offset and length of the chapter, offset and length
+            of its gzip encoding (both 0 without one)
+    data    chapters
+
+The pack version combines the layout version with ContentProcessor.VERSION.
+Packs of another version or anchoring mode are ignored and chapters are then
+rendered on request; rebuilding outdated packs is left to the artifact
+migration (see artifacts.py).
+"""
+import gzip
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app, url_for
+
+from app.models.db import db
+from app.models.book import Book
+from app.utils.content.images import image_variants
+from app.utils.content.workers import ChapterUnavailable, parser_pool
+from app.utils.epub.content import ANCHOR_MODES, ContentProcessor
+from app.utils.epub.metadata import MetadataExtractor
+
+MAGIC = b'EPUBARPK'
+
+# Version of the pack layout
+PACK_FORMAT = 1
+
+_HEADER = struct.Struct('<8sIBxII')
+_ENTRY = struct.Struct('<QIQI')
+
+
+def pack_version() -> int:
+    """Version stamped on packs; it changes with the layout and with the renderer"""
+    return PACK_FORMAT * 10000 + ContentProcessor.VERSION
+
+
+def reader_assets(book: Book) -> Tuple[Optional[str], Dict[str, Dict[str, Any]]]:
+    """
+    URLs of the stylesheet bundle and image variants a book's chapters link.
+
+    Args:
+        book: Book whose stylesheet and images are prepared
+
+    Returns:
+        Tuple of (stylesheet URL or None, image attributes by archive path)
+    """
+    stylesheet_url = url_for('api.get_stylesheet', name=book.stylesheet) if book.stylesheet else None
+    book_id = book.id
+    images = image_variants.reader_images(
+        book_id, lambda name: url_for('api.get_book_image', book_id=book_id, name=name)
+    )
+    return stylesheet_url, images
+
+
+class ReaderPack:
+    """
+    Read-only view of a pack file.
+
+    The file is mapped once; chapters are returned as memoryviews of the
+    mapping, which stays valid after the file is replaced on disk.
+    """
+
+    def __init__(self, path: str):
+        """
+        Map a pack file and read its index.
+
+        Args:
+            path: Path of the pack
+
+        Raises:
+            ValueError: If the file is not a pack
+            OSError: If the file cannot be read
+        """
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            if stat.st_size < _HEADER.size:
+                raise ValueError(f"Not a reader pack: {path}")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, mode, count, ids_length = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or mode >= len(ANCHOR_MODES):
+            raise ValueError(f"Not a reader pack: {path}")
+        self.anchor_mode = ANCHOR_MODES[mode]
+        ids = bytes(self._map[_HEADER.size:_HEADER.size + ids_length]).decode('utf-8').split('\n')
+        index_start = _HEADER.size + ids_length
+        self._entries = {
+            item_id: _ENTRY.unpack_from(self._map, index_start + number * _ENTRY.size)
+            for number, item_id in enumerate(ids[:count])
+        }
+        self._view = memoryview(self._map)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def chapter(self, item_id: str, encoded: bool = False) -> Optional[Tuple[memoryview, Optional[str]]]:
+        """
+        Look up a rendered chapter.
+
+        Args:
+            item_id: Spine item ID
+            encoded: Whether the client accepts gzip
+
+        Returns:
+            Tuple of (chapter bytes, content encoding or None), or None if
+            the pack has no such item
+        """
+        entry = self._entries.get(item_id)
+        if entry is None:
+            return None
+        offset, length, gzip_offset, gzip_length = entry
+        if encoded and gzip_length:
+            return self._view[gzip_offset:gzip_offset + gzip_length], 'gzip'
+        return self._view[offset:offset + length], None
+
+
+def write_pack(path: str, chapters: List[Tuple[str, bytes]], version: int, anchor_mode: str,
+               compress: bool = True) -> int:
+    """
+    Write a pack file, replacing any previous one atomically.
+
+    Args:
+        path: Path of the pack
+        chapters: (spine item ID, rendered chapter) pairs in spine order
+        version: Pack version
+        anchor_mode: Anchoring mode the chapters were rendered with
+        compress: Whether to store a gzip encoding of every chapter
+
+    Returns:
+        Size of the pack in bytes
+    """
+    ids = '\n'.join(item_id for item_id, _ in chapters).encode('utf-8')
+    offset = _HEADER.size + len(ids) + len(chapters) * _ENTRY.size
+    index = []
+    blobs = []
+    for _, data in chapters:
+        encoded = gzip.compress(data, compresslevel=9, mtime=0) if compress else b''
+        index.append(_ENTRY.pack(offset, len(data), offset + len(data) if encoded else 0, len(encoded)))
+        blobs.extend((data, encoded))
+        offset += len(data) + len(encoded)
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, version, ANCHOR_MODES.index(anchor_mode), len(chapters), len(ids)))
+        f.write(ids)
+        f.writelines(index)
+        f.writelines(blobs)
+    os.replace(tmp_path, path)
+    return offset
+
+
+class ReaderPacks:
+    """
+    Build and map the reader packs of the library.
+    """
+
+    def __init__(self, pack_dir: Optional[str] = None, compress: bool = True, max_open: int = 256):
+        """
+        Initialize the pack store.
+
+        Args:
+            pack_dir: Directory holding the packs
+            compress: Whether packs store gzip encodings of the chapters
+            max_open: Number of packs kept mapped; the least recently read
+                      are unmapped beyond it
+        """
+        self.pack_dir = pack_dir
+        self.compress = compress
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._packs: 'OrderedDict[int, ReaderPack]' = OrderedDict()
+        self.stats = {
+            'hits': 0, 'misses': 0, 'stale': 0, 'packs_built': 0, 'bytes_written': 0, 'chapters_skipped': 0,
+            'evictions': 0,
+        }
+
+    def init_app(self, app) -> None:
+        """
+        Configure the store from READER_PACK_* settings.
+
+        Args:
+            app: Flask application; without READER_PACK_DIR, packs are kept in
+                 a ``packs`` directory in UPLOAD_FOLDER
+        """
+        self.pack_dir = app.config.get('READER_PACK_DIR') or os.path.join(app.config['UPLOAD_FOLDER'], 'packs')
+        self.compress = app.config.get('READER_PACK_GZIP', self.compress)
+        self.max_open = app.config.get('READER_PACK_MAX_OPEN', self.max_open)
+        # Book IDs are only meaningful within one application's database
+        with self._lock:
+            self._packs = OrderedDict()
+        os.makedirs(self.pack_dir, exist_ok=True)
+
+    def path(self, book_id: int) -> str:
+        """Path of a book's pack"""
+        return os.path.join(self.pack_dir, f'{book_id}.pack')
+
+    def chapter(self, book_id: int, item_id: str, anchor_mode: str,
+                encoded: bool = False) -> Optional[Tuple[memoryview, Optional[str]]]:
+        """
+        Look up a chapter in a book's current pack.
+
+        Args:
+            book_id: Book ID
+            item_id: Spine item ID
+            anchor_mode: Anchoring mode the chapter must be rendered with
+            encoded: Whether the client accepts gzip
+
+        Returns:
+            Tuple of (chapter bytes, content encoding or None), or None if
+            the chapter must be rendered
+        """
+        pack = self._open(book_id)
+        if pack is None or pack.version != pack_version() or pack.anchor_mode != anchor_mode:
+            self._count('misses' if pack is None else 'stale')
+            return None
+        chapter = pack.chapter(item_id, encoded)
+        self._count('hits' if chapter else 'misses')
+        return chapter
+
+    def _open(self, book_id: int) -> Optional[ReaderPack]:
+        """Return the mapped pack of a book, remapping it if the file was replaced"""
+        path = self.path(book_id)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            pack = self._packs.get(book_id)
+            if pack is not None and pack.identity == (stat.st_ino, stat.st_mtime_ns):
+                self._packs.move_to_end(book_id)
+                return pack
+        try:
+            pack = ReaderPack(path)
+        except (OSError, ValueError):
+            return None
+        # Least recently read packs are dropped; a mapping closes with its
+        # file as soon as no request is still sending slices of it
+        with self._lock:
+            self._packs[book_id] = pack
+            self._packs.move_to_end(book_id)
+            while len(self._packs) > self.max_open:
+                self._packs.popitem(last=False)
+                self.stats['evictions'] += 1
+        return pack
+
+    def build_extracted(self, book: Book, extracted_path: str, anchor_mode: Optional[str] = None) -> int:
+        """
+        Render every spine item of an extracted book into its pack.
+
+        Chapters are rendered by the parser pool with the book's stylesheet
+        and image variants, exactly as the content endpoint renders them.
+        Chapters that fail to render are left out rather than packed as their
+        plain-text fallback; the content endpoint renders them on request.
+        Needs a request context for the asset URLs.
+
+        Args:
+            book: Book, with its stylesheet and image index prepared
+            extracted_path: Directory the EPUB was extracted to
+            anchor_mode: Anchoring mode (defaults to READER_ANCHOR_MODE)
+
+        Returns:
+            Number of chapters packed (chapters left out are counted in
+            ``stats['chapters_skipped']``)
+
+        Raises:
+            ValueError: If the book's structure cannot be read
+        """
+        anchor_mode = anchor_mode or current_app.config['READER_ANCHOR_MODE']
+        stylesheet_url, images = reader_assets(book)
+        images = {os.path.join(extracted_path, path): attributes for path, attributes in images.items()}
+
+        extractor = MetadataExtractor()
+        opf_path = extractor.get_opf_path(os.path.join(extracted_path, 'META-INF/container.xml'))
+        opf_dir = os.path.dirname(os.path.join(extracted_path, opf_path))
+        chapters = []
+        for item in extractor.get_spine_items(os.path.join(extracted_path, opf_path)):
+            if not os.path.isfile(item['href']):
+                continue
+            try:
+                chapters.append((item['id'], parser_pool.process_content(
+                    item['href'], opf_dir, add_data_attributes=True, anchor_mode=anchor_mode,
+                    stylesheet_url=stylesheet_url, images=images, book_id=book.id, fallback=False
+                )))
+            except ChapterUnavailable as e:
+                self._count('chapters_skipped')
+                current_app.logger.warning(f"Leaving chapter {item['id']} of book {book.id} out of its pack: {e}")
+
+        version = pack_version()
+        size = write_pack(self.path(book.id), chapters, version, anchor_mode, self.compress)
+        book.pack_version = version
+        db.session.commit()
+        with self._lock:
+            self.stats['packs_built'] += 1
+            self.stats['bytes_written'] += size
+        return len(chapters)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+
+# Shared pack store used at ingest and by the content endpoint
+reader_packs = ReaderPacks()
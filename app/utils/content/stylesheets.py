@@ -0,0 +1,157 @@
+"""
+Per-book stylesheet bundles.
+
+A book's stylesheets, embedded style elements and inline style attributes are
+collected once, scoped to the reader's chapter element (see
+utils/epub/styles.py) and written as a single minified bundle named after its
+content. Chapters link the bundle, so a book costs one cacheable stylesheet
+request however many files its CSS was split into.
+"""
+import hashlib
+import html
+import os
+import re
+import tempfile
+from typing import List, Optional
+from urllib.parse import unquote
+
+from app.utils.epub.encoding import decode_markup
+from app.utils.epub.metadata import MetadataExtractor
+from app.utils.epub.styles import bundle_stylesheets
+
+# Stylesheet links and style elements, in document order
+_STYLE_SOURCES = re.compile(r'<link\b([^>]*)>|<style\b[^>]*>(.*?)</style\s*>', re.IGNORECASE | re.DOTALL)
+_LINK_ATTRIBUTE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+_STYLE_ATTRIBUTE = re.compile(r'<[A-Za-z][^>]*?\sstyle\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+
+# Bundle names: the first 16 hex digits of the bundle's SHA-256
+BUNDLE_NAME = re.compile(r'^[0-9a-f]{16}\.css$')
+
+
+class StylesheetBundler:
+    """
+    Build and store the scoped stylesheet bundle of each book.
+
+    Bundles are content-addressed, so books sharing their CSS share a file
+    and a rebuilt bundle never replaces one a client may have cached.
+    """
+
+    def __init__(self, bundle_dir: Optional[str] = None):
+        """
+        Initialize the bundler.
+
+        Args:
+            bundle_dir: Directory holding the bundles
+        """
+        self.bundle_dir = bundle_dir
+
+    def init_app(self, app) -> None:
+        """
+        Configure the bundle directory from STYLESHEET_DIR.
+
+        Args:
+            app: Flask application; without STYLESHEET_DIR, bundles are kept
+                 in a ``stylesheets`` directory in UPLOAD_FOLDER
+        """
+        self.bundle_dir = (app.config.get('STYLESHEET_DIR')
+                           or os.path.join(app.config['UPLOAD_FOLDER'], 'stylesheets'))
+        os.makedirs(self.bundle_dir, exist_ok=True)
+
+    def build(self, extracted_path: str) -> str:
+        """
+        Bundle the styles of an extracted book.
+
+        Stylesheets are taken in the order the spine's documents first link
+        or embed them, followed by one rule per distinct inline style.
+
+        Args:
+            extracted_path: Root of the extracted EPUB
+
+        Returns:
+            Name of the bundle, or '' if the book has no usable styles
+
+        Raises:
+            ValueError: If the package document cannot be read
+        """
+        extractor = MetadataExtractor()
+        opf_path = extractor.get_opf_path(os.path.join(extracted_path, 'META-INF/container.xml'))
+        spine_items = extractor.get_spine_items(os.path.join(extracted_path, opf_path))
+
+        stylesheets: List[str] = []
+        inline_styles: List[str] = []
+        for item in spine_items:
+            try:
+                with open(item['href'], 'rb') as f:
+                    markup = decode_markup(f.read())
+            except OSError:
+                continue
+            stylesheets.extend(self._document_stylesheets(markup, item['href'], extracted_path))
+            inline_styles.extend(
+                html.unescape(match.group(1) if match.group(1) is not None else match.group(2))
+                for match in _STYLE_ATTRIBUTE.finditer(markup)
+            )
+
+        bundle = bundle_stylesheets(stylesheets, inline_styles)
+        if not bundle:
+            return ''
+        data = bundle.encode('utf-8')
+        name = f'{hashlib.sha256(data).hexdigest()[:16]}.css'
+        path = os.path.join(self.bundle_dir, name)
+        if not os.path.exists(path):
+            os.makedirs(self.bundle_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.bundle_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return name
+
+    def path(self, name: str) -> Optional[str]:
+        """
+        Locate a stored bundle.
+
+        Args:
+            name: Bundle name as returned by build()
+
+        Returns:
+            Path of the bundle, or None if the name is invalid or unknown
+        """
+        if not self.bundle_dir or not BUNDLE_NAME.match(name):
+            return None
+        path = os.path.join(self.bundle_dir, name)
+        return path if os.path.isfile(path) else None
+
+    @staticmethod
+    def _document_stylesheets(markup: str, document_path: str, extracted_path: str) -> List[str]:
+        """
+        Read the stylesheets a document links or embeds, in document order.
+
+        Linked files outside the extracted book or missing from it are skipped.
+        """
+        root = os.path.realpath(extracted_path)
+        stylesheets = []
+        for match in _STYLE_SOURCES.finditer(markup):
+            if match.group(2) is not None:
+                stylesheets.append(match.group(2))
+                continue
+            attributes = {
+                name.lower(): html.unescape(next((value for value in values if value), ''))
+                for name, *values in _LINK_ATTRIBUTE.findall(match.group(1))
+            }
+            rel = attributes.get('rel', '').lower().split()
+            href = attributes.get('href', '').split('#', 1)[0]
+            # Alternate stylesheets are off unless the reader picks them
+            if 'stylesheet' not in rel or 'alternate' in rel or not href or '://' in href:
+                continue
+            path = os.path.realpath(os.path.join(os.path.dirname(document_path), unquote(href)))
+            if not path.startswith(root + os.sep):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    stylesheets.append(f.read().decode('utf-8-sig', errors='replace'))
+            except OSError:
+                continue
+        return stylesheets
+
+
+# Shared bundler used by the upload and API routes
+stylesheet_bundler = StylesheetBundler()
@@ -0,0 +1,467 @@
+"""
+Sandboxed parsing workers for chapter rendering.
+
+Chapters are rendered by ``ContentProcessor`` in separate worker processes so
+that a pathological file (deep nesting, tens of megabytes of markup) cannot pin
+a web worker or exhaust its memory. Each worker runs under an address-space
+ceiling, each task under a wall-clock timeout, and workers are recycled after a
+fixed number of tasks. Chapters that fail are rendered as plain text instead.
+Fallbacks of chapters the parser rejects are cached per renderer version and
+swept once unused for PARSER_FALLBACK_MAX_AGE; timeouts, dead workers and
+exhausted memory or stack can be transient, so their chapters are retried.
+"""
+import hashlib
+import html
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.utils.epub.content import ANCHOR_ELEMENTS, ContentProcessor
+from app.utils.epub.encoding import decode_markup
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    resource = None
+
+
+# Elements that end a paragraph in the plain-text fallback
+_BLOCK_TAGS = {
+    'p', 'div', 'br', 'li', 'tr', 'blockquote', 'pre', 'section', 'article',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+}
+
+
+class ChapterTimeout(Exception):
+    """Raised when a worker does not finish a chapter within the timeout."""
+
+
+class WorkerExited(Exception):
+    """Raised when a worker dies while rendering a chapter."""
+
+
+class ChapterUnavailable(ValueError):
+    """Raised instead of returning the plain-text fallback when callers ask for it."""
+
+
+class _PlainTextExtractor(HTMLParser):
+    """
+    Streaming text extractor used for the degraded rendering.
+
+    It never builds a tree, so its cost stays linear in the input size no
+    matter how deeply the markup nests.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs: List[str] = []
+        self._current: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style', 'head'):
+            self._skip += 1
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style', 'head'):
+            self._skip = max(self._skip - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._current.append(data)
+
+    def _flush(self):
+        text = ' '.join(''.join(self._current).split())
+        if text:
+            self.paragraphs.append(text)
+        self._current = []
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def render_plain_text(html_path: str, data: Optional[bytes] = None) -> str:
+    """
+    Render a chapter as escaped plain-text paragraphs.
+
+    Args:
+        html_path: Path to the HTML file
+        data: The file's bytes, if already read
+
+    Returns:
+        Reader HTML document containing only the chapter's text
+    """
+    if data is None:
+        with open(html_path, 'rb') as f:
+            data = f.read()
+
+    extractor = _PlainTextExtractor()
+    extractor.feed(decode_markup(data))
+    extractor.close()
+
+    body = '\n'.join(
+        f'<p class="epubar-paragraph epubar-degraded">{html.escape(text)}</p>'
+        for text in extractor.paragraphs
+    )
+    return ContentProcessor().wrap_for_reader(body)
+
+
+def _worker_main(conn, memory_limit: int) -> None:
+    """
+    Entry point of a parsing worker process.
+
+    Args:
+        conn: Pipe end receiving tasks and returning results
+        memory_limit: Address-space ceiling in bytes (0 for none)
+    """
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    processor = ContentProcessor()
+    while True:
+        try:
+            data, html_path, base_path, add_data_attributes, anchor_mode, stylesheet_url, images = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        try:
+            stats = {}
+            result = processor.process_bytes(data, html_path, base_path, add_data_attributes, anchor_mode, stats,
+                                             stylesheet_url, images)
+            conn.send(('ok', (result, stats)))
+        except (MemoryError, RecursionError) as e:
+            # Resource limits say nothing about the markup: report a crash and
+            # exit, so the chapter is tried again by a fresh worker
+            conn.send(('crash', f'{type(e).__name__}: {e}'))
+            break
+        except BaseException as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+
+class _Worker:
+    """Handle on one worker process and its pipe."""
+
+    def __init__(self, context, memory_limit: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self) -> None:
+        """Terminate the worker process."""
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=1)
+
+
+class ParserPool:
+    """
+    Pool of sandboxed processes rendering chapters with ``ContentProcessor``.
+
+    With a size of 0 the pool renders in the calling process; the plain-text
+    fallback and its cache still apply.
+    """
+
+    def __init__(self, size: int = 0, timeout: float = 20.0,
+                 memory_limit: int = 512 * 1024 * 1024, max_tasks: int = 50,
+                 fallback_dir: Optional[str] = None, fallback_max_age: float = 7 * 24 * 3600.0):
+        """
+        Initialize the pool.
+
+        Args:
+            size: Number of worker processes (0 renders in-process)
+            timeout: Wall-clock seconds allowed per chapter
+            memory_limit: Address-space ceiling per worker in bytes
+            max_tasks: Tasks a worker handles before it is replaced
+            fallback_dir: Directory caching plain-text fallbacks
+            fallback_max_age: Seconds a cached fallback is kept after its last use
+        """
+        self.size = size
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+        self.fallback_dir = fallback_dir
+        self.fallback_max_age = fallback_max_age
+        self._last_sweep = time.monotonic()
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._idle: List[_Worker] = []
+        self._slots = threading.Semaphore(max(size, 1))
+        self.stats = {
+            'rendered': 0, 'timeouts': 0, 'failures': 0,
+            'fallbacks_served': 0, 'fallbacks_swept': 0, 'workers_started': 0, 'workers_recycled': 0,
+            'bytes_out': 0, 'bytes_saved': 0,
+        }
+        # Output size and minification savings of chapters this process rendered, per book
+        self.book_stats: Dict[int, Dict[str, int]] = {}
+
+    def init_app(self, app) -> None:
+        """
+        Configure the pool from PARSER_POOL_* settings.
+
+        Args:
+            app: Flask application
+        """
+        self.shutdown()
+        self.size = app.config.get('PARSER_POOL_SIZE', self.size)
+        self.timeout = app.config.get('PARSER_POOL_TIMEOUT', self.timeout)
+        self.memory_limit = app.config.get('PARSER_POOL_MEMORY_LIMIT', self.memory_limit)
+        self.max_tasks = app.config.get('PARSER_POOL_MAX_TASKS', self.max_tasks)
+        self.fallback_dir = app.config.get('PARSER_FALLBACK_DIR', self.fallback_dir)
+        self.fallback_max_age = app.config.get('PARSER_FALLBACK_MAX_AGE', self.fallback_max_age)
+        self._slots = threading.Semaphore(max(self.size, 1))
+        # Book IDs are only meaningful within one application's database
+        self.book_stats = {}
+        if self.fallback_dir:
+            os.makedirs(self.fallback_dir, exist_ok=True)
+
+    def process_content(self, html_path: str, base_path: str,
+                        add_data_attributes: bool = False,
+                        anchor_mode: str = ANCHOR_ELEMENTS,
+                        book_id: Optional[int] = None,
+                        stylesheet_url: Optional[str] = None,
+                        images: Optional[Dict[str, Dict[str, Any]]] = None,
+                        fallback: bool = True) -> bytes:
+        """
+        Render a chapter, falling back to plain text if rendering fails.
+
+        Args:
+            html_path: Path to the HTML file
+            base_path: Base path for resolving relative URLs
+            add_data_attributes: Whether to add data attributes for annotation support
+            anchor_mode: Elements receiving data attributes (see ContentProcessor)
+            book_id: Book the chapter belongs to, for per-book output statistics
+            stylesheet_url: URL of the book's stylesheet bundle, if it has one
+            images: Attributes of the book's indexed images, by file path
+            fallback: Whether to return the plain-text fallback of a chapter
+                      that fails; callers storing the result disable it
+
+        Returns:
+            UTF-8 encoded reader document, ready to send
+
+        Raises:
+            OSError: If the chapter cannot be read
+            ChapterUnavailable: If rendering failed and fallback is disabled
+        """
+        with open(html_path, 'rb') as f:
+            data = f.read()
+
+        try:
+            if self.size > 0:
+                result, stats = self._run_in_worker(data, html_path, base_path, add_data_attributes, anchor_mode,
+                                                    stylesheet_url, images)
+            else:
+                stats = {}
+                result = ContentProcessor().process_bytes(data, html_path, base_path, add_data_attributes,
+                                                          anchor_mode, stats, stylesheet_url, images)
+            self._count('rendered')
+            self._record_output(book_id, stats)
+            return result
+        except (ChapterTimeout, WorkerExited, MemoryError, RecursionError) as e:
+            # Resource limits: the chapter may render next time, so nothing is cached
+            self._count('timeouts' if isinstance(e, ChapterTimeout) else 'failures')
+            if not fallback:
+                raise ChapterUnavailable(f"Cannot render {html_path}: {e}")
+            fallback_path = None
+        except ValueError as e:
+            # The parser rejects this chapter: the same bytes fail every time
+            self._count('failures')
+            if not fallback:
+                raise ChapterUnavailable(f"Cannot render {html_path}: {e}")
+            fallback_path = self._fallback_path(data)
+            if fallback_path and os.path.exists(fallback_path):
+                with open(fallback_path, 'rb') as f:
+                    self._count('fallbacks_served')
+                    cached = f.read()
+                # Keep fallbacks in use from being swept
+                os.utime(fallback_path)
+                return cached
+
+        fallback = render_plain_text(html_path, data).encode('utf-8')
+        if fallback_path:
+            fd, tmp_path = tempfile.mkstemp(dir=self.fallback_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(fallback)
+            os.replace(tmp_path, fallback_path)
+            self._maybe_sweep()
+        self._count('fallbacks_served')
+        return fallback
+
+    def _run_in_worker(self, data: bytes, html_path: str, base_path: str,
+                       add_data_attributes: bool, anchor_mode: str,
+                       stylesheet_url: Optional[str] = None,
+                       images: Optional[Dict[str, Dict[str, Any]]] = None) -> Tuple[bytes, Dict[str, int]]:
+        """
+        Dispatch a chapter to a worker process and wait for the result.
+
+        Returns:
+            Tuple of (UTF-8 encoded reader document, output statistics)
+
+        Raises:
+            ChapterTimeout: If the worker does not answer within the timeout
+            WorkerExited: If the worker died or hit a resource limit while rendering
+            ValueError: If the worker failed to render the chapter
+        """
+        with self._slots:
+            worker = self._checkout()
+            try:
+                worker.conn.send((data, html_path, base_path, add_data_attributes, anchor_mode, stylesheet_url,
+                                  images))
+                if not worker.conn.poll(self.timeout):
+                    raise ChapterTimeout(f"Rendering exceeded {self.timeout}s")
+                status, payload = worker.conn.recv()
+            except ChapterTimeout:
+                worker.stop()
+                raise
+            except (EOFError, OSError) as e:
+                # The worker died, most likely by hitting its memory ceiling
+                worker.stop()
+                raise WorkerExited(f"Parsing worker exited: {e}")
+
+            if status == 'crash':
+                # The worker exits after a resource limit
+                worker.stop()
+                self._count('workers_recycled')
+                raise WorkerExited(f"Parsing worker hit a resource limit: {payload}")
+            worker.tasks += 1
+            self._checkin(worker)
+
+        if status != 'ok':
+            raise ValueError(payload)
+        return payload
+
+    def _checkout(self) -> _Worker:
+        """Take an idle worker or start a new one."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.stats['workers_started'] += 1
+        return _Worker(self._context, self.memory_limit)
+
+    def _checkin(self, worker: _Worker) -> None:
+        """Return a worker to the idle list, recycling it after max_tasks."""
+        if worker.tasks >= self.max_tasks or not worker.process.is_alive():
+            worker.stop()
+            self._count('workers_recycled')
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def _fallback_path(self, data: bytes) -> Optional[str]:
+        """
+        Content-addressed location of a chapter's cached fallback.
+
+        Keyed by the chapter's bytes, so the cache survives re-extraction into
+        a different workspace, and by the renderer version, so an upgraded
+        renderer tries the chapter again.
+        """
+        if not self.fallback_dir:
+            return None
+        return os.path.join(self.fallback_dir,
+                            f'{ContentProcessor.VERSION}-{hashlib.sha256(data).hexdigest()}.html')
+
+    def _maybe_sweep(self) -> None:
+        """Sweep the fallback cache if the last sweep is older than a tenth of the maximum age."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < self.fallback_max_age / 10:
+                return
+            self._last_sweep = now
+        self.sweep_fallbacks()
+
+    def sweep_fallbacks(self, max_age: Optional[float] = None) -> int:
+        """
+        Remove cached fallbacks of older renderer versions and those unused for a while.
+
+        Args:
+            max_age: Optional override of fallback_max_age in seconds
+
+        Returns:
+            Number of files removed
+        """
+        if not self.fallback_dir:
+            return 0
+        cutoff = time.time() - (self.fallback_max_age if max_age is None else max_age)
+        current = f'{ContentProcessor.VERSION}-'
+        removed = 0
+        try:
+            entries = list(os.scandir(self.fallback_dir))
+        except OSError:
+            return 0
+
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                # Files being written (.tmp) are kept until they are old too
+                recent = entry.stat().st_mtime >= cutoff
+                if recent and (entry.name.startswith(current) or entry.name.endswith('.tmp')):
+                    continue
+                os.unlink(entry.path)
+                removed += 1
+            except OSError:
+                continue
+
+        with self._lock:
+            self.stats['fallbacks_swept'] += removed
+        return removed
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def _record_output(self, book_id: Optional[int], stats: Dict[str, int]) -> None:
+        """Add a rendered chapter's output statistics to the totals and its book's."""
+        with self._lock:
+            self.stats['bytes_out'] += stats.get('bytes_out', 0)
+            self.stats['bytes_saved'] += stats.get('bytes_saved', 0)
+            if book_id is None:
+                return
+            totals = self.book_stats.setdefault(book_id, {'chapters': 0, 'bytes_out': 0, 'bytes_saved': 0})
+            totals['chapters'] += 1
+            totals['bytes_out'] += stats.get('bytes_out', 0)
+            totals['bytes_saved'] += stats.get('bytes_saved', 0)
+
+    def output_stats(self, book_id: int) -> Dict[str, float]:
+        """
+        Report the output size and minification savings of a book's chapters.
+
+        Args:
+            book_id: Book ID
+
+        Returns:
+            Dictionary with the number of ``chapters`` rendered, their
+            ``bytes_out``, the ``bytes_saved`` by minification and the saved
+            share of the unminified size as ``saved_percent``
+        """
+        with self._lock:
+            totals = dict(self.book_stats.get(book_id, {'chapters': 0, 'bytes_out': 0, 'bytes_saved': 0}))
+        unminified = totals['bytes_out'] + totals['bytes_saved']
+        totals['saved_percent'] = round(totals['bytes_saved'] * 100 / unminified, 1) if unminified else 0.0
+        return totals
+
+    def shutdown(self) -> None:
+        """Stop all idle workers."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+
+# Shared pool used by the API routes
+parser_pool = ParserPool()
@@ -0,0 +1,152 @@
+"""
+Benchmark of the chapter anchoring modes.
+
+Renders every chapter of an EPUB with element anchors and with block anchors
+and reports, per mode, the number of anchors, the payload size (raw and
+gzipped), the time to render the chapters and the time to build a document
+tree from the rendered markup again, which stands in for the browser's
+parsing cost.
+
+Block anchors only pay off on markup with many inline elements per block; the
+sample books are nearly span-free and render the same in both modes.
+``--span-heavy`` writes a synthetic book with eight spans per paragraph, as
+produced by converters that wrap every run of text, and benchmarks that.
+
+Usage:
+    python -m app.utils.epub.anchor_benchmark path/to/book.epub [repeat]
+    python -m app.utils.epub.anchor_benchmark --span-heavy [repeat]
+"""
+import gzip
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Callable, Dict, List
+
+from bs4 import BeautifulSoup
+
+from app.utils.epub.content import ANCHOR_MODES, ContentProcessor
+from app.utils.epub.metadata import MetadataExtractor
+from app.utils.epub.processor import EPUBProcessor
+
+
+def _best_time(fn: Callable[[], object], repeat: int) -> float:
+    """Return the fastest of ``repeat`` runs of fn, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def write_span_heavy_epub(path: str, chapters: int = 5, paragraphs: int = 200, spans: int = 8) -> str:
+    """
+    Write a synthetic EPUB whose paragraphs consist of inline spans.
+
+    Args:
+        path: Path of the EPUB to write
+        chapters: Number of chapters
+        paragraphs: Paragraphs per chapter
+        spans: Spans per paragraph
+
+    Returns:
+        The path
+    """
+    items = ''.join(
+        f'<item id="c{n}" href="c{n}.xhtml" media-type="application/xhtml+xml"/>' for n in range(chapters)
+    )
+    refs = ''.join(f'<itemref idref="c{n}"/>' for n in range(chapters))
+    paragraph = '<p>' + ' '.join(
+        f'<span class="s{i % 3}">Words of run {i} in a converted paragraph.</span>' for i in range(spans)
+    ) + '</p>\n'
+    with zipfile.ZipFile(path, 'w') as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml',
+                      '<?xml version="1.0"?><container version="1.0" '
+                      'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                      '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                      '</rootfiles></container>')
+        epub.writestr('OEBPS/content.opf',
+                      '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+                      '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Spans</dc:title>'
+                      f'</metadata><manifest>{items}</manifest><spine>{refs}</spine></package>')
+        for n in range(chapters):
+            epub.writestr(f'OEBPS/c{n}.xhtml',
+                          '<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml">'
+                          f'<head><title>Chapter {n}</title></head><body><h1>Chapter {n}</h1>\n'
+                          f'{paragraph * paragraphs}</body></html>')
+    return path
+
+
+def compare_anchor_modes(epub_path: str, repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Render a book in every anchoring mode and measure the results.
+
+    Args:
+        epub_path: Path to the EPUB file
+        repeat: Runs per measurement; the fastest is kept
+
+    Returns:
+        Dictionary mapping each mode to its ``anchors``, ``bytes``,
+        ``gzip_bytes``, ``render_seconds`` and ``parse_seconds``
+    """
+    processor = ContentProcessor()
+    extractor = MetadataExtractor()
+    results = {}
+    with EPUBProcessor() as epub:
+        extracted_path = epub.extract(epub_path)
+        opf_path = extractor.get_opf_path(os.path.join(extracted_path, 'META-INF/container.xml'))
+        opf_dir = os.path.dirname(os.path.join(extracted_path, opf_path))
+        chapters = [
+            item['href'] for item in extractor.get_spine_items(os.path.join(extracted_path, opf_path))
+            if os.path.isfile(item['href'])
+        ]
+
+        for mode in ANCHOR_MODES:
+            rendered: List[str] = []
+
+            def render():
+                rendered[:] = [processor.process_content(path, opf_dir, True, mode) for path in chapters]
+
+            def parse():
+                for html in rendered:
+                    BeautifulSoup(html, 'html.parser')
+
+            render_seconds = _best_time(render, repeat)
+            payload = [html.encode('utf-8') for html in rendered]
+            results[mode] = {
+                'anchors': sum(html.count('data-epubar-id=') for html in rendered),
+                'bytes': sum(len(data) for data in payload),
+                'gzip_bytes': sum(len(gzip.compress(data)) for data in payload),
+                'render_seconds': render_seconds,
+                'parse_seconds': _best_time(parse, repeat),
+            }
+    return results
+
+
+def main(argv: List[str]) -> int:
+    """Print the comparison for the EPUB named on the command line."""
+    if not argv:
+        print(__doc__.strip())
+        return 2
+    repeat = int(argv[1]) if len(argv) > 1 else 3
+    if argv[0] == '--span-heavy':
+        with tempfile.TemporaryDirectory() as directory:
+            results = compare_anchor_modes(write_span_heavy_epub(os.path.join(directory, 'spans.epub')), repeat)
+    else:
+        results = compare_anchor_modes(argv[0], repeat)
+    baseline = results[ANCHOR_MODES[0]]
+    print(f"{'mode':<10}{'anchors':>10}{'bytes':>12}{'gzip':>10}{'render ms':>12}{'parse ms':>12}")
+    for mode, result in results.items():
+        print(f"{mode:<10}{result['anchors']:>10}{result['bytes']:>12}{result['gzip_bytes']:>10}"
+              f"{result['render_seconds'] * 1000:>12.1f}{result['parse_seconds'] * 1000:>12.1f}")
+    for mode, result in list(results.items())[1:]:
+        saved = 1 - result['bytes'] / baseline['bytes'] if baseline['bytes'] else 0.0
+        print(f"{mode}: {saved:.1%} smaller than {ANCHOR_MODES[0]}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,11 +4,228 @@ Content processor for EPUB files.
 This module provides functionality to process and normalize HTML content from EPUB files
 for rendering in a web application.
 """
+import io
 import os
 import re
-from bs4 import BeautifulSoup
-from typing import Dict, List, Optional
-from urllib.parse import urljoin
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup, Comment, NavigableString
+from bs4.element import PreformattedString
+from bs4.formatter import HTMLFormatter
+from html import escape
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import unquote, urljoin
+
+from app.utils.epub.encoding import SNIFF_BYTES, decode_markup, detect_encoding
+from app.utils.epub.locations import ChapterLocations
+from app.utils.epub.styles import inline_style_class
+
+
+# Elements that receive a data-epubar-id, numbered in document order
+ANNOTATABLE_TAGS = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'span', 'li']
+
+# Annotatable elements that still carry their ID with block anchors
+BLOCK_ANCHOR_TAGS = [tag for tag in ANNOTATABLE_TAGS if tag != 'span']
+
+# Anchoring modes of rendered chapters: every annotatable element carries its
+# ID, or only block-level ones do (inline positions are then located by
+# character offset within the block, see utils/reading/anchors.py)
+ANCHOR_ELEMENTS = 'elements'
+ANCHOR_BLOCKS = 'blocks'
+ANCHOR_MODES = (ANCHOR_ELEMENTS, ANCHOR_BLOCKS)
+
+# Elements whose whitespace is displayed as is
+PRESERVING_TAGS = ('pre', 'textarea')
+
+# Runs of ASCII whitespace, displayed as one space outside PRESERVING_TAGS
+_WHITESPACE_RUN = re.compile(r'[ \t\n\r\f]+')
+
+# Attribute values restating the HTML default, left out of rendered chapters
+DEFAULT_ATTRIBUTE_VALUES = {
+    ('a', 'shape'): 'rect',
+    ('col', 'span'): '1',
+    ('colgroup', 'span'): '1',
+    ('link', 'type'): 'text/css',
+    ('style', 'type'): 'text/css',
+    ('td', 'colspan'): '1',
+    ('td', 'rowspan'): '1',
+    ('th', 'colspan'): '1',
+    ('th', 'rowspan'): '1',
+}
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+# Reader document around a rendered chapter body, which is always UTF-8;
+# the chapter element carries the scope of the book's stylesheet bundle
+READER_HEAD = (
+    b'<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8">'
+    b'<meta name="viewport" content="width=device-width, initial-scale=1.0">'
+    b'<title>EPUBAR Reader</title>'
+)
+CHAPTER_CLASSES = ('epubar-chapter-content', 'epubar-content')
+READER_PREFIX = READER_HEAD + f'</head><body><div class="{" ".join(CHAPTER_CLASSES)}">'.encode('ascii')
+READER_SUFFIX = b'</div></body></html>'
+
+
+class _CanonicalFormatter(HTMLFormatter):
+    """
+    Serializer writing the smallest equivalent of a chapter's markup.
+    
+    Runs of whitespace in text collapse to one space except in preformatted
+    elements, attributes are written in sorted order with duplicate classes
+    removed, and empty class lists, empty IDs and attributes restating their
+    default are left out. The number of bytes left out is counted in
+    ``saved``.
+    """
+    
+    def __init__(self):
+        super().__init__(entity_substitution=HTMLFormatter.REGISTRY['minimal'].entity_substitution)
+        self.saved = 0
+    
+    def substitute(self, ns: str) -> str:
+        if (isinstance(ns, NavigableString) and not isinstance(ns, PreformattedString)
+                and not any(parent.name in PRESERVING_TAGS for parent in ns.parents)):
+            collapsed = _WHITESPACE_RUN.sub(' ', ns)
+            self.saved += len(ns) - len(collapsed)
+            ns = collapsed
+        return super().substitute(ns)
+    
+    def attributes(self, tag):
+        kept = []
+        for name, value in sorted(tag.attrs.items()):
+            if name == 'class' and isinstance(value, list):
+                value = list(dict.fromkeys(value))
+            if self._redundant(tag.name, name, value):
+                written = ' '.join(value) if isinstance(value, list) else value or ''
+                self.saved += len(f' {name}="{written}"'.encode('utf-8'))
+                continue
+            kept.append((name, value))
+        return kept
+    
+    @staticmethod
+    def _redundant(tag_name: str, name: str, value) -> bool:
+        if name in ('class', 'id'):
+            return not value or value == ['']
+        if name == 'xmlns':
+            return value == XHTML_NAMESPACE
+        return DEFAULT_ATTRIBUTE_VALUES.get((tag_name, name)) == value
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Incremental parser collecting the text of each annotatable element.
+    
+    Elements are numbered exactly like _add_data_attributes() numbers them,
+    so every piece of text can be located in the rendered chapter. Text is
+    attributed to the innermost open annotatable element. When given a
+    ChapterLocations, the character range of every element is recorded in it,
+    counting whitespace the way the rendered chapter collapses it.
+    """
+    
+    # Elements whose content is never displayed
+    SKIPPED_TAGS = ('script', 'style', 'head')
+    
+    PRESERVING_TAGS = PRESERVING_TAGS
+    
+    def __init__(self, locations: Optional[ChapterLocations] = None):
+        super().__init__(convert_charrefs=True)
+        self.counter = 0
+        self.stack: List[Tuple[str, str, int]] = []
+        self.skipping = 0
+        self.preserving = 0
+        self.texts: Dict[Optional[str], List[str]] = {}
+        self.order: List[Optional[str]] = []
+        self.locations = locations
+        # Whether the text since the last tag ends in collapsed whitespace
+        self.after_space = False
+    
+    def handle_starttag(self, tag, attrs):
+        self.after_space = False
+        if tag in self.SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in ANNOTATABLE_TAGS:
+            self._open(tag)
+        elif tag in self.PRESERVING_TAGS:
+            self.preserving += 1
+    
+    def handle_startendtag(self, tag, attrs):
+        self.after_space = False
+        if tag in ANNOTATABLE_TAGS:
+            self._open(tag)
+            self._close(len(self.stack) - 1)
+    
+    def handle_endtag(self, tag):
+        self.after_space = False
+        if tag in self.SKIPPED_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag in self.PRESERVING_TAGS:
+            self.preserving = max(self.preserving - 1, 0)
+        elif tag in ANNOTATABLE_TAGS:
+            # Close the innermost matching element and anything left open in it
+            for i in range(len(self.stack) - 1, -1, -1):
+                if self.stack[i][0] == tag:
+                    self._close(i)
+                    break
+    
+    def _open(self, tag):
+        if self.locations is not None:
+            self.locations.open(self.stack[-1][2] if self.stack else -1, tag in BLOCK_ANCHOR_TAGS)
+        self.stack.append((tag, f'el-{self.counter}', self.counter))
+        self.counter += 1
+    
+    def _close(self, depth):
+        if self.locations is not None:
+            for _, _, number in self.stack[depth:]:
+                self.locations.close(number)
+        del self.stack[depth:]
+    
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.locations is not None:
+            self.locations.advance(self._displayed_length(data))
+        if not data.strip():
+            return
+        element_id = self.stack[-1][1] if self.stack else None
+        if element_id not in self.texts:
+            self.texts[element_id] = []
+            self.order.append(element_id)
+        self.texts[element_id].append(data)
+    
+    def handle_comment(self, data):
+        # Comments are dropped from rendered chapters, leaving the text on
+        # either side as separate strings
+        self.after_space = False
+    
+    def _displayed_length(self, data: str) -> int:
+        """Count the characters of text as the rendered chapter serializes it."""
+        if self.preserving:
+            self.after_space = False
+            return len(data)
+        # Text may arrive in several pieces, so a run can continue a previous one
+        collapsed = _WHITESPACE_RUN.sub(' ', data)
+        length = len(collapsed)
+        if self.after_space and collapsed.startswith(' '):
+            length -= 1
+        if collapsed:
+            self.after_space = collapsed.endswith(' ')
+        return length
+    
+    def drain(self) -> Iterator[Tuple[Optional[str], str]]:
+        """Yield and forget the text of the elements closed so far."""
+        open_ids = {element_id for _, element_id, _ in self.stack}
+        pending = []
+        for element_id in self.order:
+            if element_id in open_ids or element_id is None:
+                pending.append(element_id)
+                continue
+            yield element_id, ' '.join(''.join(self.texts.pop(element_id)).split())
+        self.order = pending
+    
+    def finish(self) -> Iterator[Tuple[Optional[str], str]]:
+        """Yield the text of every remaining element."""
+        self._close(0)
+        for element_id in self.order:
+            yield element_id, ' '.join(''.join(self.texts.pop(element_id)).split())
+        self.order = []
 
 
 class ContentProcessor:
@@ -19,6 +236,10 @@ class ContentProcessor:
     and preparing content for web display.
     """
     
+    # Version of the rendered output; bump it with every change to the markup
+    # chapters render to, so stored renderings (reader packs) are rebuilt
+    VERSION = 1
+    
     def normalize_html(self, html_path: str, base_path: Optional[str] = None) -> str:
         """
         Normalize HTML content for rendering in the web application.
@@ -34,8 +255,8 @@ class ContentProcessor:
             ValueError: If the HTML file cannot be read or parsed
         """
         try:
-            with open(html_path, 'r', encoding='utf-8') as f:
-                html_content = f.read()
+            with open(html_path, 'rb') as f:
+                html_content = decode_markup(f.read())
                 
             # Parse HTML with BeautifulSoup
             soup = BeautifulSoup(html_content, 'html.parser')
@@ -55,7 +276,8 @@ class ContentProcessor:
         except Exception as e:
             raise ValueError(f"Error normalizing HTML: {str(e)}")
     
-    def _fix_relative_urls(self, soup: BeautifulSoup, html_path: str, base_path: str) -> None:
+    def _fix_relative_urls(self, soup: BeautifulSoup, html_path: str, base_path: str,
+                           images: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
         """
         Fix relative URLs in the HTML content.
         
@@ -63,6 +285,8 @@ class ContentProcessor:
             soup: BeautifulSoup object
             html_path: Path to the HTML file
             base_path: Base path for resolving relative URLs
+            images: Optional dictionary mapping image file paths to the
+                attributes of their ``img`` tags (see process_bytes())
         """
         # Get the directory of the HTML file relative to the base path
         html_dir = os.path.dirname(os.path.relpath(html_path, os.path.dirname(base_path)))
@@ -70,19 +294,24 @@ class ContentProcessor:
         # Fix image sources
         for img in soup.find_all('img'):
             if img.get('src') and not img['src'].startswith(('http://', 'https://', '/')):
-                img['src'] = os.path.normpath(os.path.join(html_dir, img['src']))
-        
-        # Fix CSS links
-        for link in soup.find_all('link', rel='stylesheet'):
-            if link.get('href') and not link['href'].startswith(('http://', 'https://', '/')):
-                link['href'] = os.path.normpath(os.path.join(html_dir, link['href']))
+                source = os.path.normpath(os.path.join(os.path.dirname(html_path), unquote(img['src'])))
+                attributes = images.get(source) if images else None
+                if attributes:
+                    # Reserve the image's space and load a variant sized for the screen
+                    for name, value in attributes.items():
+                        img[name] = str(value)
+                    img['loading'] = 'lazy'
+                else:
+                    img['src'] = os.path.normpath(os.path.join(html_dir, img['src']))
     
-    def _add_styling_hooks(self, soup: BeautifulSoup) -> None:
+    def _add_styling_hooks(self, soup: BeautifulSoup, number_elements: bool = True) -> None:
         """
         Add CSS classes and data attributes to elements for styling.
         
         Args:
             soup: BeautifulSoup object
+            number_elements: Whether to add data-epubar-id attributes (skipped
+                when _add_data_attributes() numbers the elements anyway)
         """
         # Add a class to the body element
         if soup.body:
@@ -106,24 +335,33 @@ class ContentProcessor:
                 paragraph['class'] = ['epubar-paragraph']
         
         # Add data attribute for annotation support
+        if not number_elements:
+            return
         elements = soup.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'span'])
         for i, element in enumerate(elements):
             element['data-epubar-id'] = f'el-{i}'
     
-    def _clean_html(self, soup: BeautifulSoup) -> None:
+    def _clean_html(self, soup: BeautifulSoup, inline_styles: bool = False) -> None:
         """
         Clean up unnecessary elements and attributes.
         
         Args:
             soup: BeautifulSoup object
+            inline_styles: Whether to replace style attributes with the classes
+                the book's stylesheet bundle defines for them, rather than
+                dropping them
         """
-        # Remove scripts
-        for script in soup.find_all('script'):
-            script.decompose()
+        # Remove scripts, and styles: the book's CSS is served as one scoped bundle
+        for element in soup.find_all(['script', 'style']):
+            element.decompose()
+        for link in soup.find_all('link', rel='stylesheet'):
+            link.decompose()
         
-        # Remove style attributes (we'll use our own CSS)
         for tag in soup.find_all(style=True):
+            name = inline_style_class(tag['style']) if inline_styles else None
             del tag['style']
+            if name:
+                tag['class'] = tag.get('class', []) + [name]
         
         # Remove non-standard attributes
         for tag in soup.find_all():
@@ -135,74 +373,214 @@ class ContentProcessor:
             for attr in attrs_to_remove:
                 del tag[attr]
                 
-    def process_content(self, html_path: str, base_path: str, add_data_attributes: bool = False) -> str:
+    def process_content(self, html_path: str, base_path: str, add_data_attributes: bool = False,
+                        anchor_mode: str = ANCHOR_ELEMENTS, stats: Optional[Dict[str, int]] = None,
+                        stylesheet_url: Optional[str] = None,
+                        images: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
         """
         Process HTML content for rendering in the reader.
         
-        This method normalizes the HTML, resolves relative URLs, adds styling hooks,
-        and optionally adds data attributes for annotation support.
+        Reads the file and decodes the result of process_bytes(); serving
+        code should use process_bytes() directly.
         
         Args:
             html_path: Path to the HTML file
             base_path: Base path for resolving relative URLs
             add_data_attributes: Whether to add data attributes for annotation support
+            anchor_mode: ANCHOR_ELEMENTS or ANCHOR_BLOCKS, the elements that
+                receive data attributes
+            stats: Optional dictionary to add the size of the result
+                (``bytes_out``) and the bytes saved by minification
+                (``bytes_saved``) to
+            stylesheet_url: URL of the book's stylesheet bundle, if it has one
+            images: Optional attributes of the book's indexed images (see process_bytes())
             
         Returns:
             Processed HTML content ready for the reader
+        
+        Raises:
+            ValueError: If the HTML file cannot be read or processed
+        """
+        try:
+            with open(html_path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            raise ValueError(f"Error processing HTML content: {str(e)}")
+        return self.process_bytes(data, html_path, base_path, add_data_attributes, anchor_mode,
+                                  stats, stylesheet_url, images).decode('utf-8')
+    
+    def process_bytes(self, data: bytes, html_path: str, base_path: str, add_data_attributes: bool = False,
+                      anchor_mode: str = ANCHOR_ELEMENTS, stats: Optional[Dict[str, int]] = None,
+                      stylesheet_url: Optional[str] = None,
+                      images: Optional[Dict[str, Dict[str, Any]]] = None) -> bytes:
+        """
+        Process the raw bytes of a content document for rendering in the reader.
+        
+        This method normalizes the HTML, resolves relative URLs, adds styling hooks,
+        and optionally adds data attributes for annotation support. The input
+        is decoded with the encoding its byte order mark, XML declaration or
+        meta charset declares, and the result is the UTF-8 encoded reader
+        document, ready to send.
+        
+        With a stylesheet bundle, the document links it and inline styles
+        become the bundle's classes; the chapter element carries the body's
+        classes, which scoped body rules select.
+        
+        Args:
+            data: Raw bytes of the content document
+            html_path: Path of the document, for resolving relative URLs
+            base_path: Base path for resolving relative URLs
+            add_data_attributes: Whether to add data attributes for annotation support
+            anchor_mode: ANCHOR_ELEMENTS or ANCHOR_BLOCKS, the elements that
+                receive data attributes
+            stats: Optional dictionary to add the size of the result
+                (``bytes_out``) and the bytes saved by minification
+                (``bytes_saved``) to
+            stylesheet_url: URL of the book's stylesheet bundle, if it has one
+            images: Optional dictionary mapping the paths of the book's indexed
+                images to attributes (``src``, ``srcset``, ``width``...) their
+                ``img`` tags receive; these images are also loaded lazily
+            
+        Returns:
+            UTF-8 encoded reader document
+        
+        Raises:
+            ValueError: If the content cannot be processed
         """
         try:
-            # Read the HTML file
-            with open(html_path, 'r', encoding='utf-8') as f:
-                html_content = f.read()
-                
             # Parse HTML with BeautifulSoup
-            soup = BeautifulSoup(html_content, 'html.parser')
+            soup = BeautifulSoup(decode_markup(data), 'html.parser')
             
             # Process relative URLs
-            self._fix_relative_urls(soup, html_path, base_path)
+            self._fix_relative_urls(soup, html_path, base_path, images)
             
             # Add CSS classes for styling
-            self._add_styling_hooks(soup)
+            self._add_styling_hooks(soup, number_elements=not add_data_attributes)
             
             # Clean up unnecessary elements and attributes
-            self._clean_html(soup)
+            self._clean_html(soup, inline_styles=stylesheet_url is not None)
             
             # Add data attributes for annotation support if requested
             if add_data_attributes:
-                self._add_data_attributes(soup)
+                self._add_data_attributes(soup, anchor_mode)
             
             # Extract just the body content (or the entire document if no body)
             body_content = soup.body or soup
             
             # Create a new HTML structure for the reader
-            reader_html = f'''
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>EPUBAR Reader</title>
-            </head>
-            <body>
-                <div class="epubar-chapter-content">
-                    {body_content.encode_contents().decode('utf-8')}
-                </div>
-            </body>
-            </html>
-            '''
-            
+            reader_html = b''.join((
+                self._reader_prefix(soup.body.get('class', []) if soup.body else [], stylesheet_url),
+                self._serialize(body_content, stats).encode('utf-8'),
+                READER_SUFFIX
+            ))
+            if stats is not None:
+                stats['bytes_out'] = stats.get('bytes_out', 0) + len(reader_html)
             return reader_html
             
         except Exception as e:
             raise ValueError(f"Error processing HTML content: {str(e)}")
     
-    def _add_data_attributes(self, soup: BeautifulSoup) -> None:
+    def _reader_prefix(self, body_classes: List[str], stylesheet_url: Optional[str] = None) -> bytes:
+        """
+        Write the reader document up to the chapter's contents.
+        
+        Args:
+            body_classes: Classes of the chapter's body element
+            stylesheet_url: URL of the book's stylesheet bundle, if any
+            
+        Returns:
+            UTF-8 encoded start of the reader document
+        """
+        classes = ' '.join(dict.fromkeys(CHAPTER_CLASSES + tuple(body_classes)))
+        link = f'<link href="{escape(stylesheet_url)}" rel="stylesheet">' if stylesheet_url else ''
+        return READER_HEAD + f'{link}</head><body><div class="{escape(classes)}">'.encode('utf-8')
+    
+    def wrap_for_reader(self, body_html: str) -> str:
+        """
+        Wrap chapter body markup in the reader's HTML document structure.
+        
+        Args:
+            body_html: Inner HTML of the chapter body
+            
+        Returns:
+            Complete HTML document for the reader
+        """
+        return f"{READER_PREFIX.decode('utf-8')}{body_html}{READER_SUFFIX.decode('utf-8')}"
+    
+    def _serialize(self, root, stats: Optional[Dict[str, int]] = None) -> str:
+        """
+        Write the contents of an element as canonical, minified markup.
+        
+        Equivalent chapters serialize to the same bytes, so cached outputs
+        dedupe and compress better. Whitespace is collapsed exactly as
+        iter_text() counts it, so character offsets stay valid.
+        
+        Args:
+            root: Element whose contents are written
+            stats: Optional dictionary to add the bytes saved (``bytes_saved``) to
+            
+        Returns:
+            Markup of the element's contents
+        """
+        formatter = _CanonicalFormatter()
+        for comment in root.find_all(string=lambda string: isinstance(string, Comment)):
+            formatter.saved += len(comment.output_ready().encode('utf-8'))
+            comment.extract()
+        markup = root.decode_contents(formatter=formatter)
+        if stats is not None:
+            stats['bytes_saved'] = stats.get('bytes_saved', 0) + formatter.saved
+        return markup
+    
+    def _add_data_attributes(self, soup: BeautifulSoup, anchor_mode: str = ANCHOR_ELEMENTS) -> None:
         """
         Add data attributes to elements for annotation support.
         
+        With block anchors, inline elements are still counted so block IDs
+        are the same in both modes, but only block-level elements carry them.
+        
         Args:
             soup: BeautifulSoup object
+            anchor_mode: ANCHOR_ELEMENTS or ANCHOR_BLOCKS
         """
+        blocks_only = anchor_mode == ANCHOR_BLOCKS
         # Add unique IDs to elements that might be annotated
-        for i, element in enumerate(soup.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'span', 'li'])):
-            element['data-epubar-id'] = f'el-{i}'
+        for i, element in enumerate(soup.find_all(ANNOTATABLE_TAGS)):
+            if not blocks_only or element.name in BLOCK_ANCHOR_TAGS:
+                element['data-epubar-id'] = f'el-{i}'
+    
+    def iter_text(self, html_path: str, chunk_size: int = 64 * 1024,
+                  locations: Optional[ChapterLocations] = None) -> Iterator[Tuple[Optional[str], str]]:
+        """
+        Stream the visible text of a chapter, element by element.
+        
+        The file is parsed incrementally without building a document tree, so
+        memory stays bounded by the largest open element rather than the
+        chapter. The file is decoded as process_bytes() decodes it. Element
+        IDs match the data-epubar-id attributes of the rendered chapter; text
+        outside any annotatable element has ID None.
+        
+        Args:
+            html_path: Path to the HTML file
+            chunk_size: Number of characters parsed at a time
+            locations: Optional empty ChapterLocations to record the
+                character range of every element in
+            
+        Yields:
+            Tuples of (element_id, text) in document order
+        
+        Raises:
+            ValueError: If the HTML file cannot be read
+        """
+        extractor = _TextExtractor(locations)
+        try:
+            with open(html_path, 'rb') as raw:
+                encoding = detect_encoding(raw.read(SNIFF_BYTES))
+                raw.seek(0)
+                f = io.TextIOWrapper(raw, encoding=encoding, errors='replace')
+                for chunk in iter(lambda: f.read(chunk_size), ''):
+                    extractor.feed(chunk)
+                    yield from extractor.drain()
+        except OSError as e:
+            raise ValueError(f"Error reading HTML content: {str(e)}")
+        extractor.close()
+        yield from extractor.finish()
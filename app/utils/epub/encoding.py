@@ -0,0 +1,73 @@
+"""
+Character encoding detection for EPUB content documents.
+
+EPUB requires UTF-8 or UTF-16 content documents, but older books and
+conversions also declare legacy encodings such as ISO-8859-1. The encoding
+of a document is taken from its byte order mark, the NUL bytes of BOM-less
+UTF-16, its XML declaration or its meta charset, in that order, and
+defaults to UTF-8.
+"""
+import codecs
+import re
+
+# Leading bytes examined for declarations
+SNIFF_BYTES = 4096
+
+# Byte order marks, longest first (the UTF-32 LE mark starts with UTF-16 LE's)
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+_XML_DECLARATION = re.compile(rb'^\s*<\?xml[^>]*?\bencoding\s*=\s*["\']([A-Za-z0-9._:-]+)["\']')
+_META_CHARSET = re.compile(rb'<meta\b[^>]*?\bcharset\s*=\s*["\']?([A-Za-z0-9._:-]+)', re.IGNORECASE)
+
+
+def detect_encoding(head: bytes) -> str:
+    """
+    Detect the encoding of a document from its first bytes.
+
+    Args:
+        head: The document, or at least its first SNIFF_BYTES bytes
+
+    Returns:
+        Python codec name; BOM-aware codecs are returned for documents
+        starting with a byte order mark, so decoding drops the mark
+    """
+    for bom, codec in _BOMS:
+        if head.startswith(bom):
+            return codec
+    # BOM-less UTF-16 shows as NUL bytes around the ASCII of the first tag
+    if head.startswith(b'<\x00'):
+        return 'utf-16-le'
+    if head.startswith(b'\x00<'):
+        return 'utf-16-be'
+
+    head = head[:SNIFF_BYTES]
+    match = _XML_DECLARATION.match(head) or _META_CHARSET.search(head)
+    if match:
+        try:
+            codec = codecs.lookup(match.group(1).decode('ascii')).name
+        except LookupError:
+            return 'utf-8'
+        # A declared UTF-16 or UTF-32 contradicts the ASCII-compatible bytes the
+        # declaration was just read from
+        if not codec.startswith(('utf-16', 'utf-32')):
+            return codec
+    return 'utf-8'
+
+
+def decode_markup(data: bytes) -> str:
+    """
+    Decode a content document with its detected encoding.
+
+    Args:
+        data: Raw bytes of the document
+
+    Returns:
+        Decoded markup; undecodable bytes become U+FFFD
+    """
+    return data.decode(detect_encoding(data[:SNIFF_BYTES]), errors='replace')
@@ -0,0 +1,155 @@
+"""
+Character-offset index of a chapter's annotatable elements.
+
+Offsets count the characters of the chapter's displayed text (scripts,
+styles and the head excluded), which do not depend on how elements are
+numbered or marked up by the renderer. For element N the index holds the
+offset where it starts, where it ends and its enclosing element, as packed
+integer arrays indexed by N. An element converts to an offset in O(1); an
+offset converts to the innermost element containing it by bisecting the
+start offsets and walking up to the first enclosing element that is still
+open, which is bounded by the nesting depth. Elements are also flagged as
+block-level or inline, so an offset can be resolved to the innermost block
+when chapters are rendered with block anchors only.
+"""
+from array import array
+from bisect import bisect_right
+from typing import Optional, Tuple
+
+# Item type of the packed arrays (signed: -1 marks "no parent")
+_TYPECODE = 'i'
+
+# Item type of the block flags (1 for block-level elements)
+_FLAG_TYPECODE = 'B'
+
+
+class ChapterLocations:
+    """
+    Maps between element IDs (``el-N``) and character offsets in a chapter.
+    """
+
+    def __init__(self, starts: Optional[array] = None, ends: Optional[array] = None,
+                 parents: Optional[array] = None, length: int = 0,
+                 blocks: Optional[array] = None):
+        """
+        Initialize the index, empty unless arrays are given.
+
+        Args:
+            starts: Start offset of each element
+            ends: End offset of each element
+            parents: Number of the enclosing element, or -1
+            length: Number of characters in the chapter
+            blocks: Block-level flag of each element; when empty every
+                element counts as a block
+        """
+        self.starts = starts if starts is not None else array(_TYPECODE)
+        self.ends = ends if ends is not None else array(_TYPECODE)
+        self.parents = parents if parents is not None else array(_TYPECODE)
+        self.length = length
+        self.blocks = blocks if blocks is not None else array(_FLAG_TYPECODE)
+
+    @classmethod
+    def unpack(cls, starts: bytes, ends: bytes, parents: bytes, length: int,
+               blocks: Optional[bytes] = None) -> 'ChapterLocations':
+        """
+        Rebuild an index from the bytes returned by pack().
+
+        Args:
+            starts: Packed start offsets
+            ends: Packed end offsets
+            parents: Packed parent numbers
+            length: Number of characters in the chapter
+            blocks: Block flags (``blocks.tobytes()``), None if not recorded
+
+        Returns:
+            ChapterLocations instance
+        """
+        arrays = []
+        for packed in (starts, ends, parents):
+            values = array(_TYPECODE)
+            values.frombytes(packed)
+            arrays.append(values)
+        flags = array(_FLAG_TYPECODE, blocks or b'')
+        return cls(*arrays, length=length, blocks=flags)
+
+    def pack(self) -> Tuple[bytes, bytes, bytes]:
+        """Return the start, end and parent arrays as bytes."""
+        return self.starts.tobytes(), self.ends.tobytes(), self.parents.tobytes()
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    # Building, called by the text extractor in document order
+
+    def open(self, parent: int, block: bool = True) -> None:
+        """Record the start of the next element at the current offset."""
+        self.starts.append(self.length)
+        self.ends.append(self.length)
+        self.parents.append(parent)
+        self.blocks.append(1 if block else 0)
+
+    def close(self, number: int) -> None:
+        """Record the end of element ``number`` at the current offset."""
+        self.ends[number] = self.length
+
+    def advance(self, count: int) -> None:
+        """Move the current offset past ``count`` displayed characters."""
+        self.length += count
+
+    # Lookups
+
+    def offset_of(self, element_id: str, local_offset: int = 0) -> Optional[int]:
+        """
+        Convert an element and an offset within it to a chapter offset.
+
+        Args:
+            element_id: Element ID (``el-N``)
+            local_offset: Characters from the start of the element
+
+        Returns:
+            Chapter offset, or None if the element is unknown
+        """
+        number = _element_number(element_id)
+        if number is None or number >= len(self.starts):
+            return None
+        return min(self.starts[number] + max(local_offset, 0), self.length)
+
+    def element_at(self, offset: int, blocks_only: bool = False) -> Optional[Tuple[str, int]]:
+        """
+        Find the innermost element containing a chapter offset.
+
+        Offsets outside every element resolve to the closest element that
+        starts before them.
+
+        Args:
+            offset: Chapter offset
+            blocks_only: Only consider block-level elements
+
+        Returns:
+            Tuple of (element_id, offset within the element), or None if no
+            element starts at or before the offset
+        """
+        number = bisect_right(self.starts, offset) - 1
+        if number < 0:
+            return None
+        closest = number
+        while number >= 0 and (self.ends[number] <= offset or (blocks_only and not self.is_block(number))):
+            number = self.parents[number]
+        if number < 0:
+            number = closest
+            while blocks_only and number >= 0 and not self.is_block(number):
+                number -= 1
+            if number < 0:
+                return None
+        return f'el-{number}', offset - self.starts[number]
+
+    def is_block(self, number: int) -> bool:
+        """Return whether element ``number`` is a block-level anchor."""
+        return not self.blocks or bool(self.blocks[number])
+
+
+def _element_number(element_id: Optional[str]) -> Optional[int]:
+    """Parse the number of an ``el-N`` element ID"""
+    if not element_id or not element_id.startswith('el-') or not element_id[3:].isdigit():
+        return None
+    return int(element_id[3:])
@@ -15,6 +15,10 @@ class MetadataExtractor:
     This class handles parsing OPF files to extract book metadata and spine information.
     """
     
+    # Version of the extraction logic; bump it with every change to the
+    # metadata, spine or cover it reports, so derived artifacts are rebuilt
+    VERSION = 1
+    
     # XML namespaces used in EPUB files
     NAMESPACES = {
         'opf': 'http://www.idpf.org/2007/opf',
@@ -93,7 +97,19 @@ class MetadataExtractor:
                 cover_items = manifest_element.findall('.//{http://www.idpf.org/2007/opf}item[@properties="cover-image"]')
                 if not cover_items:
                     cover_items = manifest_element.findall('.//{http://www.idpf.org/2007/opf}item[@id="cover"]')
-                
+                if not cover_items and metadata_element is not None:
+                    # EPUB 2 books point at the cover item with <meta name="cover">
+                    cover_meta = metadata_element.find('./{http://www.idpf.org/2007/opf}meta[@name="cover"]')
+                    if cover_meta is None:
+                        cover_meta = metadata_element.find('./meta[@name="cover"]')
+                    if cover_meta is not None and cover_meta.get('content'):
+                        # Compared rather than spliced into a path, as IDs may hold quotes
+                        cover_id = cover_meta.get('content')
+                        cover_items = [
+                            item for item in manifest_element.iter('{http://www.idpf.org/2007/opf}item')
+                            if item.get('id') == cover_id
+                        ]
+
                 if cover_items:
                     cover_href = cover_items[0].get('href')
                     if cover_href:
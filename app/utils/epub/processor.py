@@ -2,11 +2,105 @@
 EPUB Processor module for extracting and validating EPUB files.
 """
 import os
-import shutil
-import tempfile
 import zipfile
 from typing import Tuple, List, Optional
 
+from app.utils.epub.workspace import workspace_janitor
+
+
+class DecompressionLimitExceeded(ValueError):
+    """Raised when an archive exceeds its decompression budget."""
+
+
+class DecompressionBudget:
+    """
+    Limits on how much an EPUB archive may expand when extracted.
+    
+    Declared sizes are checked against the central directory before anything
+    is read, and actual bytes are counted while streaming, so an archive that
+    lies about its sizes is still stopped mid-stream.
+    """
+    
+    # Entries smaller than this are exempt from the ratio check; tiny text
+    # files legitimately compress very well
+    RATIO_MIN_BYTES = 1024 * 1024
+    
+    def __init__(self, max_total_bytes: int = 512 * 1024 * 1024, max_entries: int = 10000,
+                 max_ratio: float = 100.0):
+        """
+        Initialize the budget.
+        
+        Args:
+            max_total_bytes: Maximum uncompressed size of the whole archive
+            max_entries: Maximum number of entries in the archive
+            max_ratio: Maximum uncompressed/compressed ratio of a large entry
+        """
+        self.max_total_bytes = max_total_bytes
+        self.max_entries = max_entries
+        self.max_ratio = max_ratio
+    
+    @classmethod
+    def from_config(cls, config) -> 'DecompressionBudget':
+        """
+        Build a budget from EPUB_MAX_* application settings.
+        
+        Args:
+            config: Flask configuration mapping
+        """
+        default = cls()
+        return cls(
+            max_total_bytes=config.get('EPUB_MAX_UNCOMPRESSED_BYTES', default.max_total_bytes),
+            max_entries=config.get('EPUB_MAX_ENTRIES', default.max_entries),
+            max_ratio=config.get('EPUB_MAX_COMPRESSION_RATIO', default.max_ratio)
+        )
+    
+    def check_archive(self, infos: List[zipfile.ZipInfo]) -> None:
+        """
+        Check the central directory of an archive against the budget.
+        
+        Args:
+            infos: Entries of the archive
+            
+        Raises:
+            DecompressionLimitExceeded: If the declared sizes exceed the budget
+        """
+        if len(infos) > self.max_entries:
+            raise DecompressionLimitExceeded(
+                f"Invalid EPUB: {len(infos)} entries exceeds the limit of {self.max_entries}"
+            )
+        
+        total = 0
+        for info in infos:
+            self.check_entry(info)
+            total += info.file_size
+        
+        if total > self.max_total_bytes:
+            raise DecompressionLimitExceeded(
+                f"Invalid EPUB: uncompressed size {total} exceeds the limit of {self.max_total_bytes} bytes"
+            )
+    
+    def check_entry(self, info: zipfile.ZipInfo) -> None:
+        """
+        Check one entry's declared size and compression ratio.
+        
+        Args:
+            info: Archive entry
+            
+        Raises:
+            DecompressionLimitExceeded: If the entry exceeds the budget
+        """
+        if info.file_size > self.max_total_bytes:
+            raise DecompressionLimitExceeded(
+                f"Invalid EPUB: {info.filename} exceeds the limit of {self.max_total_bytes} bytes"
+            )
+        if info.file_size >= self.RATIO_MIN_BYTES:
+            ratio = info.file_size / max(info.compress_size, 1)
+            if ratio > self.max_ratio:
+                raise DecompressionLimitExceeded(
+                    f"Invalid EPUB: {info.filename} has compression ratio {ratio:.0f}, "
+                    f"above the limit of {self.max_ratio:.0f}"
+                )
+
 
 class EPUBProcessor:
     """
@@ -15,10 +109,22 @@ class EPUBProcessor:
     This class handles the extraction, validation, and cleanup of EPUB files.
     """
     
-    def __init__(self):
-        """Initialize the EPUB processor."""
+    # Budget applied when none is passed explicitly; set from the app config
+    default_budget = DecompressionBudget()
+    
+    # Size of the chunks streamed out of the archive
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__(self, budget: Optional[DecompressionBudget] = None):
+        """
+        Initialize the EPUB processor.
+        
+        Args:
+            budget: Optional decompression budget (defaults to default_budget)
+        """
         self.temp_dir = None
         self.extracted_path = None
+        self.budget = budget or self.default_budget
     
     def extract(self, epub_path: str) -> str:
         """
@@ -33,11 +139,6 @@ class EPUBProcessor:
         Raises:
             ValueError: If the file is not a valid EPUB file
         """
-        # Create a temporary directory for extraction
-        self.temp_dir = tempfile.mkdtemp(prefix='epubar_')
-        self.extracted_path = os.path.join(self.temp_dir, 'epub_content')
-        os.makedirs(self.extracted_path, exist_ok=True)
-        
         # Extract the EPUB file
         try:
             with zipfile.ZipFile(epub_path, 'r') as epub:
@@ -45,8 +146,17 @@ class EPUBProcessor:
                 if epub.namelist()[0] != 'mimetype':
                     raise ValueError("Invalid EPUB: mimetype file must be first in the archive")
                 
-                # Extract all files
-                epub.extractall(self.extracted_path)
+                # Check the declared sizes before anything touches the disk
+                infos = epub.infolist()
+                self.budget.check_archive(infos)
+                
+                # Create a workspace sized for the archive, within the disk quota
+                self.temp_dir = workspace_janitor.create(sum(info.file_size for info in infos))
+                self.extracted_path = os.path.join(self.temp_dir, 'epub_content')
+                os.makedirs(self.extracted_path, exist_ok=True)
+                
+                # Extract all files within the decompression budget
+                self._extract_members(epub, infos)
                 
                 # Verify required structure exists
                 if not os.path.exists(os.path.join(self.extracted_path, 'META-INF/container.xml')):
@@ -55,9 +165,77 @@ class EPUBProcessor:
         except zipfile.BadZipFile:
             self.cleanup()
             raise ValueError("Invalid EPUB: Not a valid ZIP file")
+        except ValueError:
+            self.cleanup()
+            raise
         
         return self.extracted_path
     
+    def _extract_members(self, epub: zipfile.ZipFile, infos: List[zipfile.ZipInfo]) -> None:
+        """
+        Stream every archive member to disk while enforcing the budget.
+        
+        Args:
+            epub: Open EPUB archive
+            infos: Entries of the archive, already checked with check_archive()
+            
+        Raises:
+            DecompressionLimitExceeded: If the archive exceeds its budget
+            ValueError: If a member would be written outside the extraction directory
+        """
+        root = os.path.realpath(self.extracted_path)
+        written = 0
+        for info in infos:
+            target = os.path.realpath(os.path.join(root, info.filename))
+            if target != root and not target.startswith(root + os.sep):
+                raise ValueError(f"Invalid EPUB: unsafe member path {info.filename}")
+            
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with epub.open(info) as source, open(target, 'wb') as dest:
+                entry_bytes = 0
+                for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b''):
+                    entry_bytes += len(chunk)
+                    written += len(chunk)
+                    # Stop as soon as a member expands beyond what it declared
+                    if entry_bytes > info.file_size or written > self.budget.max_total_bytes:
+                        raise DecompressionLimitExceeded(
+                            f"Invalid EPUB: {info.filename} expands beyond its declared size"
+                        )
+                    dest.write(chunk)
+    
+    def read_member(self, epub: zipfile.ZipFile, name: str) -> bytes:
+        """
+        Read one archive member into memory within the decompression budget.
+        
+        Args:
+            epub: Open EPUB archive
+            name: Member name
+            
+        Returns:
+            The member's uncompressed bytes
+            
+        Raises:
+            DecompressionLimitExceeded: If the member exceeds the budget
+        """
+        info = epub.getinfo(name)
+        self.budget.check_entry(info)
+        
+        chunks = []
+        size = 0
+        with epub.open(info) as source:
+            for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > info.file_size:
+                    raise DecompressionLimitExceeded(
+                        f"Invalid EPUB: {info.filename} expands beyond its declared size"
+                    )
+                chunks.append(chunk)
+        return b''.join(chunks)
+    
     def validate(self, epub_path: str) -> Tuple[bool, List[str]]:
         """
         Validate an EPUB file.
@@ -77,6 +255,9 @@ class EPUBProcessor:
                 return False, errors
             
             with zipfile.ZipFile(epub_path, 'r') as epub:
+                # Check the declared sizes before reading anything
+                self.budget.check_archive(epub.infolist())
+                
                 # Check for required files
                 file_list = epub.namelist()
                 
@@ -86,7 +267,7 @@ class EPUBProcessor:
                 elif file_list[0] != 'mimetype':
                     errors.append("mimetype file is not the first file in the archive")
                 else:
-                    mimetype = epub.read('mimetype').decode('utf-8')
+                    mimetype = self.read_member(epub, 'mimetype').decode('utf-8')
                     if mimetype != 'application/epub+zip':
                         errors.append(f"Invalid mimetype: {mimetype}")
                 
@@ -96,7 +277,7 @@ class EPUBProcessor:
                 
                 # Extract and check OPF file
                 if 'META-INF/container.xml' in file_list:
-                    container_xml = epub.read('META-INF/container.xml').decode('utf-8')
+                    container_xml = self.read_member(epub, 'META-INF/container.xml').decode('utf-8')
                     # Simple check for rootfile reference
                     if 'full-path=' not in container_xml or 'media-type="application/oebps-package+xml"' not in container_xml:
                         errors.append("Invalid container.xml: missing OPF reference")
@@ -111,7 +292,15 @@ class EPUBProcessor:
         """
         Clean up temporary files and directories.
         """
-        if self.temp_dir and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
+        if self.temp_dir:
+            workspace_janitor.release(self.temp_dir)
             self.temp_dir = None
             self.extracted_path = None
+    
+    def __enter__(self) -> 'EPUBProcessor':
+        """Start a session whose workspace is removed when the block exits."""
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Remove the session's workspace."""
+        self.cleanup()
@@ -0,0 +1,290 @@
+"""
+Scoping of publisher stylesheets for the reader.
+
+A book's CSS is written for whole documents, while the reader shows chapters
+inside its own page. Rules are therefore rewritten to apply only under
+SCOPE, the class of the element holding a chapter, and declarations that
+would fight the reader are dropped: text and background colors belong to the
+reader themes, absolute font sizes to the font size setting, and ``url()``
+references point into the archive, which is not served. The output is
+minified, so equal input always produces the same bytes.
+
+Inline ``style`` attributes become classes named after their declarations,
+with one rule per distinct attribute in the book's bundle.
+"""
+import hashlib
+import re
+from typing import Iterable, List, Optional, Tuple
+
+# Version of the scoping rules; bump it with every change to the bundles they produce
+VERSION = 1
+
+# Class of the element holding a rendered chapter
+SCOPE = '.epubar-content'
+
+# Properties set by the reader themes
+THEME_PROPERTIES = frozenset({
+    'color', 'background', 'background-color', 'background-image', '-webkit-text-fill-color',
+})
+
+# Conditional group rules whose contents are kept (and scoped)
+GROUPING_AT_RULES = ('media', 'supports')
+
+# Prefix of the classes replacing inline style attributes
+INLINE_CLASS_PREFIX = 'epubar-s-'
+
+_STRING_OR_COMMENT = re.compile(r'("(?:\\.|[^"\\])*"?|\'(?:\\.|[^\'\\])*\'?)|/\*.*?(?:\*/|$)', re.DOTALL)
+_STRING = re.compile(r'("(?:\\.|[^"\\])*"?|\'(?:\\.|[^\'\\])*\'?)', re.DOTALL)
+_WHITESPACE = re.compile(r'\s+')
+_AT_RULE_NAME = re.compile(r'@(-?[\w-]+)')
+_ABSOLUTE_LENGTH = re.compile(r'\d(?:px|pt|pc|in|cm|mm|q)\b', re.IGNORECASE)
+_ROOT_COMPOUND = re.compile(r'^(?:html|:root)(?![\w-])[^\s>+~]*\s*(?:>\s*)?', re.IGNORECASE)
+_BODY_COMPOUND = re.compile(r'^body(?![\w-])', re.IGNORECASE)
+
+
+def _strip_comments(css: str) -> str:
+    """Remove comments, leaving strings that look like comments alone"""
+    return _STRING_OR_COMMENT.sub(lambda match: match.group(1) or ' ', css)
+
+
+def _skip_string(text: str, start: int) -> int:
+    """Return the index after the string literal starting at ``start``"""
+    match = _STRING.match(text, start)
+    return match.end() if match else start + 1
+
+
+def _collapse(text: str, tight: str = '') -> str:
+    """
+    Collapse whitespace outside string literals.
+
+    Args:
+        text: CSS fragment
+        tight: Characters that need no whitespace around them
+
+    Returns:
+        The fragment with whitespace runs reduced to one space, and removed
+        around the characters in ``tight``
+    """
+    parts = _STRING.split(text)
+    for index in range(0, len(parts), 2):
+        part = _WHITESPACE.sub(' ', parts[index])
+        if tight:
+            part = re.sub(rf'\s*([{re.escape(tight)}])\s*', r'\1', part)
+        parts[index] = part
+    return ''.join(parts).strip()
+
+
+def _split_top_level(text: str, separator: str) -> List[str]:
+    """Split on a separator outside strings, parentheses and brackets"""
+    pieces = []
+    depth = 0
+    start = 0
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char in '"\'':
+            index = _skip_string(text, index)
+            continue
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth = max(depth - 1, 0)
+        elif char == separator and not depth:
+            pieces.append(text[start:index])
+            start = index + 1
+        index += 1
+    pieces.append(text[start:])
+    return pieces
+
+
+def _parse_rules(css: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Split comment-free CSS into its top-level statements.
+
+    Returns:
+        List of (prelude, block) pairs; the block is None for statements
+        ending in a semicolon, such as ``@import``
+    """
+    rules = []
+    start = 0
+    index = 0
+    while index < len(css):
+        char = css[index]
+        if char in '"\'':
+            index = _skip_string(css, index)
+            continue
+        if char == ';':
+            rules.append((css[start:index].strip(), None))
+            start = index + 1
+        elif char == '}':
+            # Stray closing brace: skip it like a browser would
+            start = index + 1
+        elif char == '{':
+            depth = 1
+            end = index + 1
+            while end < len(css) and depth:
+                if css[end] in '"\'':
+                    end = _skip_string(css, end)
+                    continue
+                if css[end] == '{':
+                    depth += 1
+                elif css[end] == '}':
+                    depth -= 1
+                end += 1
+            rules.append((css[start:index].strip(), css[index + 1:end - 1] if not depth else css[index + 1:end]))
+            start = index = end
+            continue
+        index += 1
+    return rules
+
+
+def _conflicts(name: str, value: str) -> bool:
+    """Whether a declaration would override reader themes or settings"""
+    if name in THEME_PROPERTIES:
+        return True
+    if name == 'font-size' and _ABSOLUTE_LENGTH.search(value):
+        return True
+    return 'url(' in value.lower()
+
+
+def scope_selector(selector: str) -> Optional[str]:
+    """
+    Rewrite a selector to match only inside the chapter element.
+
+    ``html`` and ``:root`` are dropped and ``body`` becomes the chapter
+    element itself, keeping its qualifiers (``body.calibre`` becomes
+    ``.epubar-content.calibre``, as the chapter element carries the body's
+    classes).
+
+    Args:
+        selector: A single selector, without commas
+
+    Returns:
+        Scoped and minified selector, or None if nothing is left of it
+    """
+    selector = _collapse(selector, ',>+~')
+    if not selector:
+        return None
+    rest = _ROOT_COMPOUND.sub('', selector, count=1)
+    if rest != selector and not rest:
+        return SCOPE
+    if _BODY_COMPOUND.match(rest):
+        return SCOPE + rest[4:]
+    if rest[0] in '>+~':
+        return SCOPE + rest
+    return f'{SCOPE} {rest}'
+
+
+def filter_declarations(block: str, important: bool = False) -> str:
+    """
+    Minify a declaration block, dropping declarations that conflict with the reader.
+
+    Args:
+        block: Declarations, as in a rule body or a style attribute
+        important: Whether to mark every declaration ``!important``
+
+    Returns:
+        Minified declarations joined by semicolons (empty if none is kept)
+    """
+    kept = []
+    for declaration in _split_top_level(block, ';'):
+        name, separator, value = declaration.partition(':')
+        name = name.strip()
+        value = _collapse(value, ',')
+        if not separator or not name or not value or '{' in value:
+            continue
+        if not name.startswith('--'):
+            name = name.lower()
+        if _conflicts(name, value):
+            continue
+        if important and not value.replace(' ', '').lower().endswith('!important'):
+            value += '!important'
+        kept.append(f'{name}:{value}')
+    return ';'.join(kept)
+
+
+def _scope_rules(css: str) -> Iterable[str]:
+    """Yield the scoped, minified rules of comment-free CSS"""
+    for prelude, block in _parse_rules(css):
+        if block is None or not prelude:
+            # @charset, @import and @namespace
+            continue
+        if prelude.startswith('@'):
+            match = _AT_RULE_NAME.match(prelude)
+            if match and match.group(1).lower() in GROUPING_AT_RULES:
+                inner = ''.join(_scope_rules(block))
+                if inner:
+                    yield f'{_collapse(prelude)}{{{inner}}}'
+            # @font-face, @page, @keyframes and others have no place in a chapter
+            continue
+        selectors = [scope_selector(selector) for selector in _split_top_level(prelude, ',')]
+        selectors = list(dict.fromkeys(selector for selector in selectors if selector))
+        declarations = filter_declarations(block)
+        if selectors and declarations:
+            yield f"{','.join(selectors)}{{{declarations}}}"
+
+
+def scope_stylesheet(css: str) -> str:
+    """
+    Scope a stylesheet to the chapter element and minify it.
+
+    Args:
+        css: Stylesheet text
+
+    Returns:
+        Scoped, minified stylesheet
+    """
+    return ''.join(_scope_rules(_strip_comments(css)))
+
+
+def inline_style_class(style: str) -> Optional[str]:
+    """
+    Name the class replacing an inline style attribute.
+
+    Attributes with the same effective declarations share a class.
+
+    Args:
+        style: Value of the style attribute
+
+    Returns:
+        Class name, or None if no declaration of the attribute is kept
+    """
+    declarations = filter_declarations(style)
+    if not declarations:
+        return None
+    return INLINE_CLASS_PREFIX + hashlib.sha256(declarations.encode('utf-8')).hexdigest()[:10]
+
+
+def inline_style_rule(style: str) -> Optional[str]:
+    """
+    Write the bundle rule of an inline style attribute's class.
+
+    Declarations are marked ``!important`` to keep the precedence the
+    attribute had over stylesheet rules.
+
+    Args:
+        style: Value of the style attribute
+
+    Returns:
+        Rule for the class from inline_style_class(), or None if it has none
+    """
+    name = inline_style_class(style)
+    if name is None:
+        return None
+    return f'{SCOPE} .{name}{{{filter_declarations(style, important=True)}}}'
+
+
+def bundle_stylesheets(stylesheets: Iterable[str], inline_styles: Iterable[str] = ()) -> str:
+    """
+    Combine a book's stylesheets and inline styles into one scoped stylesheet.
+
+    Args:
+        stylesheets: Stylesheet texts in cascade order; repeats are kept once
+        inline_styles: Values of the book's style attributes
+
+    Returns:
+        Minified bundle
+    """
+    rules = [scope_stylesheet(css) for css in dict.fromkeys(stylesheets)]
+    rules.extend(dict.fromkeys(filter(None, (inline_style_rule(style) for style in inline_styles))))
+    return ''.join(rules)
@@ -0,0 +1,233 @@
+"""
+Workspace lifecycle management for extracted EPUB archives.
+
+Every extraction creates an ``epubar_*`` directory under the workspace root.
+This module keeps track of the bytes those workspaces hold, refuses new
+extractions that would exceed the disk quota, and runs a background sweeper
+that removes workspaces orphaned by crashed or interrupted requests.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+
+# Prefix of every extraction workspace directory
+WORKSPACE_PREFIX = 'epubar_'
+
+
+class WorkspaceQuotaExceeded(ValueError):
+    """Raised when an extraction would exceed the workspace disk quota."""
+
+
+def directory_size(path: str) -> int:
+    """
+    Return the total size of the files below a directory.
+
+    Args:
+        path: Directory to measure
+
+    Returns:
+        Size in bytes (0 if the directory vanished while walking it)
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class WorkspaceJanitor:
+    """
+    Disk accounting, quota guard and orphan sweeper for extraction workspaces.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_age: float = 3600.0,
+                 quota_bytes: int = 0, sweep_interval: float = 0):
+        """
+        Initialize the janitor.
+
+        Args:
+            root: Directory holding workspaces (defaults to the system temp dir)
+            max_age: Seconds after which an unreleased workspace counts as orphaned
+            quota_bytes: Maximum bytes all workspaces may hold (0 for no quota)
+            sweep_interval: Seconds between background sweeps (0 disables them)
+        """
+        self.root = root
+        self.max_age = max_age
+        self.quota_bytes = quota_bytes
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._reserved: Dict[str, int] = {}
+        self.stats = {
+            'bytes_in_use': 0,
+            'bytes_reclaimed': 0,
+            'workspaces_created': 0,
+            'workspaces_released': 0,
+            'orphans_removed': 0,
+            'quota_rejections': 0,
+            'sweeps': 0,
+        }
+
+    def init_app(self, app) -> None:
+        """
+        Configure the janitor from WORKSPACE_* settings and start the sweeper.
+
+        Args:
+            app: Flask application
+        """
+        self.stop()
+        self.root = app.config.get('WORKSPACE_ROOT') or None
+        self.max_age = app.config.get('WORKSPACE_MAX_AGE', self.max_age)
+        self.quota_bytes = app.config.get('WORKSPACE_QUOTA_BYTES', self.quota_bytes)
+        self.sweep_interval = app.config.get('WORKSPACE_SWEEP_INTERVAL', self.sweep_interval)
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+        if self.sweep_interval:
+            self.start()
+
+    @property
+    def workspace_root(self) -> str:
+        """Directory in which workspaces are created."""
+        return self.root or tempfile.gettempdir()
+
+    def create(self, required_bytes: int = 0) -> str:
+        """
+        Create a workspace after checking the disk quota.
+
+        Args:
+            required_bytes: Bytes the caller expects to write into it
+
+        Returns:
+            Path to the new workspace directory
+
+        Raises:
+            WorkspaceQuotaExceeded: If the quota cannot accommodate the request
+        """
+        self.ensure_capacity(required_bytes)
+        path = tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=self.workspace_root)
+        with self._lock:
+            self._reserved[path] = required_bytes
+            self.stats['bytes_in_use'] += required_bytes
+            self.stats['workspaces_created'] += 1
+        return path
+
+    def ensure_capacity(self, required_bytes: int) -> None:
+        """
+        Make sure ``required_bytes`` more fit within the quota, sweeping if needed.
+
+        Raises:
+            WorkspaceQuotaExceeded: If the quota is still exceeded after a sweep
+        """
+        if not self.quota_bytes:
+            return
+        if self.stats['bytes_in_use'] + required_bytes <= self.quota_bytes:
+            return
+
+        # Reclaim orphans before turning the request away
+        self.sweep()
+        if self.stats['bytes_in_use'] + required_bytes > self.quota_bytes:
+            with self._lock:
+                self.stats['quota_rejections'] += 1
+            raise WorkspaceQuotaExceeded(
+                f"Workspace quota of {self.quota_bytes} bytes exceeded"
+            )
+
+    def release(self, path: str) -> None:
+        """
+        Remove a workspace created with create().
+
+        Args:
+            path: Workspace directory
+        """
+        size = directory_size(path) if os.path.exists(path) else 0
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            reserved = self._reserved.pop(path, 0)
+            self.stats['bytes_in_use'] = max(self.stats['bytes_in_use'] - reserved, 0)
+            self.stats['bytes_reclaimed'] += size
+            self.stats['workspaces_released'] += 1
+
+    def sweep(self, max_age: Optional[float] = None) -> int:
+        """
+        Remove orphaned workspaces and recompute the bytes in use.
+
+        Workspaces still held by this process are never removed, whatever
+        their age.
+
+        Args:
+            max_age: Optional override of the orphan age in seconds
+
+        Returns:
+            Number of workspaces removed
+        """
+        max_age = self.max_age if max_age is None else max_age
+        cutoff = time.time() - max_age
+        removed = 0
+        reclaimed = 0
+        in_use = 0
+
+        try:
+            entries = list(os.scandir(self.workspace_root))
+        except OSError:
+            return 0
+
+        with self._lock:
+            held = dict(self._reserved)
+
+        for entry in entries:
+            if not entry.name.startswith(WORKSPACE_PREFIX) or not entry.is_dir(follow_symlinks=False):
+                continue
+            size = directory_size(entry.path)
+            try:
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+
+            if entry.path in held:
+                # A workspace still being filled counts for what it reserved
+                in_use += max(size, held[entry.path])
+            elif mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+                reclaimed += size
+            else:
+                in_use += size
+
+        with self._lock:
+            self.stats['bytes_in_use'] = in_use
+            self.stats['bytes_reclaimed'] += reclaimed
+            self.stats['orphans_removed'] += removed
+            self.stats['sweeps'] += 1
+        return removed
+
+    def start(self) -> None:
+        """Start the background sweeper thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='epubar-workspace-janitor', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background sweeper thread."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        """Sweep periodically until stopped."""
+        while not self._stop.wait(self.sweep_interval):
+            self.sweep()
+
+
+# Shared janitor used by EPUBProcessor
+workspace_janitor = WorkspaceJanitor()
@@ -0,0 +1,152 @@
+"""
+Keyset (cursor) pagination helpers.
+
+Instead of ``OFFSET``, each page continues strictly after the sort key of the
+last row of the previous page, so fetching page 100 costs the same indexed
+range scan as fetching page 1. Cursors are opaque, URL-safe strings.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    Encode sort-key values as an opaque cursor.
+
+    Args:
+        values: Sort-key values of the last row on a page
+
+    Returns:
+        URL-safe cursor string
+    """
+    encoded = [
+        {'dt': value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
+    ]
+    raw = json.dumps(encoded, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """
+    Decode a cursor produced by encode_cursor().
+
+    Args:
+        cursor: Cursor string
+
+    Returns:
+        List of sort-key values
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list):
+            raise ValueError("not a list")
+        return [_decode_value(value) for value in values]
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+
+def _decode_value(value: Any) -> Any:
+    """Decode one sort-key value, turning {'dt': ...} back into a datetime"""
+    if isinstance(value, dict) and 'dt' in value:
+        if not isinstance(value['dt'], str):
+            raise ValueError("datetime is not a string")
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def after_key(columns: Sequence[Any], values: Sequence[Any], descending: bool = True):
+    """
+    Build the filter selecting rows strictly after a sort key.
+
+    For columns (a, b) descending this is ``a < :a OR (a = :a AND b < :b)``,
+    which SQLite answers with a range scan on an index over (a, b).
+
+    Args:
+        columns: Sort columns, most significant first
+        values: Sort-key values of the last row seen
+        descending: Whether the sort order is descending
+
+    Returns:
+        SQLAlchemy boolean clause
+
+    Raises:
+        ValueError: If the values do not match the columns in number or type
+    """
+    if len(columns) != len(values):
+        raise ValueError("Invalid cursor")
+    for column, value in zip(columns, values):
+        _check_value(column, value)
+
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        beyond = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+
+def _check_value(column: Any, value: Any) -> None:
+    """Reject a cursor value the column's type cannot bind, such as a string for a date"""
+    if value is None:
+        return
+    try:
+        expected = column.type.python_type
+    except (AttributeError, NotImplementedError):
+        # Untyped expressions bind whatever they are given
+        return
+    if expected is float:
+        expected = (int, float)
+    if (isinstance(value, bool) and expected is not bool) or not isinstance(value, expected):
+        raise ValueError("Invalid cursor")
+
+
+def keyset_page(query, columns: Sequence[Any], cursor: Optional[str] = None,
+                limit: int = 50, descending: bool = True,
+                key_names: Optional[Sequence[str]] = None) -> Tuple[list, Optional[str]]:
+    """
+    Fetch one page of a query ordered by ``columns``.
+
+    Args:
+        query: SQLAlchemy query to paginate (without ORDER BY or LIMIT)
+        columns: Sort columns, most significant first; the last must be unique
+        cursor: Cursor returned with the previous page, or None for the first page
+        limit: Maximum number of rows per page
+        descending: Whether to sort in descending order
+        key_names: Attribute names holding the sort key on each row
+                   (defaults to the columns' keys)
+
+    Returns:
+        Tuple of (rows, next_cursor); next_cursor is None on the last page
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    if cursor:
+        query = query.filter(after_key(columns, decode_cursor(cursor), descending))
+
+    ordering = [column.desc() if descending else column.asc() for column in columns]
+    # Fetch one extra row to learn whether another page follows
+    rows = query.order_by(*ordering).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        names = key_names or [column.key for column in columns]
+        next_cursor = encode_cursor([_key_value(rows[-1], name) for name in names])
+    return rows, next_cursor
+
+
+def _key_value(row: Any, name: str) -> Any:
+    """Read a sort-key value from an ORM object or a result row"""
+    if hasattr(row, '_mapping') and name in row._mapping:
+        return row._mapping[name]
+    return getattr(row, name)
@@ -0,0 +1,271 @@
+"""
+Anchoring of annotations and reading positions to character offsets.
+
+Element IDs (``el-N``) depend on how the renderer numbers elements, so the
+durable anchor of a highlight or a reading position is its character offset
+in the chapter (see utils/epub/locations.py). Element-relative positions
+from the reader are converted to offsets when they are saved, and offsets
+are converted back to the current element IDs when they are served, using
+the chapter indexes built at ingest, so no chapter is parsed again.
+
+When chapters are rendered with block anchors (READER_ANCHOR_MODE), offsets
+are served relative to the innermost block-level element instead, and
+positions saved against inline elements by older clients are converted the
+same way.
+"""
+import json
+from typing import Any, Dict, Optional
+
+from flask import current_app
+from sqlalchemy import select, update
+
+from app.models.db import db
+from app.models.annotation import Annotation
+from app.models.chapter_location import ChapterLocation
+from app.models.reading_state import ReadingState
+from app.utils.epub.content import ANCHOR_BLOCKS
+from app.utils.epub.locations import ChapterLocations
+from app.utils.reading.progress import spine_index_of
+
+
+def load_book_locations(book_id: int) -> Dict[int, ChapterLocations]:
+    """
+    Load every chapter index of a book.
+
+    Args:
+        book_id: Book ID
+
+    Returns:
+        Dictionary mapping spine indexes to ChapterLocations
+    """
+    return {
+        row.spine_index: ChapterLocations.unpack(row.starts, row.ends, row.parents, row.length, row.blocks)
+        for row in ChapterLocation.query.filter_by(book_id=book_id)
+    }
+
+
+class BookLocations:
+    """
+    Lazily loaded chapter indexes of one book, for the span of a request.
+    """
+
+    def __init__(self, book_id: int, blocks_only: Optional[bool] = None):
+        """
+        Initialize the cache.
+
+        Args:
+            book_id: Book ID
+            blocks_only: Whether positions resolve to block-level elements
+                only (default: whether READER_ANCHOR_MODE is ANCHOR_BLOCKS)
+        """
+        self.book_id = book_id
+        if blocks_only is None:
+            blocks_only = current_app.config.get('READER_ANCHOR_MODE') == ANCHOR_BLOCKS
+        self.blocks_only = blocks_only
+        self._chapters: Dict[int, Optional[ChapterLocations]] = {}
+
+    def get(self, spine_index: Optional[int]) -> Optional[ChapterLocations]:
+        """
+        Return the index of a chapter.
+
+        Args:
+            spine_index: Spine index of the chapter
+
+        Returns:
+            ChapterLocations, or None if the chapter has not been indexed
+        """
+        if spine_index is None:
+            return None
+        if spine_index not in self._chapters:
+            row = ChapterLocation.query.filter_by(book_id=self.book_id, spine_index=spine_index).first()
+            self._chapters[spine_index] = ChapterLocations.unpack(
+                row.starts, row.ends, row.parents, row.length, row.blocks
+            ) if row else None
+        return self._chapters[spine_index]
+
+    def element_at(self, spine_index: Optional[int], offset: Optional[int]) -> Optional[str]:
+        """
+        Return the rendered element holding a chapter offset.
+
+        Args:
+            spine_index: Spine index of the chapter
+            offset: Chapter offset
+
+        Returns:
+            Element ID, or None if the chapter or offset is unknown
+        """
+        locations = self.get(spine_index)
+        if locations is None or offset is None:
+            return None
+        anchor = locations.element_at(offset, self.blocks_only)
+        return anchor[0] if anchor else None
+
+
+def anchor_range(position_data: Any, locations: Optional[ChapterLocations]):
+    """
+    Convert an element-relative selection to a chapter character range.
+
+    Args:
+        position_data: Parsed position data with ``element``, ``start`` and ``end``
+        locations: Index of the annotation's chapter
+
+    Returns:
+        Tuple of (start_offset, end_offset), or None if it cannot be converted
+    """
+    if locations is None or not isinstance(position_data, dict):
+        return None
+    start, end = position_data.get('start'), position_data.get('end')
+    if not isinstance(start, int) or not isinstance(end, int) or isinstance(start, bool) or end < start:
+        return None
+    start_offset = locations.offset_of(position_data.get('element'), start)
+    if start_offset is None:
+        return None
+    return start_offset, min(start_offset + end - start, locations.length)
+
+
+def relocate(position_data: Any, start_offset: Optional[int], end_offset: Optional[int],
+             locations: Optional[ChapterLocations], blocks_only: bool = False) -> Any:
+    """
+    Point an annotation's element-relative fields at the current elements.
+
+    Args:
+        position_data: Parsed position data
+        start_offset: Stored start of the character range
+        end_offset: Stored end of the character range
+        locations: Index of the annotation's chapter
+        blocks_only: Resolve to the innermost block-level element
+
+    Returns:
+        Position data with ``element``, ``start`` and ``end`` resolved from
+        the offsets, or the original data if they cannot be resolved
+    """
+    if locations is None or start_offset is None or end_offset is None or not isinstance(position_data, dict):
+        return position_data
+    anchor = locations.element_at(start_offset, blocks_only)
+    if anchor is None:
+        return position_data
+    element_id, local = anchor
+    return dict(position_data, element=element_id, start=local, end=local + end_offset - start_offset)
+
+
+def block_position(position_data: Any, locations: Optional[ChapterLocations]) -> Any:
+    """
+    Convert an ``el-N`` position to the block anchor holding it.
+
+    Args:
+        position_data: Parsed position data with ``element``, ``start`` and ``end``
+        locations: Index of the position's chapter
+
+    Returns:
+        Position data relative to the innermost block-level element, or the
+        original data if it cannot be converted
+    """
+    offsets = anchor_range(position_data, locations)
+    if offsets is None:
+        return position_data
+    return relocate(position_data, *offsets, locations, blocks_only=True)
+
+
+def anchor_position_data(values: Dict[str, Any], locations: BookLocations) -> None:
+    """
+    Store the offsets of an element-relative annotation, in place.
+
+    Args:
+        values: Column values from parse_annotation(), with chapter_index
+        locations: Chapter indexes of the annotation's book
+    """
+    position_data = json.loads(values['position_data'])
+    offsets = anchor_range(position_data, locations.get(values.get('chapter_index')))
+    if offsets is None:
+        return
+    values['start_offset'], values['end_offset'] = offsets
+    position_data['start_offset'], position_data['end_offset'] = offsets
+    values['position_data'] = json.dumps(position_data, separators=(',', ':'))
+
+
+def move_offset(offset: Optional[int], old: Optional[ChapterLocations],
+                new: Optional[ChapterLocations]) -> Optional[int]:
+    """
+    Carry a chapter offset from an old index of a chapter to a rebuilt one.
+
+    The offset keeps its element and its position within the element, so it
+    survives changes to how the chapter's text is counted.
+
+    Args:
+        offset: Offset in the old index
+        old: Index the offset was computed with
+        new: Rebuilt index
+
+    Returns:
+        Offset in the rebuilt index, or the original offset if it cannot be moved
+    """
+    if offset is None or old is None or new is None:
+        return offset
+    anchor = old.element_at(offset)
+    if anchor is None:
+        return offset
+    moved = new.offset_of(*anchor)
+    return offset if moved is None else moved
+
+
+def reanchor_book(book_id: int, old: Dict[int, ChapterLocations],
+                  new: Dict[int, ChapterLocations]) -> int:
+    """
+    Move a book's stored annotation and reading offsets to rebuilt chapter indexes.
+
+    Runs in the caller's transaction.
+
+    Args:
+        book_id: Book ID
+        old: Previous chapter indexes by spine index
+        new: Rebuilt chapter indexes by spine index
+
+    Returns:
+        Number of annotations and reading states changed
+    """
+    changed_chapters = {
+        spine_index for spine_index, locations in old.items()
+        if spine_index in new
+        and (locations.length, locations.pack()) != (new[spine_index].length, new[spine_index].pack())
+    }
+    if not changed_chapters:
+        return 0
+
+    session = db.session
+    changed = 0
+    rows = session.execute(
+        select(Annotation.id, Annotation.chapter_index, Annotation.start_offset, Annotation.end_offset,
+               Annotation.position_data)
+        .where(Annotation.book_id == book_id, Annotation.chapter_index.in_(changed_chapters),
+               Annotation.start_offset.is_not(None))
+    )
+    for row in rows.all():
+        start = move_offset(row.start_offset, old[row.chapter_index], new[row.chapter_index])
+        end = max(move_offset(row.end_offset, old[row.chapter_index], new[row.chapter_index]), start)
+        if (start, end) == (row.start_offset, row.end_offset):
+            continue
+        position_data = json.loads(row.position_data)
+        if isinstance(position_data, dict):
+            position_data['start_offset'], position_data['end_offset'] = start, end
+        session.execute(
+            update(Annotation).where(Annotation.id == row.id).values(
+                start_offset=start, end_offset=end,
+                position_data=json.dumps(position_data, separators=(',', ':'))
+            )
+        )
+        changed += 1
+
+    states = session.execute(
+        select(ReadingState.id, ReadingState.current_position, ReadingState.chapter_offset)
+        .where(ReadingState.book_id == book_id, ReadingState.chapter_offset.is_not(None))
+    )
+    for state in states.all():
+        spine_index = spine_index_of(state.current_position)
+        if spine_index not in changed_chapters:
+            continue
+        offset = move_offset(state.chapter_offset, old[spine_index], new[spine_index])
+        if offset != state.chapter_offset:
+            session.execute(update(ReadingState).where(ReadingState.id == state.id).values(chapter_offset=offset))
+            changed += 1
+    return changed
+
@@ -0,0 +1,403 @@
+"""
+Validation, serialization, per-chapter loading and batch writes of annotations.
+
+The reader loads annotations one chapter at a time, as compact rows selected
+through the (user_id, book_id, chapter_index) index, so a book with thousands
+of highlights costs only the current chapter's share. Character ranges from
+``position_data`` are kept in indexed ``start_offset``/``end_offset`` columns
+for overlap queries.
+
+A batch is a list of create, update and delete operations for one book. Every
+operation is validated first; the valid ones are then applied in a single
+transaction with one bulk INSERT, one bulk UPDATE per column set and one
+DELETE, so importing thousands of highlights costs a handful of statements
+instead of a request and a commit each.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, delete, func, insert, or_, select, update
+
+from app.models.db import db
+from app.models.annotation import Annotation, AnnotationType
+from app.utils.query.keyset import keyset_page
+from app.utils.reading.anchors import BookLocations, anchor_position_data, relocate
+
+
+# Operations accepted in a batch
+BATCH_OPERATIONS = ('create', 'update', 'delete')
+
+# Columns of the compact per-chapter representation, in row order
+COMPACT_FIELDS = ('id', 'chapter_index', 'start_offset', 'end_offset', 'type', 'color', 'content',
+                  'position_data', 'created_at')
+
+
+class AnnotationError(ValueError):
+    """Raised when annotation data fails validation."""
+
+
+def parse_annotation(data: Any, partial: bool = False,
+                     locations: Optional[BookLocations] = None) -> Dict[str, Any]:
+    """
+    Validate client data and convert it to column values.
+
+    Args:
+        data: Dictionary received from the client
+        partial: Whether missing fields are allowed (updates)
+        locations: Chapter indexes of the book; when given, element-relative
+                   selections are anchored to the chapter's character offsets
+
+    Returns:
+        Dictionary of column values
+
+    Raises:
+        AnnotationError: If the data is invalid
+    """
+    if not isinstance(data, dict):
+        raise AnnotationError("Annotation must be an object")
+
+    values = {}
+    if 'type' in data or not partial:
+        try:
+            values['type'] = AnnotationType(data.get('type', 'highlight'))
+        except ValueError:
+            raise AnnotationError(f"Unknown annotation type: {data.get('type')}")
+
+    if 'position_data' in data or not partial:
+        position_data = data.get('position_data')
+        if isinstance(position_data, str):
+            try:
+                position_data = json.loads(position_data)
+            except ValueError:
+                raise AnnotationError("position_data must be valid JSON")
+        elif not isinstance(position_data, (dict, list)):
+            raise AnnotationError("position_data is required")
+        values['position_data'] = json.dumps(position_data, separators=(',', ':'))
+        values['start_offset'], values['end_offset'] = character_range(position_data)
+
+    if 'chapter_index' in data or not partial:
+        chapter_index = data.get('chapter_index')
+        if chapter_index is not None and (
+                isinstance(chapter_index, bool) or not isinstance(chapter_index, int) or chapter_index < 0):
+            raise AnnotationError("chapter_index must be a non-negative integer")
+        values['chapter_index'] = chapter_index
+
+    for field in ('content', 'color'):
+        if field in data or not partial:
+            value = data.get(field)
+            if value is not None and not isinstance(value, str):
+                raise AnnotationError(f"{field} must be a string")
+            values[field] = value
+
+    if values.get('color') and len(values['color']) > 50:
+        raise AnnotationError("color must be at most 50 characters")
+
+    if locations is not None and 'position_data' in values and 'chapter_index' in values:
+        anchor_position_data(values, locations)
+
+    return values
+
+
+def character_range(position_data: Any) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Extract the chapter-level character range from position data.
+
+    The range is ``start_offset``/``end_offset``; ``start``/``end`` are used
+    only when they are not relative to an ``element``.
+
+    Args:
+        position_data: Parsed position data
+
+    Returns:
+        Tuple of (start_offset, end_offset), or (None, None) if there is no range
+
+    Raises:
+        AnnotationError: If the range is malformed
+    """
+    if not isinstance(position_data, dict):
+        return None, None
+
+    start, end = position_data.get('start_offset'), position_data.get('end_offset')
+    if start is None and end is None and 'element' not in position_data:
+        start, end = position_data.get('start'), position_data.get('end')
+    if start is None and end is None:
+        return None, None
+
+    if not (_is_id(start) and _is_id(end)) or start < 0 or end < start:
+        raise AnnotationError("start_offset and end_offset must be ordered non-negative integers")
+    return start, end
+
+
+def serialize_annotation(annotation: Annotation) -> Dict[str, Any]:
+    """
+    Convert an annotation to its JSON representation.
+
+    Args:
+        annotation: Annotation model instance
+
+    Returns:
+        Dictionary suitable for jsonify()
+    """
+    return {
+        'id': annotation.id,
+        'book_id': annotation.book_id,
+        'type': annotation.type.value,
+        'content': annotation.content,
+        'color': annotation.color,
+        'position_data': json.loads(annotation.position_data),
+        'chapter_index': annotation.chapter_index,
+        'start_offset': annotation.start_offset,
+        'end_offset': annotation.end_offset,
+        'created_at': annotation.created_at.isoformat() if annotation.created_at else None,
+        'updated_at': annotation.updated_at.isoformat() if annotation.updated_at else None
+    }
+
+
+def chapter_annotations(user_id: int, book_id: int, first_chapter: int,
+                        last_chapter: Optional[int] = None, cursor: Optional[str] = None,
+                        limit: int = 1000, unplaced: bool = False) -> Tuple[list, Optional[str]]:
+    """
+    Load one page of a book's annotations in a range of chapters.
+
+    Only the compact columns are selected, ordered by (chapter_index, id),
+    which the (user_id, book_id, chapter_index) index answers without sorting.
+    Annotations saved without a chapter (older clients sent none) belong to
+    no range; ``unplaced`` adds all of them ahead of the first page.
+
+    Args:
+        user_id: Owner of the annotations
+        book_id: Book ID
+        first_chapter: First chapter index of the range
+        last_chapter: Last chapter index of the range (inclusive, None for the end)
+        cursor: Cursor returned with the previous page
+        limit: Maximum number of annotations per page (not counting
+               annotations without a chapter)
+        unplaced: Whether to include annotations without a chapter in the
+                  first page
+
+    Returns:
+        Tuple of (rows, next_cursor)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    columns = [getattr(Annotation, field) for field in COMPACT_FIELDS]
+    query = db.session.query(*columns).filter(
+        Annotation.user_id == user_id,
+        Annotation.book_id == book_id,
+        Annotation.chapter_index >= first_chapter
+    )
+    if last_chapter is not None:
+        query = query.filter(Annotation.chapter_index <= last_chapter)
+
+    rows, next_cursor = keyset_page(query, (Annotation.chapter_index, Annotation.id), cursor=cursor,
+                                    limit=limit, descending=False)
+    if unplaced and not cursor:
+        rows = db.session.query(*columns).filter(
+            Annotation.user_id == user_id,
+            Annotation.book_id == book_id,
+            Annotation.chapter_index.is_(None)
+        ).order_by(Annotation.id).all() + rows
+    return rows, next_cursor
+
+
+# Overlap queries are built once with bound parameters: constructing the
+# expressions costs far more than the two index lookups they run
+_IN_CHAPTER = (
+    Annotation.user_id == bindparam('user_id'),
+    Annotation.book_id == bindparam('book_id'),
+    Annotation.chapter_index == bindparam('chapter_index')
+)
+_LONGEST_SPAN = select(func.max(Annotation.end_offset - Annotation.start_offset)).where(*_IN_CHAPTER)
+_OVERLAPPING = select(*[getattr(Annotation, field) for field in COMPACT_FIELDS]).where(
+    *_IN_CHAPTER,
+    Annotation.start_offset >= bindparam('lowest_start'),
+    Annotation.start_offset < bindparam('end'),
+    or_(Annotation.end_offset > bindparam('start'), Annotation.start_offset == bindparam('start'))
+).order_by(Annotation.start_offset, Annotation.id)
+
+
+def overlapping_annotations(user_id: int, book_id: int, chapter_index: int,
+                            start: int, end: int) -> list:
+    """
+    Load the annotations of a chapter whose ranges overlap ``[start, end)``.
+
+    A range [s, e) overlaps when ``s < end and e > start``. Scanning the
+    start_offset index for ``s < end`` alone would visit every earlier
+    annotation, so the scan is bounded below by ``start`` minus the longest
+    span in the chapter, read from the span expression index. Empty ranges
+    (bookmarks) count as overlapping when they lie inside ``[start, end)``.
+
+    Args:
+        user_id: Owner of the annotations
+        book_id: Book ID
+        chapter_index: Chapter index
+        start: First character offset of the range
+        end: Offset just past the last character of the range
+
+    Returns:
+        Rows selecting COMPACT_FIELDS, ordered by start_offset
+    """
+    params = {'user_id': user_id, 'book_id': book_id, 'chapter_index': chapter_index}
+    longest = db.session.execute(_LONGEST_SPAN, params).scalar()
+    if longest is None:
+        return []
+
+    return db.session.execute(_OVERLAPPING, {
+        **params,
+        'start': start,
+        'end': max(end, start + 1),
+        'lowest_start': start - longest
+    }).all()
+
+
+def compact_annotations(rows: list, next_cursor: Optional[str] = None,
+                        locations: Optional[BookLocations] = None) -> Dict[str, Any]:
+    """
+    Serialize rows from chapter_annotations() as a field list plus value arrays.
+
+    Args:
+        rows: Rows selecting COMPACT_FIELDS
+        next_cursor: Cursor of the following page, if any
+        locations: Chapter indexes of the book; when given, element-relative
+                   fields are resolved from the stored offsets
+
+    Returns:
+        Dictionary with ``fields``, ``annotations`` and ``next_cursor``
+    """
+    return {
+        'fields': COMPACT_FIELDS,
+        'annotations': [
+            [
+                row.id,
+                row.chapter_index,
+                row.start_offset,
+                row.end_offset,
+                row.type.value,
+                row.color,
+                row.content,
+                _served_position(row, locations),
+                row.created_at.isoformat() if row.created_at else None
+            ]
+            for row in rows
+        ],
+        'next_cursor': next_cursor
+    }
+
+
+def _served_position(row, locations: Optional[BookLocations]) -> Any:
+    """Position data of a row, pointed at the chapter's current elements"""
+    position_data = json.loads(row.position_data)
+    if locations is None:
+        return position_data
+    return relocate(position_data, row.start_offset, row.end_offset, locations.get(row.chapter_index),
+                    locations.blocks_only)
+
+
+def apply_batch(user_id: int, book_id: int, operations: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Validate and apply a batch of annotation operations in one transaction.
+
+    Each operation is ``{"op": "create", ...fields}``,
+    ``{"op": "update", "id": 1, ...fields}`` or ``{"op": "delete", "id": 1}``.
+    Invalid operations are reported and skipped; the valid ones are committed
+    together.
+
+    Args:
+        user_id: Owner of the annotations
+        book_id: Book the annotations belong to
+        operations: List of operations
+
+    Returns:
+        One result per operation, in order, with ``status`` set to
+        created, updated, deleted or error
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(operations)
+    creates, updates, deletes = [], [], []
+    now = datetime.utcnow()
+    locations = BookLocations(book_id)
+
+    # Annotations of this book that updates and deletes may target
+    requested_ids = {
+        op['id'] for op in operations
+        if isinstance(op, dict) and op.get('op') in ('update', 'delete') and _is_id(op.get('id'))
+    }
+    owned = set()
+    if requested_ids:
+        owned = set(db.session.scalars(
+            db.select(Annotation.id).where(
+                Annotation.user_id == user_id,
+                Annotation.book_id == book_id,
+                Annotation.id.in_(requested_ids)
+            )
+        ))
+
+    targeted = set()
+    for index, op in enumerate(operations):
+        try:
+            kind = op.get('op') if isinstance(op, dict) else None
+            if kind not in BATCH_OPERATIONS:
+                raise AnnotationError(f"op must be one of {', '.join(BATCH_OPERATIONS)}")
+
+            if kind == 'create':
+                values = parse_annotation(op, locations=locations)
+                creates.append((index, {
+                    'user_id': user_id,
+                    'book_id': book_id,
+                    'created_at': now,
+                    'updated_at': now,
+                    **values
+                }))
+                continue
+
+            annotation_id = op.get('id')
+            if not _is_id(annotation_id) or annotation_id not in owned:
+                raise AnnotationError(f"Annotation {annotation_id} not found")
+            if annotation_id in targeted:
+                raise AnnotationError(f"Annotation {annotation_id} appears twice in the batch")
+            targeted.add(annotation_id)
+
+            if kind == 'update':
+                values = parse_annotation(op, partial=True, locations=locations)
+                updates.append((index, {'id': annotation_id, 'updated_at': now, **values}))
+            else:
+                deletes.append((index, annotation_id))
+        except AnnotationError as e:
+            results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+
+    session = db.session
+    if creates:
+        # SQLite assigns rowids in VALUES order while the write lock is held,
+        # so sorted ids line up with the parameters; asking SQLAlchemy to
+        # guarantee the order would fall back to one INSERT per row
+        ids = sorted(session.scalars(
+            insert(Annotation).returning(Annotation.id),
+            [values for _, values in creates]
+        ).all())
+        for (index, _), annotation_id in zip(creates, ids):
+            results[index] = {'index': index, 'status': 'created', 'id': annotation_id}
+
+    # Rows differ in which columns they set, so group them for executemany
+    groups: Dict[tuple, list] = {}
+    for index, values in updates:
+        groups.setdefault(tuple(sorted(values)), []).append(values)
+        results[index] = {'index': index, 'status': 'updated', 'id': values['id']}
+    for rows in groups.values():
+        session.execute(update(Annotation), rows)
+
+    if deletes:
+        session.execute(
+            delete(Annotation).where(Annotation.id.in_([annotation_id for _, annotation_id in deletes])),
+            execution_options={'synchronize_session': False}
+        )
+        for index, annotation_id in deletes:
+            results[index] = {'index': index, 'status': 'deleted', 'id': annotation_id}
+
+    session.commit()
+    return results
+
+
+def _is_id(value: Any) -> bool:
+    """Whether a value can be an annotation ID"""
+    return isinstance(value, int) and not isinstance(value, bool)
@@ -0,0 +1,300 @@
+"""
+Write-behind buffer for reading positions.
+
+``reader.js`` reports the reader's position every few seconds while the user
+scrolls. Instead of committing a transaction per report, the latest position
+per (user, book) is kept in memory and written in one batched transaction per
+flush interval (and at shutdown). Reads consult the buffer first, so users
+always see their newest position. The durability window is the flush
+interval: positions reported since the last flush are lost if the process
+dies.
+"""
+import atexit
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.models.db import db
+from app.models.reading_state import ReadingState
+
+
+@dataclass
+class PendingPosition:
+    """Latest unflushed reading state of one (user, book) pair."""
+    position: Optional[str] = None
+    is_finished: Optional[bool] = None
+    progress_percent: Optional[float] = None
+    chapter_offset: Optional[int] = None
+    last_read_at: Optional[datetime] = None
+
+
+class PositionBuffer:
+    """
+    In-memory buffer coalescing reading-position updates.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, max_pending: int = 5000):
+        """
+        Initialize the buffer.
+
+        Args:
+            flush_interval: Seconds between flushes; 0 writes every update through
+            max_pending: Number of buffered pairs that triggers an early flush
+        """
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[Tuple[int, int], PendingPosition] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._atexit_registered = False
+        self.stats = {
+            'updates': 0,
+            'pending': 0,
+            'flushes': 0,
+            'rows_flushed': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    def init_app(self, app) -> None:
+        """
+        Configure the buffer from POSITION_* settings and start the flusher.
+
+        Args:
+            app: Flask application
+        """
+        self.stop()
+        self.app = app
+        self.flush_interval = app.config.get('POSITION_FLUSH_INTERVAL', self.flush_interval)
+        self.max_pending = app.config.get('POSITION_MAX_PENDING', self.max_pending)
+        if self.enabled:
+            self.start()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether updates are buffered rather than written through."""
+        return self.flush_interval > 0
+
+    def record(self, user_id: int, book_id: int, position: Optional[str] = None,
+               is_finished: Optional[bool] = None,
+               progress_percent: Optional[float] = None,
+               chapter_offset: Optional[int] = None) -> PendingPosition:
+        """
+        Buffer a reading-state update, replacing older unflushed values.
+
+        Args:
+            user_id: Reader's user ID
+            book_id: Book ID
+            position: New position, or None to keep the current one
+            is_finished: New finished flag, or None to keep the current one
+            progress_percent: New progress, or None to keep the current one
+            chapter_offset: Character offset of the new position in its chapter
+
+        Returns:
+            Copy of the merged pending state of the pair
+        """
+        with self._lock:
+            pending = self._pending.setdefault((user_id, book_id), PendingPosition())
+            if position is not None:
+                pending.position = position
+                pending.chapter_offset = chapter_offset
+            if is_finished is not None:
+                pending.is_finished = is_finished
+            if progress_percent is not None:
+                pending.progress_percent = progress_percent
+            pending.last_read_at = datetime.utcnow()
+            self.stats['updates'] += 1
+            self.stats['pending'] = len(self._pending)
+            full = len(self._pending) >= self.max_pending
+            merged = PendingPosition(**vars(pending))
+
+        if full:
+            self._wake.set()
+        return merged
+
+    def get(self, user_id: int, book_id: int) -> Optional[PendingPosition]:
+        """
+        Return the unflushed state of a pair, if any.
+
+        Args:
+            user_id: Reader's user ID
+            book_id: Book ID
+        """
+        with self._lock:
+            pending = self._pending.get((user_id, book_id))
+            return PendingPosition(**vars(pending)) if pending else None
+
+    def overlay(self, reading_state: Optional[ReadingState]) -> Optional[ReadingState]:
+        """
+        Show buffered values on a loaded ReadingState without marking it dirty.
+
+        Args:
+            reading_state: ReadingState loaded from the database
+
+        Returns:
+            The same object
+        """
+        if reading_state is None:
+            return None
+        pending = self.get(reading_state.user_id, reading_state.book_id)
+        if pending:
+            if pending.position is not None:
+                set_committed_value(reading_state, 'current_position', pending.position)
+                set_committed_value(reading_state, 'chapter_offset', pending.chapter_offset)
+            if pending.is_finished is not None:
+                set_committed_value(reading_state, 'is_finished', pending.is_finished)
+            if pending.progress_percent is not None:
+                set_committed_value(reading_state, 'progress_percent', pending.progress_percent)
+            set_committed_value(reading_state, 'last_read_at', pending.last_read_at)
+        return reading_state
+
+    def flush(self) -> int:
+        """
+        Write all buffered positions in one transaction.
+
+        Returns:
+            Number of (user, book) pairs written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self.stats['pending'] = 0
+            if not batch:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                if self.app is not None:
+                    with self.app.app_context():
+                        self._write(batch)
+                else:
+                    self._write(batch)
+            except Exception:
+                self._requeue(batch)
+                raise
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['rows_flushed'] += len(batch)
+                self.stats['last_batch_size'] = len(batch)
+                self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+                self.stats['last_flush_ms'] = round(elapsed_ms, 3)
+                self.stats['max_flush_ms'] = round(max(self.stats['max_flush_ms'], elapsed_ms), 3)
+                self.stats['total_flush_ms'] = round(self.stats['total_flush_ms'] + elapsed_ms, 3)
+            return len(batch)
+
+    def _write(self, batch: Dict[Tuple[int, int], PendingPosition]) -> None:
+        """Apply a batch with one bulk UPDATE and one bulk INSERT."""
+        session = db.session
+        # One lookup per flush on the (user_id, book_id) index; it reads only
+        # the batch's users and books, so its cost follows the batch size
+        rows = session.query(ReadingState.user_id, ReadingState.book_id, ReadingState.id)\
+            .filter(ReadingState.user_id.in_({user_id for user_id, _ in batch}),
+                    ReadingState.book_id.in_({book_id for _, book_id in batch}))\
+            .all()
+        existing = {
+            (user_id, book_id): state_id
+            for user_id, book_id, state_id in rows
+            if (user_id, book_id) in batch
+        }
+
+        now = datetime.utcnow()
+        updates, inserts = [], []
+        for key, pending in batch.items():
+            values = {'last_read_at': pending.last_read_at, 'updated_at': now}
+            if pending.position is not None:
+                values['current_position'] = pending.position
+                values['chapter_offset'] = pending.chapter_offset
+            if pending.is_finished is not None:
+                values['is_finished'] = pending.is_finished
+            if pending.progress_percent is not None:
+                values['progress_percent'] = pending.progress_percent
+
+            state_id = existing.get(key)
+            if state_id is not None:
+                updates.append({'id': state_id, **values})
+            else:
+                values.setdefault('current_position', '0:0')
+                values.setdefault('is_finished', False)
+                inserts.append({'user_id': key[0], 'book_id': key[1], 'created_at': now, **values})
+
+        # Rows differ in which columns they set, so group them for executemany
+        for group in _group_by_columns(updates):
+            session.execute(update(ReadingState), group)
+        for group in _group_by_columns(inserts):
+            session.execute(insert(ReadingState), group)
+        session.commit()
+
+    def _requeue(self, batch: Dict[Tuple[int, int], PendingPosition]) -> None:
+        """Put a failed batch back without overwriting newer updates."""
+        with self._lock:
+            for key, pending in batch.items():
+                newer = self._pending.get(key)
+                if newer is None:
+                    self._pending[key] = pending
+                else:
+                    if newer.position is None:
+                        newer.position = pending.position
+                        newer.chapter_offset = pending.chapter_offset
+                    if newer.is_finished is None:
+                        newer.is_finished = pending.is_finished
+                    if newer.progress_percent is None:
+                        newer.progress_percent = pending.progress_percent
+            self.stats['pending'] = len(self._pending)
+
+    def start(self) -> None:
+        """Start the background flusher and flush again at interpreter exit."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='epubar-position-flusher', daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def stop(self) -> None:
+        """Stop the flusher and write any remaining positions."""
+        if self._thread:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=10)
+            self._thread = None
+        if self._pending:
+            self.flush()
+
+    def _run(self) -> None:
+        """Flush every interval, or early when the buffer fills up."""
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                if self.app is not None:
+                    self.app.logger.error(f"Error flushing reading positions: {str(e)}")
+
+
+def _group_by_columns(rows):
+    """Split parameter dictionaries into groups sharing the same keys."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return list(groups.values())
+
+
+# Shared buffer used by the reader routes
+position_buffer = PositionBuffer()
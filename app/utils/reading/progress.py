@@ -0,0 +1,121 @@
+"""
+Reading progress from per-chapter text weights.
+
+While a book's text is indexed, the characters and words of every spine item
+are counted and stored on the book as cumulative character offsets
+(``Book.chapter_weights``), so chapter i covers characters
+``[starts[i], starts[i + 1])``. A position then maps to a percentage with two
+list lookups, and the result is stored on the reading state when the
+position is saved; listing pages only read the stored value.
+"""
+import json
+from typing import Dict, List, Optional
+
+# Words on a printed page, used to derive Book.total_pages
+WORDS_PER_PAGE = 250
+
+
+class ChapterWeights:
+    """
+    Accumulates character and word counts per spine item.
+    """
+
+    def __init__(self, spine_length: int):
+        """
+        Initialize the counters.
+
+        Args:
+            spine_length: Number of items in the book's spine
+        """
+        self.chars = [0] * spine_length
+        self.words = 0
+
+    def add(self, spine_index: int, text: str) -> None:
+        """
+        Count a piece of whitespace-normalized text.
+
+        Args:
+            spine_index: Spine item the text belongs to
+            text: Text with single spaces between words
+        """
+        self.chars[spine_index] += len(text)
+        if text:
+            self.words += text.count(' ') + 1
+
+    def starts(self) -> List[int]:
+        """Return the cumulative character offset of every chapter and the total."""
+        starts = [0]
+        for count in self.chars:
+            starts.append(starts[-1] + count)
+        return starts
+
+    def columns(self) -> Dict[str, object]:
+        """
+        Return the Book column values derived from the counts.
+
+        Returns:
+            Dictionary with chapter_weights, word_count and total_pages
+        """
+        return {
+            'chapter_weights': json.dumps(self.starts(), separators=(',', ':')),
+            'word_count': self.words,
+            'total_pages': -(-self.words // WORDS_PER_PAGE),
+        }
+
+
+def load_starts(chapter_weights: Optional[str]) -> Optional[List[int]]:
+    """
+    Parse the stored cumulative offsets of a book.
+
+    Args:
+        chapter_weights: Value of Book.chapter_weights
+
+    Returns:
+        List of offsets, or None if the book has not been weighed
+    """
+    if not chapter_weights:
+        return None
+    try:
+        starts = json.loads(chapter_weights)
+    except ValueError:
+        return None
+    return starts if isinstance(starts, list) and len(starts) > 1 else None
+
+
+def spine_index_of(position: Optional[str]) -> Optional[int]:
+    """
+    Read the spine index from a ``spineIndex:...`` position.
+
+    Args:
+        position: Stored reading position
+
+    Returns:
+        Spine index, or None if the position is malformed
+    """
+    head = (position or '').split(':', 1)[0]
+    return int(head) if head.isdigit() else None
+
+
+def progress_percent(starts: Optional[List[int]], spine_index: Optional[int],
+                     chapter_fraction: float = 0.0, is_finished: bool = False) -> Optional[float]:
+    """
+    Convert a position to a percentage of the book's text.
+
+    Args:
+        starts: Cumulative chapter offsets from load_starts()
+        spine_index: Current spine item
+        chapter_fraction: How far into the spine item the reader is (0 to 1)
+        is_finished: Whether the book is finished
+
+    Returns:
+        Percentage rounded to one decimal, or None if it cannot be computed
+    """
+    if is_finished:
+        return 100.0
+    if not starts or spine_index is None or starts[-1] == 0:
+        return None
+    if spine_index >= len(starts) - 1:
+        return 100.0
+    fraction = min(max(chapter_fraction or 0.0, 0.0), 1.0)
+    start, end = starts[spine_index], starts[spine_index + 1]
+    return round((start + (end - start) * fraction) * 100 / starts[-1], 1)
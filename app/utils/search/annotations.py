@@ -0,0 +1,97 @@
+"""
+Full-text search over annotations.
+
+The ``annotations_fts`` FTS5 index holds each annotation's note and the text
+it highlights (``position_data.text``). Triggers on ``annotations`` update it
+in the same transaction as the write, so single edits, batches and deletes
+are searchable as soon as they commit. Hits are ranked with bm25 and can be
+narrowed by type, color and book.
+"""
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+
+from app.models.db import db
+from app.models.annotation import Annotation, AnnotationType
+from app.utils.reading.annotations import serialize_annotation
+from app.utils.search.fulltext import MATCH_END, MATCH_START, fts_query, highlight_snippet
+
+
+# CROSS JOIN keeps the FTS index as the outer loop; otherwise SQLite may walk
+# every annotation of the user and probe the index once per row
+_SEARCH_SQL = """
+    SELECT a.id, b.title,
+           snippet(annotations_fts, -1, :match_start, :match_end, '…', :snippet_tokens) AS snippet,
+           bm25(annotations_fts) AS score
+    FROM annotations_fts
+    CROSS JOIN annotations a ON a.id = annotations_fts.rowid
+    JOIN books b ON b.id = a.book_id
+    WHERE annotations_fts MATCH :query AND a.user_id = :user_id {filters}
+    ORDER BY score
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def search_annotations(user_id: int, query: str, annotation_type: Optional[str] = None,
+                       color: Optional[str] = None, book_id: Optional[int] = None,
+                       limit: int = 20, offset: int = 0, snippet_tokens: int = 12) -> List[Dict[str, Any]]:
+    """
+    Find the best-ranked annotations matching a query.
+
+    Args:
+        user_id: Owner of the annotations
+        query: Search text entered by the user
+        annotation_type: Optional type to search (highlight, note or bookmark)
+        color: Optional highlight color to search
+        book_id: Optional book to search within
+        limit: Maximum number of hits
+        offset: Number of hits to skip
+        snippet_tokens: Approximate snippet length in words
+
+    Returns:
+        Serialized annotations with the book title, escaped snippet and score
+
+    Raises:
+        ValueError: If the query contains no words or the type is unknown
+    """
+    params = {
+        'query': fts_query(query),
+        'user_id': user_id,
+        'limit': limit,
+        'offset': offset,
+        'match_start': MATCH_START,
+        'match_end': MATCH_END,
+        'snippet_tokens': snippet_tokens,
+    }
+    filters = []
+    if annotation_type:
+        try:
+            # The type column stores enum names
+            params['type'] = AnnotationType(annotation_type).name
+        except ValueError:
+            raise ValueError(f"Unknown annotation type: {annotation_type}")
+        filters.append('AND a.type = :type')
+    if color:
+        params['color'] = color
+        filters.append('AND a.color = :color')
+    if book_id is not None:
+        params['book_id'] = book_id
+        filters.append('AND a.book_id = :book_id')
+
+    rows = db.session.execute(text(_SEARCH_SQL.format(filters=' '.join(filters))), params).all()
+    if not rows:
+        return []
+
+    # Load the page's annotations in one query and keep the ranked order
+    annotations = {
+        annotation.id: annotation
+        for annotation in Annotation.query.filter(Annotation.id.in_([row.id for row in rows]))
+    }
+    hits = []
+    for row in rows:
+        hit = serialize_annotation(annotations[row.id])
+        hit['book_title'] = row.title
+        hit['snippet'] = highlight_snippet(row.snippet)
+        hit['score'] = round(-row.score, 4)
+        hits.append(hit)
+    return hits
@@ -0,0 +1,329 @@
+"""
+Full-text search over book contents.
+
+At ingest every spine item is streamed through ContentProcessor.iter_text()
+and stored one element per row in ``book_text_segments``; the
+``book_text_fts`` FTS5 index follows that table through triggers. Books are
+indexed one at a time, each in its own short transaction, so the index grows
+incrementally and never needs a library-wide rebuild. Books that predate the
+index are picked up by a background backfill, a few per interval.
+"""
+import html
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, insert, text, update
+
+from app.models.db import db
+from app.models.book import Book
+from app.models.book_artifact import stamp_artifact
+from app.models.book_text import BookTextSegment
+from app.models.chapter_location import ChapterLocation
+from app.utils.epub.content import ContentProcessor
+from app.utils.epub.locations import ChapterLocations
+from app.utils.epub.metadata import MetadataExtractor
+from app.utils.epub.processor import EPUBProcessor
+from app.utils.reading.anchors import load_book_locations, reanchor_book
+from app.utils.reading.progress import ChapterWeights
+
+
+# Markers placed around matches by snippet(), replaced after escaping
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+_SEARCH_SQL = """
+    SELECT s.book_id, b.title, b.author, s.spine_index, s.element_id,
+           snippet(book_text_fts, 0, :match_start, :match_end, '…', :snippet_tokens) AS snippet,
+           bm25(book_text_fts) AS score
+    FROM book_text_fts
+    JOIN book_text_segments s ON s.id = book_text_fts.rowid
+    JOIN books b ON b.id = s.book_id
+    WHERE book_text_fts MATCH :query AND b.user_id = :user_id {book_filter}
+    ORDER BY score
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def text_index_version() -> str:
+    """Version of the text index; it changes with the text extraction and the spine reading"""
+    return f'{ContentProcessor.VERSION}.{MetadataExtractor.VERSION}'
+
+
+def fts_query(query: str) -> str:
+    """
+    Turn user input into a safe FTS5 query.
+
+    Every word becomes a quoted term, so FTS5 operators in the input are
+    searched for literally; all terms must match and the last one may be a
+    prefix, which suits search-as-you-type.
+
+    Args:
+        query: Search text entered by the user
+
+    Returns:
+        FTS5 MATCH expression
+
+    Raises:
+        ValueError: If the query contains no words
+    """
+    terms = re.findall(r'\w+', query or '')
+    if not terms:
+        raise ValueError("Search query must contain at least one word")
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def highlight_snippet(snippet: str) -> str:
+    """Escape a snippet and mark its matches with <mark>"""
+    escaped = html.escape(snippet or '')
+    return escaped.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+class BookTextIndex:
+    """
+    Builds and queries the full-text index of book contents.
+    """
+
+    # Segments inserted per statement
+    INSERT_BATCH = 500
+
+    def __init__(self, backfill_interval: float = 0, backfill_batch: int = 5):
+        """
+        Initialize the index.
+
+        Args:
+            backfill_interval: Seconds between backfill runs (0 disables them)
+            backfill_batch: Books indexed per backfill run
+        """
+        self.backfill_interval = backfill_interval
+        self.backfill_batch = backfill_batch
+        self.app = None
+        self._failed = set()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {
+            'books_indexed': 0,
+            'segments_indexed': 0,
+            'failures': 0,
+            'backfill_runs': 0,
+            'searches': 0,
+        }
+
+    def init_app(self, app) -> None:
+        """
+        Configure the index from SEARCH_* settings and start the backfill.
+
+        Args:
+            app: Flask application
+        """
+        self.stop()
+        self.app = app
+        self.backfill_interval = app.config.get('SEARCH_BACKFILL_INTERVAL', self.backfill_interval)
+        self.backfill_batch = app.config.get('SEARCH_BACKFILL_BATCH', self.backfill_batch)
+        if self.backfill_interval:
+            self.start()
+
+    def index_extracted(self, book_id: int, extracted_path: str) -> int:
+        """
+        Index the text of an extracted book, replacing any earlier entries.
+
+        The same pass weighs the chapters for reading progress, fills the
+        book's word count and page count, and builds the character-offset
+        index of every chapter; offsets stored against the previous indexes
+        are moved to the rebuilt ones.
+
+        Args:
+            book_id: Book ID
+            extracted_path: Directory the EPUB was extracted to
+
+        Returns:
+            Number of segments indexed
+
+        Raises:
+            ValueError: If the book's structure cannot be read
+        """
+        extractor = MetadataExtractor()
+        opf_path = extractor.get_opf_path(os.path.join(extracted_path, 'META-INF/container.xml'))
+        spine_items = extractor.get_spine_items(os.path.join(extracted_path, opf_path))
+        processor = ContentProcessor()
+        weights = ChapterWeights(len(spine_items))
+
+        session = db.session
+        # Stored offsets are moved from the previous chapter indexes once rebuilt
+        previous = load_book_locations(book_id)
+        rebuilt: Dict[int, ChapterLocations] = {}
+        session.execute(delete(BookTextSegment).where(BookTextSegment.book_id == book_id))
+        session.execute(delete(ChapterLocation).where(ChapterLocation.book_id == book_id))
+
+        count = 0
+        batch: List[Dict[str, Any]] = []
+        location_rows: List[Dict[str, Any]] = []
+        for spine_index, item in enumerate(spine_items):
+            if not os.path.isfile(item['href']):
+                continue
+            locations = ChapterLocations()
+            for element_id, segment in processor.iter_text(item['href'], locations=locations):
+                if not segment:
+                    continue
+                weights.add(spine_index, segment)
+                batch.append({
+                    'book_id': book_id,
+                    'spine_index': spine_index,
+                    'element_id': element_id,
+                    'text': segment
+                })
+                if len(batch) >= self.INSERT_BATCH:
+                    session.execute(insert(BookTextSegment), batch)
+                    count += len(batch)
+                    batch = []
+            rebuilt[spine_index] = locations
+            starts, ends, parents = locations.pack()
+            location_rows.append({
+                'book_id': book_id,
+                'spine_index': spine_index,
+                'length': locations.length,
+                'starts': starts,
+                'ends': ends,
+                'parents': parents,
+                'blocks': locations.blocks.tobytes()
+            })
+        if location_rows:
+            session.execute(insert(ChapterLocation), location_rows)
+        if previous:
+            reanchor_book(book_id, previous, rebuilt)
+        if batch:
+            session.execute(insert(BookTextSegment), batch)
+            count += len(batch)
+
+        session.execute(
+            update(Book).where(Book.id == book_id).values(text_indexed_at=datetime.utcnow(), **weights.columns())
+        )
+        stamp_artifact(book_id, 'text', text_index_version())
+        session.commit()
+
+        self.stats['books_indexed'] += 1
+        self.stats['segments_indexed'] += count
+        return count
+
+    def index_book(self, book: Book) -> int:
+        """
+        Extract a stored book and index its text.
+
+        Args:
+            book: Book to index
+
+        Returns:
+            Number of segments indexed
+        """
+        with EPUBProcessor() as processor:
+            return self.index_extracted(book.id, processor.extract(book.file_path))
+
+    def backfill(self, limit: Optional[int] = None) -> int:
+        """
+        Index books that are not indexed yet.
+
+        Books that fail are skipped until the process restarts.
+
+        Args:
+            limit: Maximum number of books to index (defaults to backfill_batch)
+
+        Returns:
+            Number of books indexed
+        """
+        query = Book.query.filter(Book.text_indexed_at.is_(None))
+        if self._failed:
+            query = query.filter(Book.id.notin_(self._failed))
+        books = query.order_by(Book.id).limit(limit or self.backfill_batch).all()
+
+        indexed = 0
+        for book in books:
+            try:
+                self.index_book(book)
+                indexed += 1
+            except (ValueError, OSError) as e:
+                db.session.rollback()
+                self._failed.add(book.id)
+                self.stats['failures'] += 1
+                if self.app is not None:
+                    self.app.logger.warning(f"Could not index book {book.id}: {str(e)}")
+        self.stats['backfill_runs'] += 1
+        return indexed
+
+    def search(self, user_id: int, query: str, book_id: Optional[int] = None,
+               limit: int = 20, offset: int = 0, snippet_tokens: int = 16) -> List[Dict[str, Any]]:
+        """
+        Find the best-ranked passages matching a query.
+
+        Args:
+            user_id: Owner of the books searched
+            query: Search text entered by the user
+            book_id: Optional book to search within
+            limit: Maximum number of hits
+            offset: Number of hits to skip
+            snippet_tokens: Approximate snippet length in words
+
+        Returns:
+            Hits with book, spine index, element ID, escaped snippet and score
+
+        Raises:
+            ValueError: If the query contains no words
+        """
+        params = {
+            'query': fts_query(query),
+            'user_id': user_id,
+            'limit': limit,
+            'offset': offset,
+            'match_start': MATCH_START,
+            'match_end': MATCH_END,
+            'snippet_tokens': snippet_tokens,
+        }
+        book_filter = ''
+        if book_id is not None:
+            book_filter = 'AND s.book_id = :book_id'
+            params['book_id'] = book_id
+
+        rows = db.session.execute(text(_SEARCH_SQL.format(book_filter=book_filter)), params)
+        self.stats['searches'] += 1
+        return [
+            {
+                'book_id': row.book_id,
+                'title': row.title,
+                'author': row.author,
+                'spine_index': row.spine_index,
+                'element_id': row.element_id,
+                'snippet': highlight_snippet(row.snippet),
+                'score': round(-row.score, 4)
+            }
+            for row in rows
+        ]
+
+    def start(self) -> None:
+        """Start the background backfill thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='epubar-text-backfill', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background backfill thread."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self) -> None:
+        """Index a few unindexed books per interval until stopped."""
+        while not self._stop.wait(self.backfill_interval):
+            try:
+                with self.app.app_context():
+                    self.backfill()
+            except Exception as e:
+                self.app.logger.error(f"Error backfilling the search index: {str(e)}")
+
+
+# Shared index used at ingest and by the search API
+book_text_index = BookTextIndex()
@@ -0,0 +1,193 @@
+"""
+Search, sorting and facets for the library listing.
+
+Text search goes through the ``books_fts`` FTS5 index over title, author,
+publisher and subject; every sort order has a matching composite index so
+keyset pages stay range scans; facet counts are GROUP BY queries answered
+from the (user_id, language) and (user_id, author) indexes. Each facet is
+counted with every filter except its own, so the counts show what choosing
+another value would return.
+"""
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import column, func, literal_column, select, table, text
+
+from app.models.db import db
+from app.models.book import Book
+from app.models.reading_state import ReadingState
+from app.utils.search.fulltext import fts_query
+
+
+# Author sort key; books without an author sort first instead of breaking
+# the keyset comparison with NULL. The '' is rendered inline: as a bound
+# parameter SQLite would not match the expression to ix_books_user_author.
+AUTHOR_SORT_KEY = func.coalesce(Book.author, literal_column("''"))
+
+# Sort orders of the library: name -> (columns, descending by default,
+# Book attributes holding the sort key for cursors)
+LIBRARY_SORTS = {
+    'added': ((Book.created_at, Book.id), True, ('created_at', 'id')),
+    'title': ((Book.title, Book.id), False, ('title', 'id')),
+    'author': ((AUTHOR_SORT_KEY, Book.id), False, ('author_sort_key', 'id')),
+}
+
+# Facets reported for the library, in response order
+LIBRARY_FACETS = ('language', 'author', 'finished')
+
+_books_fts = table('books_fts', column('rowid'))
+
+
+def parse_library_args(args) -> Dict[str, Any]:
+    """
+    Read search, filter and sort options from request arguments.
+
+    Args:
+        args: Request arguments (q, language, author, finished, sort, order)
+
+    Returns:
+        Dictionary of options for library_filters() and library_sort()
+
+    Raises:
+        ValueError: If an option is invalid
+    """
+    sort = args.get('sort', 'added')
+    if sort not in LIBRARY_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(LIBRARY_SORTS)}")
+
+    order = args.get('order')
+    if order not in (None, 'asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+
+    finished = args.get('finished')
+    if finished not in (None, '', 'true', 'false'):
+        raise ValueError("finished must be true or false")
+
+    options = {
+        'q': (args.get('q') or '').strip() or None,
+        'language': args.get('language') or None,
+        'author': args.get('author') or None,
+        'finished': None if not finished else finished == 'true',
+        'sort': sort,
+        'descending': LIBRARY_SORTS[sort][1] if order is None else order == 'desc',
+    }
+    if options['q']:
+        # Reject queries without words before they reach FTS5
+        fts_query(options['q'])
+    return options
+
+
+def library_filters(user_id: int, options: Dict[str, Any], exclude: Optional[str] = None) -> List[Any]:
+    """
+    Build the WHERE clauses selecting a user's matching books.
+
+    Args:
+        user_id: Owner of the books
+        options: Options from parse_library_args()
+        exclude: Filter to leave out (used when counting that facet)
+
+    Returns:
+        List of SQLAlchemy clauses
+    """
+    clauses = [Book.user_id == user_id]
+    if options.get('q'):
+        matches = select(_books_fts.c.rowid).where(
+            text('books_fts MATCH :library_query').bindparams(library_query=fts_query(options['q']))
+        )
+        clauses.append(Book.id.in_(matches))
+    if options.get('language') and exclude != 'language':
+        clauses.append(Book.language == options['language'])
+    if options.get('author') and exclude != 'author':
+        clauses.append(AUTHOR_SORT_KEY == options['author'])
+    if options.get('finished') is not None and exclude != 'finished':
+        finished = Book.id.in_(_finished_book_ids(user_id))
+        clauses.append(finished if options['finished'] else ~finished)
+    return clauses
+
+
+def library_sort(options: Dict[str, Any]):
+    """
+    Return the sort columns and direction for keyset_page().
+
+    Args:
+        options: Options from parse_library_args()
+
+    Returns:
+        Tuple of (columns, descending)
+    """
+    return LIBRARY_SORTS[options['sort']][0], options['descending']
+
+
+def library_sort_keys(options: Dict[str, Any]):
+    """
+    Return the Book attributes holding the sort key, for keyset_page().
+
+    Args:
+        options: Options from parse_library_args()
+
+    Returns:
+        Tuple of attribute names
+    """
+    return LIBRARY_SORTS[options['sort']][2]
+
+
+def facet_counts(user_id: int, options: Dict[str, Any], author_limit: int = 20) -> Dict[str, Any]:
+    """
+    Count the matching books per language, author and finished state.
+
+    Args:
+        user_id: Owner of the books
+        options: Options from parse_library_args()
+        author_limit: Number of most frequent authors reported
+
+    Returns:
+        Dictionary with ``language`` and ``author`` lists of
+        ``{"value", "count"}`` (most frequent first) and ``finished``
+        counts of finished and unfinished books
+    """
+    session = db.session
+    facets = {}
+
+    language_count = func.count(Book.id)
+    rows = session.execute(
+        select(Book.language, language_count)
+        .where(*library_filters(user_id, options, exclude='language'))
+        .group_by(Book.language)
+        .order_by(language_count.desc(), Book.language)
+    )
+    facets['language'] = [{'value': value, 'count': count} for value, count in rows]
+
+    author_count = func.count(Book.id)
+    rows = session.execute(
+        select(AUTHOR_SORT_KEY, author_count)
+        .where(*library_filters(user_id, options, exclude='author'))
+        .group_by(AUTHOR_SORT_KEY)
+        .order_by(author_count.desc(), AUTHOR_SORT_KEY)
+        .limit(author_limit)
+    )
+    facets['author'] = [{'value': value, 'count': count} for value, count in rows]
+
+    # Finished books are counted from the reading states, which are few,
+    # instead of outer-joining every book
+    filters = library_filters(user_id, options, exclude='finished')
+    if not options.get('language') and options.get('finished') is None:
+        # Same filters as the language facet, which already counted them
+        total = sum(entry['count'] for entry in facets['language'])
+    else:
+        total = session.execute(select(func.count(Book.id)).where(*filters)).scalar()
+    finished = session.execute(
+        select(func.count(Book.id))
+        .select_from(ReadingState)
+        .join(Book, Book.id == ReadingState.book_id)
+        .where(ReadingState.user_id == user_id, ReadingState.is_finished.is_(True), *filters)
+    ).scalar()
+    facets['finished'] = {'finished': finished, 'unfinished': total - finished}
+
+    return facets
+
+
+def _finished_book_ids(user_id: int):
+    """Subquery of the IDs of books the user has finished"""
+    return select(ReadingState.book_id).where(
+        ReadingState.user_id == user_id,
+        ReadingState.is_finished.is_(True)
+    )